@@ -5,5 +5,8 @@ export const Config = {
     CloudtraillakeEventDataStoreArn: "",
     // The email address which will recieve notifications from SNS for any service limit quota limits that are requested
     // Note: you will need to check your inbox after deploying the CDK and confirm the SNS subscription
-    NotifyEmailAddress: ""
+    NotifyEmailAddress: "",
+    // [Optional] The name of an S3 bucket the Lambda function may stream large query results into (see ResultSink in the README)
+    // Leave empty if every query result fits in the Lambda response payload
+    ResultSinkBucketName: ""
 };
\ No newline at end of file
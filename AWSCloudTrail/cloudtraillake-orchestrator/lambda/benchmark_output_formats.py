@@ -0,0 +1,66 @@
+import gzip
+import json
+import os
+import time
+import uuid
+
+from local_cloudtrail import FakeCloudTrailClient, load_query_function
+
+# Compares the payload size and encode time of the OutputFormat and ResultFormat options of
+# cloudtraillake-query.py against the default JSON body, on synthetic CloudTrail Lake rows.
+#
+# Usage:
+#   python3 benchmark_output_formats.py [rows]
+# parquet and arrow are only measured when pyarrow is installed.
+
+def make_rows(count):
+    rows = []
+    for i in range(count):
+        rows.append([
+            { 'eventID': str(uuid.uuid4()) },
+            { 'eventTime': '2022-06-08 19:{:02d}:{:02d}.000'.format(i // 60 % 60, i % 60) },
+            { 'eventName': ['GetObject', 'PutObject', 'AssumeRole', 'ConsoleLogin'][i % 4] },
+            { 'eventSource': 's3.amazonaws.com' },
+            { 'awsRegion': ['us-east-1', 'eu-west-1'][i % 2] },
+            { 'recipientAccountId': '123456789012' },
+            { 'bytesTransferred': str(i * 17 % 100000) }
+        ])
+    return rows
+
+def measure(name, encode, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        payload = encode()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('{:<28} {:>12,} bytes {:>12,} gzipped {:>9.1f} ms'.format(name, len(payload), len(gzip.compress(payload)), best * 1000))
+
+def main(count):
+    rows = make_rows(count)
+    # cloudtraillake-query.py creates its boto3 client when it is loaded
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    query = load_query_function(FakeCloudTrailClient(rows))
+    print('{:,} rows'.format(count))
+
+    # the default body: the rows exactly as CloudTrail Lake returns them
+    measure('rows (current body)', lambda: json.dumps(rows).encode('utf-8'))
+    for OutputFormat in ['records', 'columnar']:
+        for CoerceTypes in [False, True]:
+            event = { 'OutputFormat': OutputFormat, 'CoerceTypes': CoerceTypes }
+            name = '{}{}'.format(OutputFormat, ' + CoerceTypes' if CoerceTypes else '')
+            measure(name, lambda: json.dumps(query.format_query_results([rows], event)[0]).encode('utf-8'))
+
+    if query.get_pyarrow() is None:
+        print('pyarrow is not installed, skipping parquet and arrow')
+        return
+    for ResultFormat in query.ArrowResultFormats:
+        def encode():
+            decoder = query.ResultDecoder(True)
+            decoder.add_page(rows)
+            return query.encode_arrow(decoder, ResultFormat)
+        measure(ResultFormat + ' + CoerceTypes', encode)
+
+if __name__ == "__main__":
+    import sys
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,41 @@
+import os
+import sys
+
+from local_cloudtrail import load_query_function
+
+# Checks the column types CoerceTypes infers from CloudTrail Lake string values.
+# It is not deployed with the Lambda function.
+#
+# Usage:
+#   python3 check_coerce_types.py
+
+Cases = [
+    # (values, expected type, expected converted values)
+    (['1', '22', None], 'bigint', [1, 22, None]),
+    (['1', '2.5', '-3', '4e2'], 'double', [1.0, 2.5, -3.0, 400.0]),
+    (['0.5', '1.25'], 'double', [0.5, 1.25]),
+    (['012345678901', '2.5'], 'string', ['012345678901', '2.5']),
+    (['1', 'GetObject'], 'string', ['1', 'GetObject']),
+    ([None, None], 'string', [None, None]),
+]
+
+def main():
+    # cloudtraillake-query.py creates its boto3 client when it is loaded
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    query = load_query_function(None)
+    failed = 0
+    for Values, ExpectedType, ExpectedValues in Cases:
+        Type, Converted = query.coerce_column(Values)
+        if (Type, Converted) != (ExpectedType, ExpectedValues):
+            print('{}: expected {} {}, got {} {}'.format(Values, ExpectedType, ExpectedValues, Type, Converted))
+            failed += 1
+    Type, Converted = query.coerce_column(['2022-06-08 19:58:06.000'])
+    if Type != 'timestamp' or query.format_timestamp(Converted[0]) != '2022-06-08T19:58:06.000Z':
+        print('timestamp column: got {} {}'.format(Type, Converted))
+        failed += 1
+    print('{} of {} column types checked'.format(len(Cases) + 1 - failed, len(Cases) + 1))
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
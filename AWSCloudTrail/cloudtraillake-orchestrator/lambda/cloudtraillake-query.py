@@ -4,12 +4,81 @@ import time
 import re
 import datetime
 import os
+import zlib
+import random
+import hashlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
 client = boto3.client('cloudtrail')
 RequiredParameters = ['EventDataStore', 'QueryStatement']
-MaxQueryResults = 100
+CollectRequiredParameters = ['EventDataStore', 'QueryId']
+# "query" starts the query and waits for all of its results, "start" and "collect" split that across invocations
+Operations = ['query', 'start', 'collect']
+# the largest page size get_query_results accepts, fewer pages means fewer calls
+MaxQueryResults = 1000
+
+# query waiter settings, describe_query is polled with exponential backoff and jitter until the query reaches a terminal state
+TerminalQueryStatuses = ['FINISHED', 'FAILED', 'CANCELLED', 'TIMED_OUT']
+PollInitialDelay = 0.5
+PollMaxDelay = 10
+PollBackoffRate = 2
+# stop waiting when less than this is left of the Lambda timeout, so the function can still return
+RemainingTimeReserveMillis = 10000
+
+# streaming mode settings, used when the caller passes a ResultSink
+# each part is written as its own object, and S3 requires at least 5 MiB for every multipart chunk except the last
+# parquet and arrow need pyarrow, for example from the AWS SDK for pandas Lambda layer
+ResultFormats = {'ndjson': '.ndjson', 'ndjson.gz': '.ndjson.gz', 'parquet': '.parquet', 'arrow': '.arrow'}
+ArrowResultFormats = ['parquet', 'arrow']
+DefaultResultFormat = 'ndjson.gz'
+DefaultRowsPerPart = 100000
+MultipartChunkSize = 8 * 1024 * 1024
+
+# result cache settings, used when the caller passes CacheTTLSeconds
+# the in-memory cache lives as long as the Lambda container, a CacheStore keeps results across containers
+CacheMaxEntries = 256
+CacheMaxBytes = 64 * 1024 * 1024
+
+# output formats of the rows returned in the response body
+# "rows" is QueryResultRows as returned by CloudTrail Lake: a list of rows, each a list of single key objects
+# "records" is a list of objects with one key per column, "columnar" is one list of values per column plus a schema
+OutputFormats = ['rows', 'records', 'columnar']
+IntegerPattern = re.compile(r'^-?(0|[1-9][0-9]*)$')
+# also matches integers, so that a column mixing integers and decimal numbers is a double column, tried after bigint
+DoublePattern = re.compile(r'^-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?$')
+TimestampPattern = re.compile(r'^([0-9]{4}-[0-9]{2}-[0-9]{2})[ T]([0-9]{2}:[0-9]{2}:[0-9]{2})(\.[0-9]+)?Z?$')
+# string literals and quoted identifiers, with their doubled quote escapes
+QuotedPattern = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+# batch mode settings, the default concurrency stays within the CloudTrail Lake quota of concurrent queries
+DefaultMaxConcurrentQueries = 10
+StartQueryRetries = 5
 
 def lambda_handler(event, context):
     
+    Operation = event.get('Operation', 'query')
+    if Operation not in Operations:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                "InvalidParameter": "Operation"
+            })
+        }
+    # for example:
+    # "OutputFormat": "columnar"
+    # "CoerceTypes": true, or a list of the columns to convert to numbers and timestamps
+    if event.get('OutputFormat', 'rows') not in OutputFormats:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                "InvalidParameter": "OutputFormat"
+            })
+        }
+    if Operation == 'collect':
+        return collect_handler(event, context)
+    if Operation == 'query' and 'Batch' in event:
+        return batch_handler(event, context)
+
     # check the input parameters from the function invocation
     for requiredParam in RequiredParameters:
         if requiredParam not in event:
@@ -19,18 +88,9 @@ def lambda_handler(event, context):
                     "MissingParameter": requiredParam
                 })
             }
-    EventDataStore = event['EventDataStore']
+    EventDataStore = get_event_data_store_id(event['EventDataStore'])
     QueryStatement = event['QueryStatement']
     
-    # obtain the event data store associated with this Lambda function if not provided
-    if EventDataStore == '' or EventDataStore == "FROM_ENV":
-        EventDataStore = os.environ['EVENT_DATA_STORE']
-    
-    # If a full Arn was passed, we only need the event data store ID
-    matchEDS = re.search("^arn:.*eventdatastore\/(.*)", EventDataStore)
-    if matchEDS:
-        EventDataStore = matchEDS.group(1)
-    
     # insert the EventDataStore into the QueryFormatParams if used m{EventDataStore} in place of hard coding it into the QueryStatement
     # if eventDataStore is derived from the environment, then it will be formatted in to the SQL
     if not 'QueryFormatParams' in event:
@@ -49,14 +109,359 @@ def lambda_handler(event, context):
     if 'QueryFormatParams' in event:
         QueryStatement = QueryStatement.format(m=event['QueryFormatParams'])
     
+    # in streaming mode the rows are written to the sink in parts, so check the sink before starting the query
+    # for example:
+    # "ResultSink": "s3://my-bucket/cloudtraillake/" or "file:///tmp/cloudtraillake" for local testing
+    # "ResultFormat": "ndjson" or "ndjson.gz"
+    # "RowsPerPart": 100000
+    sink = None
+    if event.get('ResultSink'):
+        ResultFormat = event.get('ResultFormat', DefaultResultFormat)
+        if ResultFormat not in ResultFormats:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    "InvalidParameter": "ResultFormat"
+                })
+            }
+        if ResultFormat in ArrowResultFormats and get_pyarrow() is None:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    "InvalidParameter": "ResultFormat",
+                    "Reason": "pyarrow is not installed"
+                })
+            }
+        sink = get_result_sink(event['ResultSink'])
+        if sink is None:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    "InvalidParameter": "ResultSink"
+                })
+            }
+
+    # return the rows of an identical query from the cache, if it has not expired, without starting a new query
+    # for example:
+    # "CacheTTLSeconds": 300
+    # "CacheStore": "file:///tmp/cloudtraillake-cache" to also keep results outside of this Lambda container
+    cache = None
+    if Operation == 'query' and sink is None and event.get('CacheTTLSeconds'):
+        cache = get_result_cache(event.get('CacheStore'))
+        if cache is None:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    "InvalidParameter": "CacheStore"
+                })
+            }
+        CacheKey = get_cache_key(EventDataStore, QueryStatement)
+        QueryResultRows = cache.get(CacheKey)
+        if QueryResultRows is not None:
+            print("CloudTrail Lake Query:", { "TotalResults": len(QueryResultRows), "QueryStatement": QueryStatement, "EventDataStore": EventDataStore, "Cache": "hit" } )
+            return {
+                'statusCode': 200,
+                'body': format_query_results([QueryResultRows], event)[0]
+            }
+
     # start the query
     response = client.start_query(
         QueryStatement=QueryStatement
     )
     QueryId = response['QueryId']
     
-    # begin getting query results
-    QueryResultRows = []
+    # in the split mode, return a checkpoint right away and let the caller collect the results later
+    if Operation == 'start':
+        print("CloudTrail Lake Query:", { "QueryId": QueryId, "QueryStatement": QueryStatement, "EventDataStore": EventDataStore } )
+        return {
+            'statusCode': 200,
+            'body': {
+                'QueryId': QueryId,
+                'NextToken': None,
+                'Complete': False
+            }
+        }
+
+    # wait for the query to complete, then begin getting query results
+    waiter = QueryWaiter(client, context)
+    try:
+        response = waiter.wait(EventDataStore, QueryId)
+    except QueryWaitTimeout as e:
+        print("CloudTrail Lake Query:", { "QueryId": QueryId, "QueryStatus": e.QueryStatus, "QueryStatement": QueryStatement, "EventDataStore": EventDataStore, **waiter.metrics() } )
+        return {
+            'statusCode': 504,
+            'body': json.dumps({
+                "QueryId": QueryId,
+                "QueryStatus": e.QueryStatus
+            })
+        }
+    if response['QueryStatus'] != 'FINISHED':
+        print("CloudTrail Lake Query:", { "QueryId": QueryId, "QueryStatus": response['QueryStatus'], "QueryStatement": QueryStatement, "EventDataStore": EventDataStore, **waiter.metrics() } )
+        return {
+            'statusCode': 500,
+            'body': json.dumps({
+                "QueryId": QueryId,
+                "QueryStatus": response['QueryStatus'],
+                "ErrorMessage": response.get('ErrorMessage', '')
+            })
+        }
+    pages = get_query_result_pages(EventDataStore, QueryId, waiter)
+
+    if sink is not None:
+        manifest = write_result_parts(pages, sink, QueryId, ResultFormat, int(event.get('RowsPerPart', DefaultRowsPerPart)), event.get('CoerceTypes'))
+        print("CloudTrail Lake Query:", { "TotalResults": manifest['TotalResults'], "Parts": len(manifest['Parts']), "QueryStatement": QueryStatement, "EventDataStore": EventDataStore, **waiter.metrics() } )
+        return {
+            'statusCode': 200,
+            'body': manifest
+        }
+
+    # the cache keeps the rows as returned by CloudTrail Lake, otherwise the pages are decoded as they arrive
+    if cache is not None:
+        QueryResultRows = []
+        for page in pages:
+            QueryResultRows.extend(page)
+        cache.put(CacheKey, QueryResultRows, float(event['CacheTTLSeconds']))
+        pages = [QueryResultRows]
+    body, TotalResults = format_query_results(pages, event)
+
+    print("CloudTrail Lake Query:", { "TotalResults": TotalResults, "QueryStatement": QueryStatement, "EventDataStore": EventDataStore, **waiter.metrics() } )
+
+    return {
+        'statusCode': 200,
+        'body': body
+    }
+
+def batch_handler(event, context):
+    # run several queries in one invocation, polling them concurrently, and return the results keyed by input
+    # each item of Batch is either a QueryStatement or an object with QueryFormatParams to format into the QueryStatement
+    # for example:
+    # "QueryStatement": "SELECT ... FROM {m[EventDataStore]} WHERE element_at(serviceEventDetails, 'requestId') = '{m[RequestId]}'",
+    # "Batch": [
+    #   { "Key": "request-1", "QueryFormatParams": { "RequestId": "1" } },
+    #   "SELECT eventID FROM {m[EventDataStore]} WHERE ...",
+    # ],
+    # "MaxConcurrentQueries": 10
+    # items without a Key are keyed by their position in Batch
+    if 'EventDataStore' not in event:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                "MissingParameter": "EventDataStore"
+            })
+        }
+    EventDataStore = get_event_data_store_id(event['EventDataStore'])
+
+    # render every statement, identical statements are only queried once
+    QueryStatements = collections.OrderedDict()
+    for index, item in enumerate(event['Batch']):
+        if isinstance(item, str):
+            item = { 'QueryStatement': item }
+        QueryStatement = item.get('QueryStatement', event.get('QueryStatement'))
+        if QueryStatement is None:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    "MissingParameter": "QueryStatement",
+                    "Batch": index
+                })
+            }
+        QueryFormatParams = dict(event.get('QueryFormatParams', {}))
+        QueryFormatParams.update(item.get('QueryFormatParams', {}))
+        QueryFormatParams.setdefault('EventDataStore', EventDataStore)
+        QueryStatements[str(item.get('Key', index))] = QueryStatement.format(m=QueryFormatParams)
+
+    cache = None
+    if event.get('CacheTTLSeconds'):
+        cache = get_result_cache(event.get('CacheStore'))
+        if cache is None:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    "InvalidParameter": "CacheStore"
+                })
+            }
+
+    results = {}
+    pending = []
+    for QueryStatement in collections.OrderedDict.fromkeys(QueryStatements.values()):
+        QueryResultRows = cache.get(get_cache_key(EventDataStore, QueryStatement)) if cache is not None else None
+        if QueryResultRows is not None:
+            results[QueryStatement] = { 'QueryStatus': 'FINISHED', 'QueryResultRows': QueryResultRows, 'Cache': 'hit' }
+        else:
+            pending.append(QueryStatement)
+
+    # every worker starts its query, waits for it and reads its results, so at most MaxConcurrentQueries run at once
+    waiters = []
+    with ThreadPoolExecutor(max_workers=int(event.get('MaxConcurrentQueries', DefaultMaxConcurrentQueries))) as executor:
+        for QueryStatement, (result, waiter) in zip(pending, executor.map(lambda QueryStatement: run_batch_query(EventDataStore, QueryStatement, context), pending)):
+            results[QueryStatement] = result
+            waiters.append(waiter)
+            if cache is not None and result['QueryStatus'] == 'FINISHED':
+                cache.put(get_cache_key(EventDataStore, QueryStatement), result['QueryResultRows'], float(event['CacheTTLSeconds']))
+
+    body = {}
+    for Key, QueryStatement in QueryStatements.items():
+        body[Key] = results[QueryStatement]
+    for result in results.values():
+        if 'QueryResultRows' in result:
+            result['QueryResultRows'] = format_query_results([result['QueryResultRows']], event)[0]
+    Failed = len([Key for Key in body if body[Key]['QueryStatus'] != 'FINISHED'])
+    print("CloudTrail Lake Batch:", { "Queries": len(QueryStatements), "Started": len(pending), "Failed": Failed, "EventDataStore": EventDataStore, **combine_metrics(waiters) } )
+
+    return {
+        'statusCode': 200,
+        'body': body
+    }
+
+def run_batch_query(EventDataStore, QueryStatement, context):
+    waiter = QueryWaiter(client, context)
+    result = {}
+    try:
+        result['QueryId'] = start_query(QueryStatement, waiter)
+        response = waiter.wait(EventDataStore, result['QueryId'])
+        result['QueryStatus'] = response['QueryStatus']
+        if response['QueryStatus'] == 'FINISHED':
+            result['QueryResultRows'] = []
+            for page in get_query_result_pages(EventDataStore, result['QueryId'], waiter):
+                result['QueryResultRows'].extend(page)
+        else:
+            result['ErrorMessage'] = response.get('ErrorMessage', '')
+    except QueryWaitTimeout as e:
+        result['QueryStatus'] = e.QueryStatus
+        result['ErrorMessage'] = str(e)
+    except Exception as e:
+        result['QueryStatus'] = 'ERROR'
+        result['ErrorMessage'] = str(e)
+    return result, waiter
+
+def start_query(QueryStatement, waiter):
+    # other callers may be running queries too, so back off when the account is at its concurrent query quota
+    delay = waiter.InitialDelay
+    for attempt in range(StartQueryRetries + 1):
+        try:
+            return waiter.call('start_query', QueryStatement=QueryStatement)['QueryId']
+        except Exception as e:
+            ErrorCode = getattr(e, 'response', {}).get('Error', {}).get('Code')
+            if ErrorCode != 'MaxConcurrentQueriesException' or attempt == StartQueryRetries:
+                raise
+        sleep = delay / 2 + random.uniform(0, delay / 2)
+        time.sleep(sleep)
+        waiter.WaitSeconds += sleep
+        delay = min(delay * waiter.BackoffRate, waiter.MaxDelay)
+
+def combine_metrics(waiters):
+    Calls = {}
+    for waiter in waiters:
+        for operation, count in waiter.Calls.items():
+            Calls[operation] = Calls.get(operation, 0) + count
+    return {
+        "ApiCalls": sum(Calls.values()),
+        "ApiCallsByOperation": Calls,
+        "ApiSeconds": round(sum(waiter.CallSeconds for waiter in waiters), 3),
+        "WaitSeconds": round(sum(waiter.WaitSeconds for waiter in waiters), 3)
+    }
+
+def collect_handler(event, context):
+    # read as many result pages of a started query as fit in the time budget and return them with the next checkpoint
+    # for example:
+    # "Operation": "collect",
+    # "QueryId": "1e9a8f2b-...",
+    # "NextToken": null or the NextToken returned by the previous collect,
+    # "MaxRows": 1000, to keep the response within the Step Functions payload limit
+    # "TimeBudgetSeconds": 60
+    for requiredParam in CollectRequiredParameters:
+        if requiredParam not in event:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    "MissingParameter": requiredParam
+                })
+            }
+    EventDataStore = get_event_data_store_id(event['EventDataStore'])
+    QueryId = event['QueryId']
+
+    waiter = QueryWaiter(client, context)
+    checkpoint = collect_query_results(EventDataStore, QueryId, event.get('NextToken'), waiter, event.get('MaxRows'), event.get('TimeBudgetSeconds'))
+    print("CloudTrail Lake Collect:", { "QueryId": QueryId, "QueryStatus": checkpoint['QueryStatus'], "Results": len(checkpoint['QueryResultRows']), "Complete": checkpoint['Complete'], "EventDataStore": EventDataStore, **waiter.metrics() } )
+
+    checkpoint['QueryResultRows'] = format_query_results([checkpoint['QueryResultRows']], event)[0]
+
+    if checkpoint['QueryStatus'] not in ['QUEUED', 'RUNNING', 'FINISHED']:
+        return {
+            'statusCode': 500,
+            'body': json.dumps({
+                "QueryId": QueryId,
+                "QueryStatus": checkpoint['QueryStatus'],
+                "ErrorMessage": checkpoint.get('ErrorMessage', '')
+            })
+        }
+    return {
+        'statusCode': 200,
+        'body': checkpoint
+    }
+
+def collect_query_results(EventDataStore, QueryId, NextToken, waiter, MaxRows=None, TimeBudgetSeconds=None):
+    deadline = None
+    if TimeBudgetSeconds:
+        deadline = time.monotonic() + float(TimeBudgetSeconds)
+    checkpoint = {
+        'QueryId': QueryId,
+        'QueryStatus': 'FINISHED',
+        'NextToken': NextToken,
+        'Complete': False,
+        'QueryResultRows': []
+    }
+
+    # a NextToken means the query already finished, otherwise check once instead of waiting inside the invocation
+    if NextToken is None:
+        response = waiter.call('describe_query', EventDataStore=EventDataStore, QueryId=QueryId)
+        checkpoint['QueryStatus'] = response['QueryStatus']
+        if response['QueryStatus'] != 'FINISHED':
+            if 'ErrorMessage' in response:
+                checkpoint['ErrorMessage'] = response['ErrorMessage']
+            return checkpoint
+
+    QueryResultRows = checkpoint['QueryResultRows']
+    while 1:
+        args = {}
+        args['EventDataStore'] = EventDataStore
+        args['QueryId'] = QueryId
+        args['MaxQueryResults'] = MaxQueryResults
+        if MaxRows:
+            args['MaxQueryResults'] = min(MaxQueryResults, int(MaxRows) - len(QueryResultRows))
+        if NextToken is not None:
+            args['NextToken'] = NextToken
+        start = time.monotonic()
+        response = waiter.call('get_query_results', **args)
+        QueryResultRows.extend(response.get('QueryResultRows', []))
+        NextToken = response.get('NextToken')
+        if NextToken is None or (MaxRows and len(QueryResultRows) >= int(MaxRows)):
+            break
+
+        # stop when another page taking as long as the last one might not fit in the remaining time
+        remaining = waiter.remaining_seconds()
+        if deadline is not None:
+            remaining = deadline - time.monotonic() if remaining is None else min(remaining, deadline - time.monotonic())
+        if remaining is not None and remaining < time.monotonic() - start:
+            break
+
+    checkpoint['NextToken'] = NextToken
+    checkpoint['Complete'] = NextToken is None
+    return checkpoint
+
+def get_event_data_store_id(EventDataStore):
+    # obtain the event data store associated with this Lambda function if not provided
+    if EventDataStore == '' or EventDataStore == "FROM_ENV":
+        EventDataStore = os.environ['EVENT_DATA_STORE']
+    
+    # If a full Arn was passed, we only need the event data store ID
+    matchEDS = re.search("^arn:.*eventdatastore\/(.*)", EventDataStore)
+    if matchEDS:
+        EventDataStore = matchEDS.group(1)
+    return EventDataStore
+
+def get_query_result_pages(EventDataStore, QueryId, waiter):
+    # generator over the QueryResultRows of each page of a finished query, so callers never need to hold more than one page
     NextToken = None
     
     while 1:
@@ -68,25 +473,457 @@ def lambda_handler(event, context):
         args['MaxQueryResults'] = MaxQueryResults
         if NextToken is not None:
             args['NextToken'] = NextToken
-        response = client.get_query_results(**args)
+        response = waiter.call('get_query_results', **args)
         
-        # handle if query is not yet finished
-        if response['QueryStatus'] != 'FINISHED':
-            time.sleep(1)
-            continue
-        
-        # save the results and continue getting results if any
+        # hand out the results and continue getting results if any
         if 'QueryResultRows' in response:
-            QueryResultRows.extend(response['QueryResultRows'])
+            yield response['QueryResultRows']
         if 'NextToken' in response:
             NextToken=response['NextToken']
         else:
             break
 
-    print("CloudTrail Lake Query:", { "TotalResults": len(QueryResultRows), "QueryStatement": QueryStatement, "EventDataStore": EventDataStore } )
+class QueryWaitTimeout(Exception):
+    def __init__(self, QueryId, QueryStatus):
+        super().__init__("Query {} still {} when the Lambda function ran out of time".format(QueryId, QueryStatus))
+        self.QueryId = QueryId
+        self.QueryStatus = QueryStatus
+
+class QueryWaiter:
+    # polls describe_query, which is much cheaper than get_query_results, until the query reaches a terminal state
+    # every CloudTrail call made through the waiter is counted and timed
+    def __init__(self, cloudtrail, context=None, InitialDelay=PollInitialDelay, MaxDelay=PollMaxDelay, BackoffRate=PollBackoffRate):
+        self.cloudtrail = cloudtrail
+        self.context = context
+        self.InitialDelay = InitialDelay
+        self.MaxDelay = MaxDelay
+        self.BackoffRate = BackoffRate
+        self.Calls = {}
+        self.CallSeconds = 0.0
+        self.WaitSeconds = 0.0
+
+    def call(self, operation, **args):
+        start = time.monotonic()
+        try:
+            return getattr(self.cloudtrail, operation)(**args)
+        finally:
+            self.Calls[operation] = self.Calls.get(operation, 0) + 1
+            self.CallSeconds += time.monotonic() - start
+
+    def remaining_seconds(self):
+        # without a Lambda context (e.g. when running locally) there is no deadline
+        if self.context is None:
+            return None
+        return (self.context.get_remaining_time_in_millis() - RemainingTimeReserveMillis) / 1000
+
+    def wait(self, EventDataStore, QueryId):
+        delay = self.InitialDelay
+        while 1:
+            response = self.call('describe_query', EventDataStore=EventDataStore, QueryId=QueryId)
+            if response['QueryStatus'] in TerminalQueryStatuses:
+                return response
+
+            # back off exponentially, with jitter so concurrent waiters do not poll in lockstep
+            sleep = delay / 2 + random.uniform(0, delay / 2)
+            remaining = self.remaining_seconds()
+            if remaining is not None:
+                if remaining <= 0:
+                    raise QueryWaitTimeout(QueryId, response['QueryStatus'])
+                sleep = min(sleep, remaining)
+            time.sleep(sleep)
+            self.WaitSeconds += sleep
+            delay = min(delay * self.BackoffRate, self.MaxDelay)
+
+    def metrics(self):
+        return {
+            "ApiCalls": sum(self.Calls.values()),
+            "ApiCallsByOperation": self.Calls,
+            "ApiSeconds": round(self.CallSeconds, 3),
+            "WaitSeconds": round(self.WaitSeconds, 3)
+        }
+
+def write_result_parts(pages, sink, QueryId, ResultFormat, RowsPerPart, CoerceTypes=None):
+    # write the rows as parts of at most RowsPerPart rows each and return a manifest of the parts
+    Parts = []
+    TotalResults = 0
+    part = None
+    try:
+        for page in pages:
+            for row in page:
+                if part is None:
+                    Key = '{}/part-{:05d}{}'.format(QueryId, len(Parts), ResultFormats[ResultFormat])
+                    part = ResultPart(sink.open(Key), ResultFormat, CoerceTypes)
+                part.write_row(row)
+                TotalResults += 1
+                if part.Rows >= RowsPerPart:
+                    Parts.append(part.close())
+                    part = None
+        if part is not None:
+            Parts.append(part.close())
+            part = None
+    except Exception:
+        # do not leave incomplete multipart uploads behind
+        if part is not None:
+            part.abort()
+        raise
 
     return {
-        'statusCode': 200,
-        'body': QueryResultRows
+        'QueryId': QueryId,
+        'ResultFormat': ResultFormat,
+        'TotalResults': TotalResults,
+        'Parts': Parts
     }
 
+def format_query_results(pages, event):
+    # returns the rows of the pages in the requested OutputFormat and the number of rows
+    OutputFormat = event.get('OutputFormat', 'rows')
+    if OutputFormat == 'rows':
+        QueryResultRows = []
+        for page in pages:
+            QueryResultRows.extend(page)
+        return QueryResultRows, len(QueryResultRows)
+
+    decoder = ResultDecoder(event.get('CoerceTypes'))
+    for page in pages:
+        decoder.add_page(page)
+    if OutputFormat == 'records':
+        return decoder.records(), decoder.Rows
+    return decoder.columnar(), decoder.Rows
+
+class ResultDecoder:
+    # decodes pages of QueryResultRows into one list of values per column as they arrive
+    # columns missing from a row are None, and with CoerceTypes a column whose every value is a number or
+    # a timestamp is converted to that type
+    def __init__(self, CoerceTypes=None):
+        self.CoerceTypes = CoerceTypes
+        self.Columns = collections.OrderedDict()
+        self.Rows = 0
+
+    def add_page(self, page):
+        for row in page:
+            for cell in row:
+                for Name, Value in cell.items():
+                    if Name not in self.Columns:
+                        self.Columns[Name] = [None] * self.Rows
+                    Values = self.Columns[Name]
+                    # a column selected twice keeps its last value
+                    if len(Values) > self.Rows:
+                        Values[-1] = Value
+                    else:
+                        Values.append(Value)
+            self.Rows += 1
+            for Values in self.Columns.values():
+                if len(Values) < self.Rows:
+                    Values.append(None)
+
+    def decode(self):
+        # returns the schema and the values of every column, with the types coerced where asked for
+        Schema = []
+        Columns = collections.OrderedDict()
+        for Name, Values in self.Columns.items():
+            Type = 'string'
+            if self.CoerceTypes is True or (isinstance(self.CoerceTypes, list) and Name in self.CoerceTypes):
+                Type, Values = coerce_column(Values)
+            Schema.append({ 'Name': Name, 'Type': Type })
+            Columns[Name] = Values
+        return Schema, Columns
+
+    def columnar(self):
+        Schema, Columns = self.decode()
+        for Column in Schema:
+            if Column['Type'] == 'timestamp':
+                Columns[Column['Name']] = [format_timestamp(Value) for Value in Columns[Column['Name']]]
+        return { 'Schema': Schema, 'Columns': Columns, 'TotalResults': self.Rows }
+
+    def records(self):
+        decoded = self.columnar()
+        Names = list(decoded['Columns'].keys())
+        return [dict(zip(Names, Values)) for Values in zip(*decoded['Columns'].values())]
+
+def coerce_column(Values):
+    # returns the type every non null value of the column matches, and the converted values
+    for Type, pattern, convert in [('bigint', IntegerPattern, int), ('double', DoublePattern, float), ('timestamp', TimestampPattern, parse_timestamp)]:
+        if all(Value is None or (isinstance(Value, str) and pattern.match(Value)) for Value in Values):
+            if any(Value is not None for Value in Values):
+                return Type, [None if Value is None else convert(Value) for Value in Values]
+    return 'string', Values
+
+def parse_timestamp(Value):
+    # CloudTrail Lake returns times such as "2022-06-08 19:58:06.000", in UTC
+    # slicing the fields is several times faster than strptime
+    date, clock, fraction = TimestampPattern.match(Value).groups()
+    microsecond = int((fraction[1:] + '000000')[:6]) if fraction else 0
+    return datetime.datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]), int(clock[0:2]), int(clock[3:5]), int(clock[6:8]), microsecond, datetime.timezone.utc)
+
+def format_timestamp(Value):
+    if Value is None:
+        return None
+    return '{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}.{:03d}Z'.format(Value.year, Value.month, Value.day, Value.hour, Value.minute, Value.second, Value.microsecond // 1000)
+
+def get_pyarrow():
+    # pyarrow is only needed for the parquet and arrow result formats, so it is imported on first use
+    global pyarrow
+    if pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            return None
+    return pyarrow
+
+pyarrow = None
+
+def encode_arrow(decoder, ResultFormat):
+    ArrowTypes = {
+        'string': get_pyarrow().string(),
+        'bigint': pyarrow.int64(),
+        'double': pyarrow.float64(),
+        'timestamp': pyarrow.timestamp('ms', tz='UTC')
+    }
+    Schema, Columns = decoder.decode()
+    arrays = []
+    for Column in Schema:
+        Values = Columns[Column['Name']]
+        if Column['Type'] == 'string':
+            Values = [Value if Value is None or isinstance(Value, str) else json.dumps(Value) for Value in Values]
+        arrays.append(pyarrow.array(Values, type=ArrowTypes[Column['Type']]))
+    table = pyarrow.Table.from_arrays(arrays, names=[Column['Name'] for Column in Schema])
+
+    stream = pyarrow.BufferOutputStream()
+    if ResultFormat == 'parquet':
+        pyarrow.parquet.write_table(table, stream)
+    else:
+        with pyarrow.ipc.new_file(stream, table.schema) as writer:
+            writer.write_table(table)
+    return stream.getvalue().to_pybytes()
+
+def get_result_sink(ResultSink):
+    matchS3 = re.search("^s3://([^/]+)/?(.*)", ResultSink)
+    if matchS3:
+        return S3Sink(matchS3.group(1), matchS3.group(2))
+    matchFile = re.search("^file://(.+)", ResultSink)
+    if matchFile:
+        return LocalSink(matchFile.group(1))
+    return None
+
+def get_cache_key(EventDataStore, QueryStatement):
+    # statements that only differ in whitespace outside quoted literals or a trailing semicolon are the same query
+    # the case and the whitespace of string literals and quoted identifiers are kept because they matter there
+    parts = QuotedPattern.split(QueryStatement)
+    normalized = ''.join(part if i % 2 else re.sub(r'\s+', ' ', part) for i, part in enumerate(parts))
+    normalized = normalized.strip().rstrip(';').strip()
+    return hashlib.sha256('{}\n{}'.format(EventDataStore, normalized).encode('utf-8')).hexdigest()
+
+def get_result_cache(CacheStore=None):
+    if not CacheStore:
+        return MemoryCache
+    if CacheStore not in PersistentCaches:
+        matchFile = re.search("^file://(.+)", CacheStore)
+        if not matchFile:
+            return None
+        PersistentCaches[CacheStore] = TieredResultCache(MemoryCache, FileResultCache(matchFile.group(1)))
+    return PersistentCaches[CacheStore]
+
+class MemoryResultCache:
+    # least recently used cache of query results, bounded by the number of entries and their total size
+    def __init__(self, MaxEntries=CacheMaxEntries, MaxBytes=CacheMaxBytes):
+        self.MaxEntries = MaxEntries
+        self.MaxBytes = MaxBytes
+        self.Bytes = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, CacheKey):
+        if CacheKey not in self.entries:
+            return None
+        Expires, Size, QueryResultRows = self.entries[CacheKey]
+        if Expires <= time.time():
+            self.remove(CacheKey)
+            return None
+        self.entries.move_to_end(CacheKey)
+        return QueryResultRows
+
+    def put(self, CacheKey, QueryResultRows, TTLSeconds, Size=None):
+        if Size is None:
+            Size = len(json.dumps(QueryResultRows))
+        self.remove(CacheKey)
+        if Size > self.MaxBytes or TTLSeconds <= 0:
+            return
+        self.entries[CacheKey] = (time.time() + TTLSeconds, Size, QueryResultRows)
+        self.Bytes += Size
+        while len(self.entries) > self.MaxEntries or self.Bytes > self.MaxBytes:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, CacheKey):
+        if CacheKey in self.entries:
+            self.Bytes -= self.entries.pop(CacheKey)[1]
+
+class FileResultCache:
+    # persistent store keeping one JSON file per query result in a directory
+    # any other store (S3, DynamoDB, ...) can take its place by implementing load and save
+    def __init__(self, Directory, MaxEntries=CacheMaxEntries):
+        self.Directory = Directory
+        self.MaxEntries = MaxEntries
+        os.makedirs(Directory, exist_ok=True)
+
+    def load(self, CacheKey):
+        path = os.path.join(self.Directory, CacheKey + '.json')
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry['Expires'] <= time.time():
+            self.remove(path)
+            return None
+        return entry
+
+    def save(self, CacheKey, entry):
+        path = os.path.join(self.Directory, CacheKey + '.json')
+        # write to a temporary file first so a concurrent reader never sees a partial entry
+        with open(path + '.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.replace(path + '.tmp', path)
+        self.evict()
+
+    def evict(self):
+        paths = [os.path.join(self.Directory, name) for name in os.listdir(self.Directory) if name.endswith('.json')]
+        if len(paths) > self.MaxEntries:
+            paths.sort(key=os.path.getmtime)
+            for path in paths[:len(paths) - self.MaxEntries]:
+                self.remove(path)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+class TieredResultCache:
+    # looks in the in-memory cache of this container first, then in the persistent store
+    def __init__(self, memory, store):
+        self.memory = memory
+        self.store = store
+
+    def get(self, CacheKey):
+        QueryResultRows = self.memory.get(CacheKey)
+        if QueryResultRows is None:
+            entry = self.store.load(CacheKey)
+            if entry is None:
+                return None
+            QueryResultRows = entry['QueryResultRows']
+            self.memory.put(CacheKey, QueryResultRows, entry['Expires'] - time.time())
+        return QueryResultRows
+
+    def put(self, CacheKey, QueryResultRows, TTLSeconds):
+        self.memory.put(CacheKey, QueryResultRows, TTLSeconds)
+        self.store.save(CacheKey, { 'Expires': time.time() + TTLSeconds, 'QueryResultRows': QueryResultRows })
+
+MemoryCache = MemoryResultCache()
+PersistentCaches = {}
+
+class ResultPart:
+    # encodes rows as NDJSON, optionally gzipped, or as a Parquet or Arrow IPC file into a sink writer
+    def __init__(self, writer, ResultFormat, CoerceTypes=None):
+        self.writer = writer
+        self.ResultFormat = ResultFormat
+        self.Rows = 0
+        self.compressor = None
+        self.decoder = None
+        if ResultFormat.endswith('.gz'):
+            # wbits=31 produces a gzip container rather than a raw zlib stream
+            self.compressor = zlib.compressobj(wbits=31)
+        if ResultFormat in ArrowResultFormats:
+            # columnar files are written in one go, so the part is decoded into columns until it is closed
+            self.decoder = ResultDecoder(CoerceTypes)
+
+    def write_row(self, row):
+        self.Rows += 1
+        if self.decoder is not None:
+            self.decoder.add_page([row])
+            return
+        data = (json.dumps(row) + '\n').encode('utf-8')
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        if data:
+            self.writer.write(data)
+
+    def close(self):
+        if self.compressor is not None:
+            self.writer.write(self.compressor.flush())
+        if self.decoder is not None:
+            self.writer.write(encode_arrow(self.decoder, self.ResultFormat))
+        self.writer.close()
+        return { 'Key': self.writer.Key, 'Rows': self.Rows }
+
+    def abort(self):
+        self.writer.abort()
+
+class S3Sink:
+    # writes every part to s3://Bucket/Prefix/<Key> through a multipart upload
+    def __init__(self, Bucket, Prefix, s3=None):
+        self.Bucket = Bucket
+        self.Prefix = Prefix
+        self.s3 = s3 if s3 is not None else boto3.client('s3')
+
+    def open(self, Key):
+        # a prefix given without a trailing slash is still a directory, and the manifest reports the full object key
+        if self.Prefix and not self.Prefix.endswith('/'):
+            Key = '/' + Key
+        return S3PartWriter(self.s3, self.Bucket, self.Prefix + Key)
+
+class S3PartWriter:
+    def __init__(self, s3, Bucket, Key):
+        self.s3 = s3
+        self.Bucket = Bucket
+        self.Key = Key
+        self.UploadId = s3.create_multipart_upload(Bucket=Bucket, Key=Key)['UploadId']
+        self.Parts = []
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer.extend(data)
+        if len(self.buffer) >= MultipartChunkSize:
+            self.flush()
+
+    def flush(self):
+        PartNumber = len(self.Parts) + 1
+        response = self.s3.upload_part(Bucket=self.Bucket, Key=self.Key, UploadId=self.UploadId, PartNumber=PartNumber, Body=bytes(self.buffer))
+        self.Parts.append({ 'ETag': response['ETag'], 'PartNumber': PartNumber })
+        self.buffer = bytearray()
+
+    def close(self):
+        # the last chunk may be smaller than 5 MiB, and an upload needs at least one part
+        if self.buffer or not self.Parts:
+            self.flush()
+        self.s3.complete_multipart_upload(Bucket=self.Bucket, Key=self.Key, UploadId=self.UploadId, MultipartUpload={ 'Parts': self.Parts })
+
+    def abort(self):
+        self.s3.abort_multipart_upload(Bucket=self.Bucket, Key=self.Key, UploadId=self.UploadId)
+
+class LocalSink:
+    # writes every part under a local directory, for testing the streaming mode offline
+    def __init__(self, Directory):
+        self.Directory = Directory
+
+    def open(self, Key):
+        # the manifest reports the path of the file, directory included, as S3Sink reports the prefix
+        return LocalPartWriter(os.path.join(self.Directory, Key))
+
+class LocalPartWriter:
+    def __init__(self, Path):
+        self.Key = Path
+        self.Path = Path
+        os.makedirs(os.path.dirname(self.Path), exist_ok=True)
+        self.file = open(self.Path, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.Path)
+
@@ -0,0 +1,103 @@
+import importlib.util
+import json
+import os
+import sys
+import uuid
+
+# A local stand-in for the CloudTrail client used by cloudtraillake-query.py, so the start and collect
+# operations can be exercised without an event data store. It is not deployed with the Lambda function.
+#
+# Usage:
+#   python3 local_cloudtrail.py
+# runs the same start -> collect -> collect ... loop as the sample state machine against fake results.
+
+class FakeCloudTrailClient:
+    def __init__(self, rows, PollsUntilFinished=2, FinalStatus='FINISHED', ErrorMessage=None):
+        # rows is the QueryResultRows every query returns, PollsUntilFinished is how many
+        # describe_query calls report the query as QUEUED/RUNNING before it reaches FinalStatus
+        self.rows = rows
+        self.PollsUntilFinished = PollsUntilFinished
+        self.FinalStatus = FinalStatus
+        self.ErrorMessage = ErrorMessage
+        self.queries = {}
+        self.calls = []
+
+    def start_query(self, QueryStatement):
+        self.calls.append('start_query')
+        QueryId = str(uuid.uuid4())
+        self.queries[QueryId] = { 'QueryStatement': QueryStatement, 'Polls': 0 }
+        return { 'QueryId': QueryId }
+
+    def describe_query(self, EventDataStore, QueryId):
+        self.calls.append('describe_query')
+        query = self.get_query(QueryId)
+        query['Polls'] += 1
+        response = { 'QueryId': QueryId, 'QueryString': query['QueryStatement'], 'QueryStatus': self.get_status(query) }
+        if response['QueryStatus'] in ['FAILED', 'CANCELLED', 'TIMED_OUT'] and self.ErrorMessage:
+            response['ErrorMessage'] = self.ErrorMessage
+        return response
+
+    def get_query_results(self, EventDataStore, QueryId, MaxQueryResults=1000, NextToken=None):
+        self.calls.append('get_query_results')
+        query = self.get_query(QueryId)
+        status = self.get_status(query)
+        if status != 'FINISHED':
+            return { 'QueryStatus': status }
+
+        # the NextToken is the offset of the next row, tied to the query it was issued for
+        start = 0
+        if NextToken is not None:
+            TokenQueryId, offset = NextToken.split(':')
+            if TokenQueryId != QueryId:
+                raise ValueError('InvalidNextTokenException: NextToken does not belong to query {}'.format(QueryId))
+            start = int(offset)
+        end = start + MaxQueryResults
+        response = {
+            'QueryStatus': 'FINISHED',
+            'QueryStatistics': { 'ResultsCount': len(self.rows[start:end]), 'TotalResultsCount': len(self.rows) },
+            'QueryResultRows': self.rows[start:end]
+        }
+        if end < len(self.rows):
+            response['NextToken'] = '{}:{}'.format(QueryId, end)
+        return response
+
+    def get_query(self, QueryId):
+        if QueryId not in self.queries:
+            raise ValueError('QueryIdNotFoundException: {}'.format(QueryId))
+        return self.queries[QueryId]
+
+    def get_status(self, query):
+        if query['Polls'] < self.PollsUntilFinished:
+            return 'QUEUED' if query['Polls'] == 0 else 'RUNNING'
+        return self.FinalStatus
+
+def load_query_function(cloudtrail):
+    # import cloudtraillake-query.py (its name is not a valid module name) and swap in the given client
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cloudtraillake-query.py')
+    spec = importlib.util.spec_from_file_location('cloudtraillake_query', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.client = cloudtrail
+    return module
+
+def main():
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('EVENT_DATA_STORE', 'arn:aws:cloudtrail:us-east-1:123456789012:eventdatastore/local')
+    rows = [[{ 'eventID': str(uuid.uuid4()) }, { 'eventName': 'RequestServiceQuotaIncrease' }] for i in range(2500)]
+    cloudtrail = FakeCloudTrailClient(rows)
+    query = load_query_function(cloudtrail)
+
+    checkpoint = query.lambda_handler({ 'Operation': 'start', 'EventDataStore': 'FROM_ENV', 'QueryStatement': 'SELECT eventID, eventName FROM {m[EventDataStore]}' }, None)['body']
+    collected = 0
+    while not checkpoint['Complete']:
+        response = query.lambda_handler({ 'Operation': 'collect', 'EventDataStore': 'FROM_ENV', 'QueryId': checkpoint['QueryId'], 'NextToken': checkpoint['NextToken'], 'MaxRows': 1000 }, None)
+        if response['statusCode'] != 200:
+            print(response)
+            sys.exit(1)
+        checkpoint = response['body']
+        collected += len(checkpoint['QueryResultRows'])
+
+    print(json.dumps({ 'Collected': collected, 'Expected': len(rows), 'Calls': cloudtrail.calls }))
+
+if __name__ == "__main__":
+    main()
@@ -57,8 +57,18 @@ export class CloudtraillakeOrchestratorStack extends Stack {
     const statement = new iam.PolicyStatement();
     statement.addActions("cloudtrail:startQuery");
     statement.addActions("cloudtrail:getQueryResults");
+    statement.addActions("cloudtrail:describeQuery");
     statement.addResources(eventDataStoreArn);
     handler.addToRolePolicy(statement); 
+
+    // Optionally allow the Lambda function to stream query results into an S3 bucket
+    if ( Config.ResultSinkBucketName ) {
+      const sinkStatement = new iam.PolicyStatement();
+      sinkStatement.addActions("s3:PutObject");
+      sinkStatement.addActions("s3:AbortMultipartUpload");
+      sinkStatement.addResources(`arn:${this.partition}:s3:::${Config.ResultSinkBucketName}/*`);
+      handler.addToRolePolicy(sinkStatement);
+    }
     
     // Create a KMS key for encrypting the SNS topic
     const key = new kms.Key(this, "ServiceLimitCheckerKey");
@@ -95,6 +105,14 @@ export class CloudtraillakeOrchestratorStack extends Stack {
             }
           }
         },
+        "CloudtraillakeCollect_RequestServiceQuotaIncrease": {
+          "Parameters": {
+            "FunctionName": handler.functionArn,
+            "Payload": {
+              "EventDataStore": "FROM_ENV"
+            }
+          }
+        },
         "Each_RequestServiceQuotaIncrease": {
           "Iterator": {
             "States" : {
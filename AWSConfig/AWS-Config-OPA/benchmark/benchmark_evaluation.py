@@ -0,0 +1,171 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Measures the throughput of the OPA evaluation paths of opa_lambda.py, in
+# config items per second, for each of the policies in opa_policies/ on
+# synthetic config items:
+# * one evaluation per item (change notifications) with opa eval, the OPA
+#   server and the in-process Wasm evaluator
+# * one OPA query for all the items (scheduled re-evaluation) with opa eval
+#   and the OPA server
+# Needs the opa binary on the PATH (or in OPA_BIN), boto3 and wasmtime.
+#
+# Usage:
+#   python3 benchmark/benchmark_evaluation.py [items]
+
+os.environ.setdefault('LOGGING_LEVEL', 'WARNING')
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'lambda_sources', 'function'))
+
+import opa_lambda  # noqa: E402
+
+policies_dir = os.path.join(here, '..', 'opa_policies')
+opa_bin = os.environ.get('OPA_BIN', 'opa')
+
+
+def make_volume(i):
+    return {
+        'resourceId': 'vol-{:017x}'.format(i),
+        'resourceType': 'AWS::EC2::Volume',
+        'configuration': {
+            'encrypted': i % 3 == 0,
+            'size': 8,
+            'attachments': [{'instanceId': 'i-{:017x}'.format(i)}]
+            if i % 2 == 0 else []
+        }
+    }
+
+
+def make_eip(i):
+    return {
+        'resourceId': 'eipalloc-{:017x}'.format(i),
+        'resourceType': 'AWS::EC2::EIP',
+        'configuration': {
+            'associationId': 'eipassoc-{:017x}'.format(i)
+            if i % 2 == 0 else None
+        }
+    }
+
+
+def make_bucket(i):
+    rules = [{'applyServerSideEncryptionByDefault': {
+        'sseAlgorithm': ['AES256', 'aws:kms'][i % 2]}}] if i % 3 else []
+    return {
+        'resourceId': 'bucket-{}'.format(i),
+        'resourceType': 'AWS::S3::Bucket',
+        'configuration': {},
+        'supplementaryConfiguration': {
+            'ServerSideEncryptionConfiguration': {'rules': rules}
+        }
+    }
+
+
+# policy file, package, config item generator
+policies = [
+    ('opa_policy_s3_encryption.rego', 's3_bucket_encryption', make_bucket),
+    ('opa_policy_ebs_encryption.rego', 'ebs_encryption', make_volume),
+    ('opa_policy_ebs_attachment.rego', 'ebs_attachment', make_volume),
+    ('opa_policy_eip_attachment.rego', 'eip_attachment', make_eip),
+]
+
+
+def make_items(make_item, count):
+    items = [make_item(i) for i in range(count)]
+    for item in items:
+        item['configurationItemStatus'] = 'OK'
+        item['configurationItemCaptureTime'] = '2023-01-01T00:00:00.000Z'
+    return items
+
+
+def build_wasm(directory):
+    # The same bundle package_lambda.sh builds with OPA_BUILD_WASM=true
+    bundle_path = os.path.join(directory, 'opa_bundle.tar.gz')
+    command = [opa_bin, 'build', '-b', policies_dir, '-t', 'wasm',
+               '-o', bundle_path]
+    for _, package, _ in policies:
+        command += ['-e', '{}/compliant'.format(package)]
+    subprocess.run(command, check=True)
+    with open(bundle_path, 'rb') as f:
+        bundle = opa_lambda.OpaBundle(f.read())
+    return opa_lambda.OpaWasmPolicy(bundle.files['policy.wasm'])
+
+
+def per_item_cli(items, policy, package, wasm_policy):
+    results = []
+    for item in items:
+        input_file = opa_lambda.get_tempfile(opa_lambda.json.dumps(item))
+        try:
+            opa = opa_lambda.Opa(input_file.name, package, 'compliant')
+            results.append(opa.eval_compliance(policy.path))
+        finally:
+            input_file.close()
+    return results
+
+
+def per_item_server(items, policy, package, wasm_policy):
+    server = opa_lambda.get_opa_server()
+    opa = opa_lambda.Opa(None, package, 'compliant')
+    return [opa.eval_compliance_server(server, package, policy.body, item)
+            for item in items]
+
+
+def per_item_wasm(items, policy, package, wasm_policy):
+    entrypoint = '{}/compliant'.format(package)
+    return [wasm_policy.evaluate(entrypoint, item) for item in items]
+
+
+def batch_cli(items, policy, package, wasm_policy):
+    return opa_lambda.eval_batch_cli(items, policy, package, 'compliant')
+
+
+def batch_server(items, policy, package, wasm_policy):
+    return opa_lambda.eval_batch_server(items, policy, package, package,
+                                        'compliant')
+
+
+modes = [
+    ('per item, opa eval', per_item_cli),
+    ('per item, OPA server', per_item_server),
+    ('per item, in-process Wasm', per_item_wasm),
+    ('batch, opa eval', batch_cli),
+    ('batch, OPA server', batch_server),
+]
+
+
+def main(count):
+    with tempfile.TemporaryDirectory() as directory:
+        wasm_policy = build_wasm(directory)
+    print('{:,} items per policy'.format(count))
+    try:
+        run(count, wasm_policy)
+    finally:
+        if opa_lambda.opa_server is not None:
+            opa_lambda.opa_server.stop()
+
+
+def run(count, wasm_policy):
+    for file_name, package, make_item in policies:
+        path = os.path.join(policies_dir, file_name)
+        with open(path, 'rb') as f:
+            policy = opa_lambda.PolicyCacheEntry(f.read(), None, path)
+        items = make_items(make_item, count)
+        expected = None
+        print(package)
+        for name, evaluate in modes:
+            start = time.perf_counter()
+            results = evaluate(items, policy, package, wasm_policy)
+            elapsed = time.perf_counter() - start
+            if expected is None:
+                expected = results
+            elif results != expected:
+                print('{} returned different results'.format(name))
+                sys.exit(1)
+            print('  {:<28} {:>9.3f} s {:>12,.0f} items/s'.format(
+                name, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
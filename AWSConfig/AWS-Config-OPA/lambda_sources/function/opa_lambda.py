@@ -1,13 +1,42 @@
+# Imported first, so that its startup timings include the rest of the module
+import aws_clients
+import evaluation_submitter
 import os
 import json
-import boto3
 import logging
 from botocore.exceptions import ClientError
 import subprocess
 import tempfile
+import shlex
+import hashlib
+import http.client
+import time
+import tarfile
+import io
+import base64
+import hmac
+import ctypes
+import re
 
 
 logging_level = os.environ['LOGGING_LEVEL']
+# 'cli' runs `opa eval` for every evaluation, 'server' (opt-in) evaluates
+# through an `opa run --server` process kept for the life of the Lambda
+# container, 'wasm' evaluates the Wasm bundle of OPA_BUNDLE_KEY in-process
+opa_eval_mode = os.environ.get('OPA_EVAL_MODE', 'cli')
+opa_server_port = int(os.environ.get('OPA_SERVER_PORT', '8181'))
+opa_server_startup_timeout = float(
+    os.environ.get('OPA_SERVER_STARTUP_TIMEOUT', '5'))
+# Downloaded policies are reused for POLICY_CACHE_TTL seconds, then
+# revalidated against S3 with their ETag
+policy_cache_dir = os.environ.get('POLICY_CACHE_DIR', '/tmp/opa_policies')
+policy_cache_ttl = float(os.environ.get('POLICY_CACHE_TTL', '0'))
+# PEM public key (RS256) or shared secret (HS256) the bundles are signed with.
+# When set, bundles without a valid signature are rejected.
+opa_bundle_verification_key = os.environ.get('OPA_BUNDLE_VERIFICATION_KEY',
+                                             '')
+# Longest Annotation accepted by PutEvaluations
+annotation_max_length = 256
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging_level)
@@ -23,8 +52,14 @@ class Opa(object):
     def __init__(self, input_file_name, policy_package_name, rule_to_eval) -> None:
         try:
             self.input_file_path = input_file_name
-            self.query = '"data.{}.{}"'.format(policy_package_name,
-                                               rule_to_eval)
+            self.rule_path = 'data.{}.{}'.format(policy_package_name,
+                                                 rule_to_eval)
+            self.query = '"{}"'.format(self.rule_path)
+            # Evaluates the rule once per element of input.items, in a
+            # single query, keyed by the position of the element
+            self.batch_query = 'results := {{i: r | item := input.items[i]; ' \
+                               'r := {} with input as item}}'.format(
+                                   self.rule_path)
         except Exception as e:
             logger.error(e)
             raise
@@ -53,10 +88,177 @@ class Opa(object):
             raise
 
 
+    def eval_compliance_batch(self, policy_file_path, count) -> list:
+        try:
+            command = 'opa eval -d {} -i {} {}'.format(
+                policy_file_path, self.input_file_path,
+                shlex.quote(self.batch_query))
+            logger.debug('OPA eval command: {}'.format(command))
+            output = run_process(command)
+            results = {}
+            for result in output.get('result', []):
+                results = result['bindings']['results']
+            logger.info('OPA batch compliance evaluated successfully')
+            return [results.get(str(i), False) for i in range(count)]
+        except Exception as e:
+            logger.error(e)
+            raise
+
+    def eval_compliance_server(self, server, policy_id, policy,
+                               config_item) -> bool:
+        try:
+            server.put_policy(policy_id, policy)
+            compliance = server.eval(self.rule_path, config_item)
+        except OpaServerError as e:
+            logger.error(e)
+            raise
+        else:
+            logger.debug('OPA output compliance: {}'.format(compliance))
+            logger.info('OPA compliance evaluated successfully by OPA server')
+            return compliance
+
+    def eval_compliance_batch_server(self, server, policy_id, policy,
+                                     config_items) -> list:
+        try:
+            server.put_policy(policy_id, policy)
+            results = server.query(self.batch_query,
+                                   {'items': config_items}).get('results', {})
+        except OpaServerError as e:
+            logger.error(e)
+            raise
+        else:
+            logger.info('OPA batch compliance evaluated successfully by OPA '
+                        'server')
+            return [results.get(str(i), False)
+                    for i in range(len(config_items))]
+
+
+class OpaServerError(Exception):
+    pass
+
+
+class OpaServer(object):
+    def __init__(self, port) -> None:
+        self.address = '127.0.0.1:{}'.format(port)
+        self.process = None
+        self.connection = None
+        self.policy_hashes = {}
+
+    def start(self) -> None:
+        try:
+            self.process = subprocess.Popen(
+                ['opa', 'run', '--server', '--addr', self.address,
+                 '--log-level', 'error'],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+        except OSError as e:
+            raise OpaServerError('OPA server failed to start: {}'.format(e))
+        deadline = time.monotonic() + opa_server_startup_timeout
+        while time.monotonic() < deadline:
+            if not self.is_alive():
+                raise OpaServerError('OPA server exited with code {}'.format(
+                    self.process.returncode))
+            try:
+                status, _ = self.request('GET', '/health')
+            except OpaServerError:
+                status = None
+            if status == 200:
+                logger.info('OPA server listening on {}'.format(self.address))
+                return
+            time.sleep(0.05)
+        self.stop()
+        raise OpaServerError('OPA server not ready after {} seconds'.format(
+            opa_server_startup_timeout))
+
+    def stop(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.process is not None and self.is_alive():
+            self.process.kill()
+            self.process.wait()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def request(self, method, path, body=None, headers=None):
+        # The connection is kept open across evaluations and invocations.
+        # It is re-opened once if the server closed it in the meantime.
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.address,
+                                                             timeout=10)
+            try:
+                self.connection.request(method, path, body, headers or {})
+                response = self.connection.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, OSError) as e:
+                self.connection.close()
+                self.connection = None
+                if attempt == 1 or not self.is_alive():
+                    raise OpaServerError(
+                        'OPA server request failed: {}'.format(e))
+
+    def put_policy(self, policy_id, policy) -> None:
+        # Only upload the policy when it changed, so it is compiled once.
+        policy_hash = hashlib.sha256(policy.encode('utf-8')).hexdigest()
+        if self.policy_hashes.get(policy_id) == policy_hash:
+            return
+        status, body = self.request(
+            'PUT', '/v1/policies/{}'.format(policy_id), policy.encode('utf-8'),
+            {'Content-Type': 'text/plain'})
+        if status != 200:
+            raise OpaServerError('OPA server rejected policy {}: {}'.format(
+                policy_id, body.decode('utf-8')))
+        self.policy_hashes[policy_id] = policy_hash
+        logger.info('OPA policy {} loaded into OPA server'.format(policy_id))
+
+    def eval(self, query, input_document):
+        # data.<package>.<rule> is served under /v1/data/<package>/<rule>
+        path = '/v1/' + query.replace('.', '/')
+        status, body = self.request(
+            'POST', path, json.dumps({'input': input_document}).encode('utf-8'),
+            {'Content-Type': 'application/json'})
+        if status != 200:
+            raise OpaServerError('OPA server evaluation failed: {}'.format(
+                body.decode('utf-8')))
+        return json.loads(body).get('result')
+
+    def query(self, query, input_document) -> dict:
+        # Ad-hoc query, returns the bindings of the first result
+        status, body = self.request(
+            'POST', '/v1/query',
+            json.dumps({'query': query,
+                        'input': input_document}).encode('utf-8'),
+            {'Content-Type': 'application/json'})
+        if status != 200:
+            raise OpaServerError('OPA server query failed: {}'.format(
+                body.decode('utf-8')))
+        result = json.loads(body).get('result', [])
+        return result[0] if result else {}
+
+
+opa_server = None
+
+
+def get_opa_server() -> OpaServer:
+    # Started on the first evaluation and reused while the container is warm.
+    global opa_server
+    if opa_server is None or not opa_server.is_alive():
+        if opa_server is not None:
+            logger.warning('OPA server is not running anymore, restarting it')
+            opa_server.stop()
+        opa_server = OpaServer(opa_server_port)
+        opa_server.start()
+    return opa_server
+
+
 class Config(object):
     def __init__(self, event) -> None:
         self.config_event = json.loads(event['invokingEvent'])
-        self.config_item = self.config_event['configurationItem']
+        # Scheduled notifications do not carry a configuration item
+        self.config_item = self.config_event.get('configurationItem')
         logger.debug('Config Item: {}'.format(self.config_item))
         self.result_token = event['resultToken']
         logger.debug('Result token: {}'.format(self.result_token))
@@ -64,59 +266,631 @@ class Config(object):
         logger.debug('Config rule parameters: {}'.format(self.input_parameters))
         self.message_type = self.config_event['messageType']
         logger.debug('Config message type: {}'.format(self.message_type))
-        self.resource_id = self.config_item['resourceId']
-        logger.debug('AWS resource id: {}'.format(self.resource_id))
-        self.resource_status = self.config_item['configurationItemStatus']
-        logger.debug('AWS resource status: {}'.format(self.resource_status))
-        self.client = boto3.client('config')
+        if self.config_item is not None:
+            self.resource_id = self.config_item['resourceId']
+            logger.debug('AWS resource id: {}'.format(self.resource_id))
+            self.resource_status = self.config_item['configurationItemStatus']
+            logger.debug('AWS resource status: {}'.format(
+                self.resource_status))
+        self.client = aws_clients.client('config')
 
     def set_compliance(self, compliance) -> None:
-        evaluation = {
-            'Annotation': 'Setting compliance based on OPA policy evaluation.\n',
-            'ComplianceResourceType': self.config_item['resourceType'],
-            'ComplianceResourceId': self.config_item['resourceId'],
-            'OrderingTimestamp': self.config_item['configurationItemCaptureTime']
-        }
-        if self.resource_status == 'ResourceDeleted':
-            evaluation['ComplianceType'] = 'NOT_APPLICABLE'
-            msg = 'Resource {} is deleted, setting Compliance Status to ' \
-                  'NOT_APPLICABLE.'.format(self.resource_id)
-            logger.info(msg)
-            evaluation['Annotation'] += msg
-        elif compliance:
-            evaluation['ComplianceType'] = 'COMPLIANT'
-            msg = 'Resource {} is compliant'.format(self.resource_id)
-            logger.info(msg)
-            evaluation['Annotation'] += msg
-        else:
-            evaluation['ComplianceType'] = 'NON_COMPLIANT'
-            msg = 'Resource {} is NOT compliant'.format(self.resource_id)
-            logger.info(msg)
-            evaluation['Annotation'] += msg
+        evaluation = get_evaluation(
+            self.config_item, compliance,
+            self.config_item['configurationItemCaptureTime'])
+        logger.info(evaluation['Annotation'].splitlines()[-1])
+        self.put_evaluations([evaluation])
+
+    def set_compliances(self, config_items, compliances,
+                        non_compliant_policies=None) -> None:
+        evaluations = []
+        for i, config_item in enumerate(config_items):
+            if self.message_type == 'ScheduledNotification':
+                ordering_timestamp = self.config_event[
+                    'notificationCreationTime']
+            else:
+                ordering_timestamp = config_item[
+                    'configurationItemCaptureTime']
+            evaluations.append(get_evaluation(
+                config_item, compliances[i], ordering_timestamp,
+                non_compliant_policies[i] if non_compliant_policies else ()))
+        summary = {}
+        for evaluation in evaluations:
+            compliance_type = evaluation['ComplianceType']
+            summary[compliance_type] = summary.get(compliance_type, 0) + 1
+        logger.info('Compliance of {} resources: {}'.format(len(evaluations),
+                                                            summary))
+        self.put_evaluations(evaluations)
+
+    def put_evaluations(self, evaluations) -> None:
+        # Chunks of 100 evaluations, sent in parallel, throttling retried
+        submitter = evaluation_submitter.EvaluationSubmitter(
+            self.client, self.result_token)
         try:
-            self.client.put_evaluations(Evaluations=[evaluation],
-                                        ResultToken=self.result_token)
+            submitter.add_all(evaluations)
+            submitter.flush()
         except ClientError as e:
             logger.error(
-                'Config service PUT Evaluation failed with error: {}'.format(
-                    e.response['Error']['Message']
-                )
+                'Config service PUT Evaluation failed with error: '
+                '{}'.format(e.response['Error']['Message'])
             )
+        for failed in submitter.failed_evaluations:
+            logger.error('Config service rejected evaluation of '
+                         '{}'.format(failed['ComplianceResourceId']))
+        logger.info('PutEvaluations: {}'.format(submitter.get_metrics()))
+
+    def select_config_items(self, resource_types):
+        # Current configuration items of the given resource types, in the
+        # shape of the configurationItem of a change notification
+        expression = 'SELECT resourceId, resourceType, configuration, ' \
+                     'supplementaryConfiguration, ' \
+                     'configurationItemCaptureTime, configurationItemStatus ' \
+                     'WHERE resourceType IN ({})'.format(', '.join(
+                         "'{}'".format(t) for t in resource_types))
+        kwargs = {'Expression': expression, 'Limit': 100}
+        while True:
+            try:
+                response = self.client.select_resource_config(**kwargs)
+            except ClientError as e:
+                logger.error(
+                    'Config service select resource config failed with '
+                    'error: {}'.format(e.response['Error']['Message']))
+                raise
+            for result in response['Results']:
+                yield json.loads(result)
+            if not response.get('NextToken'):
+                return
+            kwargs['NextToken'] = response['NextToken']
+
+
+# Compliance of the items eval_policy_set finds no policy for, evaluated as
+# NOT_APPLICABLE. An undefined rule result is False, NON_COMPLIANT.
+no_applicable_policy = object()
+
+
+def get_evaluation(config_item, compliance, ordering_timestamp,
+                   non_compliant_policies=()) -> dict:
+    resource_id = config_item['resourceId']
+    evaluation = {
+        'Annotation': 'Setting compliance based on OPA policy evaluation.\n',
+        'ComplianceResourceType': config_item['resourceType'],
+        'ComplianceResourceId': resource_id,
+        'OrderingTimestamp': ordering_timestamp
+    }
+    if config_item['configurationItemStatus'] == 'ResourceDeleted':
+        evaluation['ComplianceType'] = 'NOT_APPLICABLE'
+        evaluation['Annotation'] += 'Resource {} is deleted, setting ' \
+                                    'Compliance Status to NOT_APPLICABLE.' \
+                                    ''.format(resource_id)
+    elif compliance is no_applicable_policy:
+        evaluation['ComplianceType'] = 'NOT_APPLICABLE'
+        evaluation['Annotation'] += 'No policy applies to resource type ' \
+                                    '{}'.format(config_item['resourceType'])
+    elif compliance:
+        evaluation['ComplianceType'] = 'COMPLIANT'
+        evaluation['Annotation'] += 'Resource {} is compliant'.format(
+            resource_id)
+    else:
+        evaluation['ComplianceType'] = 'NON_COMPLIANT'
+        evaluation['Annotation'] += 'Resource {} is NOT compliant'.format(
+            resource_id)
+        if non_compliant_policies:
+            evaluation['Annotation'] += ' with {}'.format(
+                ', '.join(non_compliant_policies))
+    if len(evaluation['Annotation']) > annotation_max_length:
+        evaluation['Annotation'] = \
+            evaluation['Annotation'][:annotation_max_length - 3] + '...'
+    return evaluation
 
 
-def download_s3_obj(bucket, prefix, object_key) -> str:
+def download_s3_obj(bucket, prefix, object_key, etag=None):
+    # Returns (data, etag), or None when etag is given and the object has not
+    # changed since (S3 answers the conditional GET with 304 Not Modified).
     try:
-        s3 = boto3.resource('s3')
+        s3_client = aws_clients.client('s3')
         object_path = ''.join([prefix, object_key])
-        obj = s3.Object(bucket, object_path)
-        obj_body = obj.get()['Body'].read().decode('utf-8')
+        kwargs = {'Bucket': bucket, 'Key': object_path}
+        if etag is not None:
+            kwargs['IfNoneMatch'] = etag
+        obj = s3_client.get_object(**kwargs)
+        obj_body = obj['Body'].read()
     except ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified'):
+            return None
         logger.error('S3 download file failed with: {}'.format(
             e.response['Error']['Message']))
+        raise
     except Exception as e:
         logger.error(e)
+        raise
     else:
-        return obj_body
+        return obj_body, obj['ETag']
+
+
+class PolicyCacheEntry(object):
+    def __init__(self, data, etag, path) -> None:
+        self.data = data
+        self.etag = etag
+        self.path = path
+        self.validated_at = time.monotonic()
+        # In-process evaluator of a Wasm bundle, created on first use
+        self.wasm_policy = None
+
+    @property
+    def body(self) -> str:
+        return self.data.decode('utf-8')
+
+
+class PolicyCache(object):
+    # Rego policies downloaded from S3, kept in memory and under /tmp while
+    # the Lambda container is warm. An entry younger than ttl seconds is used
+    # as is. An older entry is revalidated with a conditional GET on its ETag
+    # and only downloaded and written to disk again when it changed in S3.
+    def __init__(self, directory, ttl) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self.entries = {}
+        self.listings = {}
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    def get(self, bucket, prefix, object_key) -> PolicyCacheEntry:
+        cache_key = (bucket, ''.join([prefix, object_key]))
+        entry = self.entries.get(cache_key)
+        if entry is not None and not os.path.exists(entry.path):
+            entry = None
+        if entry is not None:
+            if time.monotonic() - entry.validated_at < self.ttl:
+                self.hits += 1
+                return entry
+            try:
+                downloaded = download_s3_obj(bucket, prefix, object_key,
+                                             entry.etag)
+            except ClientError:
+                logger.warning('Using cached policy {} after failed '
+                               'revalidation'.format(object_key))
+                self.hits += 1
+                return entry
+            if downloaded is None:
+                entry.validated_at = time.monotonic()
+                self.revalidations += 1
+                logger.debug('Policy {} not modified'.format(object_key))
+                return entry
+        else:
+            downloaded = download_s3_obj(bucket, prefix, object_key)
+        data, etag = downloaded
+        entry = PolicyCacheEntry(data, etag, self.write(cache_key, data))
+        self.entries[cache_key] = entry
+        self.misses += 1
+        logger.info('Policy {} downloaded'.format(object_key))
+        return entry
+
+    def list(self, bucket, prefix) -> list:
+        # Keys of the rego policies under prefix, listed again after ttl
+        listed_at, keys = self.listings.get((bucket, prefix), (None, None))
+        if listed_at is not None and time.monotonic() - listed_at < self.ttl:
+            return keys
+        keys = []
+        try:
+            paginator = aws_clients.client('s3').get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    if obj['Key'].endswith('.rego'):
+                        keys.append(obj['Key'][len(prefix):])
+        except ClientError as e:
+            logger.error('S3 list policies failed with: {}'.format(
+                e.response['Error']['Message']))
+            raise
+        self.listings[(bucket, prefix)] = (time.monotonic(), keys)
+        return keys
+
+    def write(self, cache_key, data) -> str:
+        # One file per bucket/key, replaced atomically when the policy changes
+        os.makedirs(self.directory, exist_ok=True)
+        name = hashlib.sha256('/'.join(cache_key).encode('utf-8')).hexdigest()
+        path = os.path.join(self.directory,
+                            name + os.path.splitext(cache_key[1])[1])
+        with tempfile.NamedTemporaryFile(mode='wb', dir=self.directory,
+                                         delete=False) as tf:
+            tf.write(data)
+        os.replace(tf.name, path)
+        return path
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'revalidations': self.revalidations,
+                'misses': self.misses}
+
+
+policy_cache = PolicyCache(policy_cache_dir, policy_cache_ttl)
+
+
+class OpaBundleError(Exception):
+    pass
+
+
+class OpaBundle(object):
+    # A bundle built by `opa build`, read from its .tar.gz archive. When a
+    # verification key is given, .signatures.json must hold a JWT signed with
+    # it that lists the SHA-256 of every file of the bundle.
+    def __init__(self, data, verification_key='') -> None:
+        self.files = {}
+        try:
+            with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tf:
+                for member in tf.getmembers():
+                    if member.isfile():
+                        name = member.name
+                        if name.startswith('./'):
+                            name = name[2:]
+                        name = name.lstrip('/')
+                        self.files[name] = tf.extractfile(member).read()
+        except (tarfile.TarError, OSError) as e:
+            raise OpaBundleError('Invalid OPA bundle: {}'.format(e))
+        if verification_key:
+            self.verify(verification_key)
+        self.manifest = json.loads(self.files.get('.manifest', b'{}'))
+
+    def verify(self, verification_key) -> None:
+        if '.signatures.json' not in self.files:
+            raise OpaBundleError('OPA bundle is not signed')
+        signatures = json.loads(self.files['.signatures.json'])['signatures']
+        if len(signatures) != 1:
+            raise OpaBundleError('OPA bundle must have exactly one signature')
+        header, payload, signature = signatures[0].split('.')
+        algorithm = json.loads(b64url_decode(header)).get('alg')
+        signed = '{}.{}'.format(header, payload).encode('ascii')
+        if algorithm == 'HS256':
+            expected = hmac.new(verification_key.encode('utf-8'), signed,
+                                hashlib.sha256).digest()
+            valid = hmac.compare_digest(expected, b64url_decode(signature))
+        elif algorithm == 'RS256':
+            valid = verify_rs256(verification_key, signed,
+                                 b64url_decode(signature))
+        else:
+            raise OpaBundleError('Unsupported OPA bundle signing '
+                                 'algorithm: {}'.format(algorithm))
+        if not valid:
+            raise OpaBundleError('Invalid OPA bundle signature')
+        hashes = {f['name'].lstrip('/'): f['hash']
+                  for f in json.loads(b64url_decode(payload))['files']}
+        names = set(self.files) - {'.signatures.json'}
+        if set(hashes) != names:
+            raise OpaBundleError('OPA bundle files do not match its '
+                                 'signature')
+        for name in names:
+            if hash_bundle_file(name, self.files[name]) != hashes[name]:
+                raise OpaBundleError('OPA bundle file {} does not match its '
+                                     'signature'.format(name))
+        logger.info('OPA bundle signature verified')
+
+
+def b64url_decode(value) -> bytes:
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def hash_bundle_file(name, content) -> str:
+    # OPA hashes JSON files in their compact form with sorted keys
+    if name.endswith('.json') or name.endswith('.manifest'):
+        content = json.dumps(json.loads(content), sort_keys=True,
+                             separators=(',', ':'),
+                             ensure_ascii=False).encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+def verify_rs256(public_key_pem, signed, signature) -> bool:
+    try:
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import padding
+    except ImportError:
+        raise OpaBundleError('cryptography is required to verify RS256 '
+                             'signed OPA bundles')
+    key = serialization.load_pem_public_key(public_key_pem.encode('utf-8'))
+    try:
+        key.verify(signature, signed, padding.PKCS1v15(), hashes.SHA256())
+    except InvalidSignature:
+        return False
+    return True
+
+
+class OpaWasmPolicy(object):
+    # The policy.wasm of a bundle built with `opa build -t wasm`, compiled and
+    # instantiated once, then evaluated in-process through the OPA Wasm ABI:
+    # the input is copied into the module memory and opa_eval returns the
+    # result set as a JSON string, with no process, temp file or HTTP call.
+    def __init__(self, wasm) -> None:
+        try:
+            import wasmtime
+        except ImportError:
+            raise OpaBundleError('wasmtime is required to evaluate Wasm '
+                                 'OPA bundles')
+        self.store = wasmtime.Store()
+        module = wasmtime.Module(self.store.engine, wasm)
+        self.memory = wasmtime.Memory(
+            self.store, wasmtime.MemoryType(wasmtime.Limits(2, None)))
+        i32 = wasmtime.ValType.i32()
+        linker = wasmtime.Linker(self.store.engine)
+        linker.define(self.store, 'env', 'memory', self.memory)
+        linker.define_func('env', 'opa_abort', wasmtime.FuncType([i32], []),
+                           self.abort)
+        linker.define_func('env', 'opa_println',
+                           wasmtime.FuncType([i32], []), self.println)
+        for arity in range(5):
+            linker.define_func(
+                'env', 'opa_builtin{}'.format(arity),
+                wasmtime.FuncType([i32] * (arity + 2), [i32]),
+                self.call_builtin)
+        self.exports = linker.instantiate(self.store, module).exports(
+            self.store)
+        if self.exports['opa_wasm_abi_version'].value(self.store) != 1 or \
+                self.exports['opa_wasm_abi_minor_version'].value(
+                    self.store) < 2:
+            raise OpaBundleError('OPA Wasm ABI 1.2 or later is required')
+        self.entrypoints = self.load_json(self.call('entrypoints'))
+        self.builtins = {}
+        for name, builtin_id in self.load_json(self.call('builtins')).items():
+            if name not in wasm_builtins:
+                raise OpaBundleError('OPA builtin {} is not available for '
+                                     'Wasm evaluation'.format(name))
+            self.builtins[builtin_id] = wasm_builtins[name]
+        self.data = self.dump_json({})
+        self.heap = self.call('opa_heap_ptr_get')
+
+    def evaluate(self, entrypoint, input_document):
+        if entrypoint not in self.entrypoints:
+            raise OpaBundleError('OPA bundle has no entrypoint {}'.format(
+                entrypoint))
+        value = json.dumps(input_document).encode('utf-8')
+        self.reserve(self.heap + len(value))
+        self.memory.write(self.store, value, self.heap)
+        # Everything opa_eval allocates is above the input, and discarded by
+        # the next evaluation, which starts again from the same heap pointer
+        result = self.read_string(self.call(
+            'opa_eval', 0, self.entrypoints[entrypoint], self.data,
+            self.heap, len(value), self.heap + len(value), 0))
+        results = json.loads(result)
+        return results[0]['result'] if results else None
+
+    def call(self, name, *args):
+        return self.exports[name](self.store, *args)
+
+    def reserve(self, size) -> None:
+        missing = size - self.memory.data_len(self.store)
+        if missing > 0:
+            self.memory.grow(self.store, (missing + 65535) // 65536)
+
+    def read_string(self, address) -> bytes:
+        base = ctypes.addressof(self.memory.data_ptr(self.store).contents)
+        return ctypes.string_at(base + address)
+
+    def load_json(self, address):
+        return json.loads(self.read_string(self.call('opa_json_dump',
+                                                     address)))
+
+    def dump_json(self, value) -> int:
+        data = json.dumps(value).encode('utf-8')
+        address = self.call('opa_malloc', len(data))
+        self.memory.write(self.store, data, address)
+        parsed = self.call('opa_json_parse', address, len(data))
+        if parsed == 0:
+            raise OpaBundleError('OPA Wasm failed to parse a value')
+        return parsed
+
+    def call_builtin(self, builtin_id, context, *args):
+        return self.dump_json(self.builtins[builtin_id](
+            *[self.load_json(arg) for arg in args]))
+
+    def abort(self, address) -> None:
+        raise OpaBundleError('OPA Wasm aborted: {}'.format(
+            self.read_string(address).decode('utf-8')))
+
+    def println(self, address) -> None:
+        logger.debug(self.read_string(address).decode('utf-8'))
+
+
+# Builtins the policies may call that OPA does not compile into Wasm
+wasm_builtins = {
+    'any': lambda values: any(v is True for v in values),
+    'all': lambda values: all(v is True for v in values),
+}
+
+
+def get_wasm_policy(config) -> OpaWasmPolicy:
+    # The evaluator is kept on the cache entry of the bundle, so it is only
+    # created again when a new version of the bundle is downloaded
+    bundle_key = config.input_parameters.get('OPA_BUNDLE_KEY')
+    if not bundle_key:
+        raise OpaBundleError('OPA_BUNDLE_KEY rule parameter is not set')
+    try:
+        entry = policy_cache.get(
+            config.input_parameters['ASSETS_BUCKET'],
+            config.input_parameters['REGO_POLICIES_PREFIX'],
+            bundle_key
+        )
+    except ClientError as e:
+        raise OpaBundleError('OPA bundle download failed: {}'.format(e))
+    if entry.wasm_policy is None:
+        bundle = OpaBundle(entry.data, opa_bundle_verification_key)
+        if 'policy.wasm' not in bundle.files:
+            raise OpaBundleError('OPA bundle {} is not compiled to '
+                                 'Wasm'.format(bundle_key))
+        start = time.monotonic()
+        entry.wasm_policy = OpaWasmPolicy(bundle.files['policy.wasm'])
+        logger.info('OPA Wasm policy loaded in {:.3f}s'.format(
+            time.monotonic() - start))
+    return entry.wasm_policy
+
+
+class PolicySet(object):
+    # Several policies evaluated together, with an index from resource type
+    # to the policies that apply to it. A policy applies to the resource
+    # types it compares input.resourceType with, or to every resource type
+    # when it does not compare it.
+    resource_type_pattern = re.compile(
+        r'input\.resourceType\s*==\s*"([^"]+)"')
+    package_pattern = re.compile(r'^package\s+([\w.]+)', re.MULTILINE)
+
+    def __init__(self, policies) -> None:
+        self.policies = policies
+        self.packages = {}
+        self.index = {}
+        self.any_resource_type = []
+        for key, policy in policies.items():
+            match = self.package_pattern.search(policy.body)
+            if match is None:
+                raise ValueError('Policy {} has no package'.format(key))
+            self.packages[key] = match.group(1)
+            resource_types = set(
+                self.resource_type_pattern.findall(policy.body))
+            if not resource_types:
+                self.any_resource_type.append(key)
+            for resource_type in resource_types:
+                self.index.setdefault(resource_type, []).append(key)
+        logger.info('Policy set index: {}'.format(
+            dict(self.index, **{'*': self.any_resource_type})))
+
+    def policies_for(self, resource_type) -> list:
+        return sorted(self.index.get(resource_type, []) +
+                      self.any_resource_type)
+
+    def batch_query(self, keys, rule_to_eval) -> str:
+        # Every policy of keys for every element of input.items, in a single
+        # query, as {position: {policy key: compliance}}
+        rules = ', '.join('{}: data.{}.{}'.format(
+            json.dumps(key), self.packages[key], rule_to_eval) for key in keys)
+        return 'results := {{i: r | item := input.items[i]; ' \
+               'r := {{{}}} with input as item}}'.format(rules)
+
+
+policy_sets = {}
+
+
+def get_policy_set(config) -> PolicySet:
+    # REGO_POLICY_KEYS is a comma delimited list of policy keys, or * for
+    # every policy under REGO_POLICIES_PREFIX. The index is only built again
+    # when one of the policies changed.
+    bucket = config.input_parameters['ASSETS_BUCKET']
+    prefix = config.input_parameters['REGO_POLICIES_PREFIX']
+    keys_parameter = config.input_parameters['REGO_POLICY_KEYS'].strip()
+    keys = keys_parameter
+    if keys == '*':
+        keys = policy_cache.list(bucket, prefix)
+    else:
+        keys = [key.strip() for key in keys.split(',') if key.strip()]
+    policies = {key: policy_cache.get(bucket, prefix, key) for key in keys}
+    logger.info('Policy cache: {}'.format(policy_cache.stats()))
+    version = tuple(sorted((key, policy.etag)
+                           for key, policy in policies.items()))
+    cached = policy_sets.get((bucket, prefix, keys_parameter))
+    if cached is None or cached[0] != version:
+        cached = (version, PolicySet(policies))
+        policy_sets[(bucket, prefix, keys_parameter)] = cached
+    return cached[1]
+
+
+def eval_policy_set_server(policy_set, keys, config_items,
+                           rule_to_eval) -> list:
+    global opa_server
+    try:
+        server = get_opa_server()
+        for key in keys:
+            server.put_policy(key, policy_set.policies[key].body)
+        results = server.query(policy_set.batch_query(keys, rule_to_eval),
+                               {'items': config_items}).get('results', {})
+    except OpaServerError as e:
+        logger.warning(
+            'OPA server evaluation failed, falling back to opa eval: '
+            '{}'.format(e))
+        if opa_server is not None:
+            opa_server.stop()
+            opa_server = None
+        raise
+    return [results.get(str(i), {}) for i in range(len(config_items))]
+
+
+def eval_policy_set_cli(policy_set, keys, config_items, rule_to_eval) -> list:
+    input_file = get_tempfile(json.dumps({'items': config_items}))
+    try:
+        command = 'opa eval {} -i {} {}'.format(
+            ' '.join('-d {}'.format(policy_set.policies[key].path)
+                     for key in keys),
+            input_file.name,
+            shlex.quote(policy_set.batch_query(keys, rule_to_eval)))
+        logger.debug('OPA eval command: {}'.format(command))
+        output = run_process(command)
+        results = {}
+        for result in output.get('result', []):
+            results = result['bindings']['results']
+        return [results.get(str(i), {}) for i in range(len(config_items))]
+    finally:
+        input_file.close()
+
+
+def eval_policy_set_wasm(config, policy_set, keys, config_items,
+                         rule_to_eval) -> list:
+    try:
+        wasm_policy = get_wasm_policy(config)
+        entrypoints = {key: '{}/{}'.format(
+            policy_set.packages[key].replace('.', '/'), rule_to_eval)
+            for key in keys}
+        return [{key: undefined_as_false(
+                     wasm_policy.evaluate(entrypoint, config_item))
+                 for key, entrypoint in entrypoints.items()}
+                for config_item in config_items]
+    except Exception as e:
+        logger.warning(
+            'OPA Wasm evaluation failed, falling back to opa eval: '
+            '{}'.format(e))
+        raise OpaBundleError(e)
+
+
+def eval_policy_set(config, config_items) -> tuple:
+    # Every policy of the set that applies to the resource type of each item,
+    # with one OPA query per resource type. Returns the combined compliance
+    # of each item (no_applicable_policy when no policy applies) and its non
+    # compliant policies.
+    policy_set = get_policy_set(config)
+    rule_to_eval = config.input_parameters['OPA_POLICY_RULE_TO_EVAL']
+    start = time.monotonic()
+    groups = {}
+    for i, config_item in enumerate(config_items):
+        groups.setdefault(config_item['resourceType'], []).append(i)
+    results = [{} for _ in config_items]
+    for resource_type, positions in groups.items():
+        keys = policy_set.policies_for(resource_type)
+        if not keys:
+            continue
+        items = [config_items[i] for i in positions]
+        group_results = None
+        if opa_eval_mode == 'wasm':
+            try:
+                group_results = eval_policy_set_wasm(
+                    config, policy_set, keys, items, rule_to_eval)
+            except OpaBundleError:
+                pass
+        if group_results is None and opa_eval_mode == 'server':
+            try:
+                group_results = eval_policy_set_server(
+                    policy_set, keys, items, rule_to_eval)
+            except OpaServerError:
+                pass
+        if group_results is None:
+            group_results = eval_policy_set_cli(policy_set, keys, items,
+                                                rule_to_eval)
+        for i, result in zip(positions, group_results):
+            results[i] = {key: result.get(key, False) for key in keys}
+    elapsed = time.monotonic() - start
+    logger.info('Evaluated {} config items against {} policies in {:.3f}s '
+                '({:.0f} items/s)'.format(
+                    len(config_items), len(policy_set.policies), elapsed,
+                    len(config_items) / max(elapsed, 1e-6)))
+    compliances = [all(result.values()) if result else no_applicable_policy
+                   for result in results]
+    non_compliant_policies = [
+        sorted(key for key, compliant in result.items() if not compliant)
+        for result in results
+    ]
+    return compliances, non_compliant_policies
 
 
 def run_process(command):
@@ -151,38 +925,190 @@ def get_tempfile(content):
         return tf
 
 
-def lambda_handler(event, context):
+def eval_compliance_server(config, policy, policy_package_name,
+                           rule_to_eval):
+    global opa_server
     try:
-        logger.debug('Lambda event: {}'.format(event))
-        config = Config(event)
-        logger.info('Config input processed')
+        opa = Opa(None, policy_package_name, rule_to_eval)
+        return opa.eval_compliance_server(
+            get_opa_server(),
+            config.input_parameters['REGO_POLICY_KEY'],
+            policy.body,
+            config.config_item
+        )
+    except OpaServerError as e:
+        logger.warning(
+            'OPA server evaluation failed, falling back to opa eval: '
+            '{}'.format(e))
+        if opa_server is not None:
+            opa_server.stop()
+            opa_server = None
+        raise
+
 
+def eval_compliance_cli(config, policy, policy_package_name, rule_to_eval):
+    try:
         input_file = get_tempfile(json.dumps(config.config_item))
         logger.info('OPA input file created')
         logger.debug('Name of the input file is: {}'.format(input_file.name))
+        logger.debug('Name of the policy file is: {}'.format(policy.path))
 
-        policy_file = get_tempfile(download_s3_obj(
-            config.input_parameters['ASSETS_BUCKET'],
-            config.input_parameters['REGO_POLICIES_PREFIX'],
-            config.input_parameters['REGO_POLICY_KEY']
-        ))
-        logger.info('OPA policy file created')
-        logger.debug('Name of the policy file is: {}'.format(policy_file.name))
-
-        opa = Opa(
-            input_file.name,
-            config.input_parameters['OPA_POLICY_PACKAGE_NAME'],
-            config.input_parameters['OPA_POLICY_RULE_TO_EVAL']
-        )
+        opa = Opa(input_file.name, policy_package_name, rule_to_eval)
 
-        config.set_compliance(opa.eval_compliance(policy_file.name))
+        return opa.eval_compliance(policy.path)
     finally:
         try:
             input_file.close()
-            policy_file.close()
         except UnboundLocalError as e:
             logger.error(
                 'Tempfiles not created. Nothing to close. Error: {}'.format(e)
             )
         else:
             logger.info("Temp files have been closed")
+
+
+def eval_batch_server(config_items, policy, policy_id, policy_package_name,
+                      rule_to_eval) -> list:
+    global opa_server
+    try:
+        opa = Opa(None, policy_package_name, rule_to_eval)
+        return opa.eval_compliance_batch_server(
+            get_opa_server(), policy_id, policy.body, config_items)
+    except OpaServerError as e:
+        logger.warning(
+            'OPA server evaluation failed, falling back to opa eval: '
+            '{}'.format(e))
+        if opa_server is not None:
+            opa_server.stop()
+            opa_server = None
+        raise
+
+
+def eval_batch_cli(config_items, policy, policy_package_name,
+                   rule_to_eval) -> list:
+    input_file = get_tempfile(json.dumps({'items': config_items}))
+    try:
+        logger.debug('Name of the input file is: {}'.format(input_file.name))
+        opa = Opa(input_file.name, policy_package_name, rule_to_eval)
+        return opa.eval_compliance_batch(policy.path, len(config_items))
+    finally:
+        input_file.close()
+
+
+def eval_wasm(config, config_items, policy_package_name,
+              rule_to_eval) -> list:
+    try:
+        wasm_policy = get_wasm_policy(config)
+        entrypoint = '{}/{}'.format(policy_package_name.replace('.', '/'),
+                                    rule_to_eval)
+        compliances = [
+            undefined_as_false(wasm_policy.evaluate(entrypoint, config_item))
+            for config_item in config_items]
+    except Exception as e:
+        logger.warning(
+            'OPA Wasm evaluation failed, falling back to opa eval: '
+            '{}'.format(e))
+        raise OpaBundleError(e)
+    else:
+        logger.info('OPA compliance evaluated successfully in-process')
+        return compliances
+
+
+def get_policy(config) -> PolicyCacheEntry:
+    policy = policy_cache.get(
+        config.input_parameters['ASSETS_BUCKET'],
+        config.input_parameters['REGO_POLICIES_PREFIX'],
+        config.input_parameters['REGO_POLICY_KEY']
+    )
+    logger.info('Policy cache: {}'.format(policy_cache.stats()))
+    return policy
+
+
+def undefined_as_false(compliance):
+    # An undefined rule result (None) is NON_COMPLIANT, as in the batch queries
+    return False if compliance is None else compliance
+
+
+def eval_config_item(config) -> bool:
+    policy_package_name = config.input_parameters['OPA_POLICY_PACKAGE_NAME']
+    rule_to_eval = config.input_parameters['OPA_POLICY_RULE_TO_EVAL']
+
+    if opa_eval_mode == 'wasm':
+        try:
+            return eval_wasm(config, [config.config_item],
+                             policy_package_name, rule_to_eval)[0]
+        except OpaBundleError:
+            pass
+
+    policy = get_policy(config)
+    if opa_eval_mode == 'server':
+        try:
+            return undefined_as_false(eval_compliance_server(
+                config, policy, policy_package_name, rule_to_eval))
+        except OpaServerError:
+            pass
+
+    return undefined_as_false(eval_compliance_cli(
+        config, policy, policy_package_name, rule_to_eval))
+
+
+def eval_config_items(config, config_items) -> list:
+    # One OPA query for all the items, instead of one per item
+    policy_package_name = config.input_parameters['OPA_POLICY_PACKAGE_NAME']
+    rule_to_eval = config.input_parameters['OPA_POLICY_RULE_TO_EVAL']
+    start = time.monotonic()
+    compliances = None
+    if opa_eval_mode == 'wasm':
+        try:
+            compliances = eval_wasm(config, config_items,
+                                    policy_package_name, rule_to_eval)
+        except OpaBundleError:
+            pass
+    if compliances is None:
+        policy = get_policy(config)
+        if opa_eval_mode == 'server':
+            try:
+                compliances = eval_batch_server(
+                    config_items, policy,
+                    config.input_parameters['REGO_POLICY_KEY'],
+                    policy_package_name, rule_to_eval)
+            except OpaServerError:
+                pass
+    if compliances is None:
+        compliances = eval_batch_cli(config_items, policy,
+                                     policy_package_name, rule_to_eval)
+    elapsed = time.monotonic() - start
+    logger.info('Evaluated {} config items in {:.3f}s ({:.0f} items/s)'.format(
+        len(config_items), elapsed, len(config_items) / max(elapsed, 1e-6)))
+    return compliances
+
+
+@aws_clients.timed_handler(logger.info)
+def lambda_handler(event, context):
+    logger.debug('Lambda event: {}'.format(event))
+    config = Config(event)
+    logger.info('Config input processed')
+
+    if config.message_type == 'ScheduledNotification':
+        # Periodic re-evaluation of every resource in RESOURCE_TYPES
+        resource_types = [
+            t.strip()
+            for t in config.input_parameters['RESOURCE_TYPES'].split(',')
+            if t.strip()
+        ]
+        config_items = list(config.select_config_items(resource_types))
+        logger.info('{} config items selected'.format(len(config_items)))
+        if not config_items:
+            return
+    else:
+        config_items = [config.config_item]
+
+    if config.input_parameters.get('REGO_POLICY_KEYS'):
+        # Every policy of the set that applies to the resource type
+        config.set_compliances(config_items,
+                               *eval_policy_set(config, config_items))
+    elif config.message_type == 'ScheduledNotification':
+        config.set_compliances(config_items,
+                               eval_config_items(config, config_items))
+    else:
+        config.set_compliance(eval_config_item(config))
@@ -2,6 +2,30 @@
 
 rm -rf ./lambda_sources/function/lib
 pip3 install -r ./lambda_sources/function/lambda_requirements.txt -t ./lambda_sources/function/lib/
+# wasmtime and cryptography are only needed by the Wasm and signed bundle modes, and are
+# native packages: install the wheels of the python3.8 Lambda runtime, whatever the host.
+if [ "$OPA_BUILD_WASM" = "true" ] || [ -n "$OPA_SIGNING_KEY" ]; then
+  pip3 install -r ./lambda_sources/function/lambda_optional_requirements.txt -t ./lambda_sources/function/lib/ \
+    --platform manylinux2014_x86_64 --python-version 3.8 --implementation cp --only-binary=:all:
+fi
 cp ./lambda_sources/function/*.py ./lambda_sources/function/lambda_requirements.txt ./lambda_sources/function/lib/ &&
 cd ./lambda_sources/function/lib && zip -r  ../../packaged_lambda_assets/sources.zip .
 cd ../../layers && zip -r ../packaged_lambda_assets/opa.zip .
+
+# OPA bundle of the rego policies -> opa_bundle.tar.gz, to be uploaded next to them.
+# Signed when OPA_SIGNING_KEY is set (a PEM private key, or a secret with OPA_SIGNING_ALG=HS256),
+# compiled to Wasm with one entrypoint per policy when OPA_BUILD_WASM=true.
+cd ../..
+OPA_BIN=${OPA_BIN:-./lambda_sources/layers/opa/bin/opa}
+bundle_args=()
+if [ -n "$OPA_SIGNING_KEY" ]; then
+  bundle_args+=(--signing-key "$OPA_SIGNING_KEY" --signing-alg "${OPA_SIGNING_ALG:-RS256}")
+fi
+if [ "$OPA_BUILD_WASM" = "true" ]; then
+  bundle_args+=(-t wasm)
+  for policy in ./opa_policies/*.rego; do
+    package=$(awk '/^package / {print $2; exit}' "$policy")
+    bundle_args+=(-e "${package//.//}/${OPA_ENTRYPOINT_RULE:-compliant}")
+  done
+fi
+"$OPA_BIN" build -b ./opa_policies "${bundle_args[@]}" -o ./lambda_sources/packaged_lambda_assets/opa_bundle.tar.gz
@@ -0,0 +1,119 @@
+import json
+import os
+import sys
+import time
+
+# Measures the clean up of previous evaluations at the end of a periodic
+# evaluation: the resources that were evaluated before but not this time are
+# reported as NOT_APPLICABLE. Compares the nested loop the rule used to run
+# over all the previous evaluations with clean_up_old_evaluations(), on a
+# fake AWS Config client that pages the previous evaluations 100 at a time.
+# The nested loop is quadratic, so above 10,000 previous evaluations its time
+# is extrapolated from a run on 10,000.
+# Needs boto3 and requests, which the Lambda function imports.
+#
+# Usage:
+#   python3 benchmark/benchmark_cleanup.py [previous evaluations]
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'lambda_function'))
+
+import CloudEndureReplicationCheck as check  # noqa: E402
+
+event = {
+    'configRuleName': 'cloudendure-replication-check',
+    'invokingEvent': json.dumps({
+        'messageType': 'ScheduledNotification',
+        'notificationCreationTime': '2023-01-01T00:00:00.000Z'
+    })
+}
+nested_loop_max = 10000
+
+
+class FakeConfigClient(object):
+    def __init__(self, previous_count):
+        self.previous_count = previous_count
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, PaginationConfig, **kwargs):
+        page_size = PaginationConfig['PageSize']
+        for start in range(0, self.previous_count, page_size):
+            yield {'EvaluationResults': [
+                get_old_evaluation(i)
+                for i in range(start, min(start + page_size,
+                                          self.previous_count))
+            ]}
+
+
+def get_old_evaluation(i):
+    return {'EvaluationResultIdentifier': {'EvaluationResultQualifier': {
+        'ConfigRuleName': event['configRuleName'],
+        'ResourceType': 'AWS::EC2::Instance',
+        'ResourceId': 'i-{:017x}'.format(i)
+    }}}
+
+
+def make_latest_evaluations(previous_count):
+    # Half of the resources evaluated before are still there
+    return [check.build_evaluation('i-{:017x}'.format(i), 'COMPLIANT', event,
+                                   resource_type='AWS::EC2::Instance')
+            for i in range(0, previous_count, 2)]
+
+
+def nested_loop(latest_evaluations, old_eval_list):
+    # The clean up the rule did before clean_up_old_evaluations()
+    cleaned_evaluations = []
+    for old_eval in old_eval_list:
+        qualifier = old_eval['EvaluationResultIdentifier'][
+            'EvaluationResultQualifier']
+        newer_founded = False
+        for latest_eval in latest_evaluations:
+            if qualifier['ResourceId'] == latest_eval['ComplianceResourceId']:
+                newer_founded = True
+        if not newer_founded:
+            cleaned_evaluations.append(check.build_evaluation(
+                qualifier['ResourceId'], 'NOT_APPLICABLE', event,
+                resource_type=qualifier['ResourceType']))
+    return cleaned_evaluations
+
+
+def streaming(previous_count):
+    check.AWS_CONFIG_CLIENT = FakeConfigClient(previous_count)
+    latest_evaluations = make_latest_evaluations(previous_count)
+    start = time.perf_counter()
+    stale_evaluations = list(check.clean_up_old_evaluations(
+        latest_evaluations, event))
+    return stale_evaluations, time.perf_counter() - start
+
+
+def main(previous_count):
+    print('{:,} previous evaluations, {:,} still evaluated'.format(
+        previous_count, len(make_latest_evaluations(previous_count))))
+
+    stale_evaluations, elapsed = streaming(previous_count)
+
+    loop_count = min(previous_count, nested_loop_max)
+    latest_evaluations = make_latest_evaluations(loop_count)
+    old_eval_list = [get_old_evaluation(i) for i in range(loop_count)]
+    start = time.perf_counter()
+    expected = nested_loop(latest_evaluations, old_eval_list)
+    loop_elapsed = time.perf_counter() - start
+    if stale_evaluations[:len(expected)] != expected:
+        print('clean_up_old_evaluations returned different evaluations')
+        sys.exit(1)
+    loop_label = 'nested loop'
+    if loop_count < previous_count:
+        loop_elapsed *= (previous_count / loop_count) ** 2
+        loop_label = 'nested loop (estimated)'
+
+    print('{:,} evaluations set to NOT_APPLICABLE'.format(
+        len(stale_evaluations)))
+    for name, seconds in [(loop_label, loop_elapsed),
+                          ('set, page by page', elapsed)]:
+        print('  {:<24} {:>10.3f} s'.format(name, seconds))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,110 @@
+import datetime
+import os
+import sys
+import time
+
+# Measures how long it takes to find and evaluate the CloudEndure machine of
+# each configuration item of a synthetic project, with the linear scan over
+# the machine list the rule used to do for every item, and with the machine
+# index built once per fetch of the machine list.
+# Needs boto3 and requests, which the Lambda function imports.
+#
+# Usage:
+#   python3 benchmark/benchmark_machine_lookup.py [machines] [items]
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'lambda_function'))
+
+import CloudEndureReplicationCheck as check  # noqa: E402
+
+now = datetime.datetime.now()
+
+
+def make_machine(i):
+    # A mix of healthy, backlogged, lagging, replicating and untested machines
+    consistency = now - datetime.timedelta(minutes=[1, 1, 30, 1, 1][i % 5])
+    replication_info = {
+        'lastConsistencyDateTime': consistency.strftime('%Y-%m-%dT%H:%M:%S'),
+        'backloggedStorageBytes': 1024 if i % 5 == 1 else 0
+    }
+    if i % 7 == 0:
+        del replication_info['lastConsistencyDateTime']
+    return {
+        'sourceProperties': {
+            'machineCloudId': 'i-{:017x}'.format(i) if i % 2 == 0 else '',
+            'name': 'server-{}'.format(i)
+        },
+        'replicationInfo': replication_info,
+        'lifeCycle': {'lastTestLaunchDateTime': '2023-01-01T00:00:00'}
+        if i % 3 else {}
+    }
+
+
+def make_config_item(i):
+    # EC2 instances for the even machines, managed instances for the odd
+    # ones, and 10% of the items are not in CloudEndure
+    if i % 10 == 9:
+        i += 10 ** 7
+    if i % 2 == 0:
+        return {'resourceId': 'i-{:017x}'.format(i)}
+    resource_id = 'mi-{:017x}'.format(i)
+    return {
+        'resourceId': resource_id,
+        'configuration': {'AWS:InstanceInformation': {'Content': {
+            resource_id: {'ComputerName': 'server-{}'.format(i)}
+        }}}
+    }
+
+
+def scan(machines, ciData):
+    # The lookup the rule did before the machine index
+    for machine in machines:
+        if ciData['resourceId'].startswith('mi-'):
+            computer_name = ciData['configuration']['AWS:InstanceInformation'][
+                'Content'][ciData['resourceId']]['ComputerName']
+            if machine['sourceProperties']['name'] == computer_name:
+                return check.evaluate_machine_replication(machine, now)
+        elif ciData['resourceId'].startswith('i-'):
+            if machine['sourceProperties']['machineCloudId'] == \
+                    ciData['resourceId']:
+                return check.evaluate_machine_replication(machine, now)
+    return ['NOT_APPLICABLE', 'Machine not in CloudEndure']
+
+
+def indexed(machines, config_items):
+    machine_index = check.index_machines(machines)
+    results = []
+    for ciData in config_items:
+        machine = check.find_machine(machine_index, ciData)
+        if machine is None:
+            results.append(['NOT_APPLICABLE', 'Machine not in CloudEndure'])
+        else:
+            results.append(check.evaluate_machine_replication(machine, now))
+    return results
+
+
+def main(machine_count, item_count):
+    machines = [make_machine(i) for i in range(machine_count)]
+    config_items = [make_config_item(i) for i in range(item_count)]
+    print('{:,} machines, {:,} config items'.format(machine_count, item_count))
+
+    start = time.perf_counter()
+    expected = [scan(machines, ciData) for ciData in config_items]
+    scan_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = indexed(machines, config_items)
+    index_elapsed = time.perf_counter() - start
+
+    if results != expected:
+        print('The indexed lookup returned different results')
+        sys.exit(1)
+    for name, elapsed in [('linear scan', scan_elapsed),
+                          ('index (including build)', index_elapsed)]:
+        print('  {:<24} {:>9.3f} s {:>12,.0f} items/s'.format(
+            name, elapsed, item_count / elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
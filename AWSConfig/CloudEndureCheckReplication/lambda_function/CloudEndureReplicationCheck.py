@@ -1,8 +1,17 @@
 import json
 import sys
+import os
+import time
+import random
+import hashlib
+import asyncio
 import datetime
-import boto3
-import botocore
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import botocore.exceptions
+import aws_clients
+import evaluation_submitter
 
 try:
     import liblogging
@@ -19,9 +28,25 @@ DEFAULT_RESOURCE_TYPE = 'AWS::::Account'
 # Set to True to get the lambda to assume the Role attached on the Config Service (useful for cross-account).
 ASSUME_ROLE_MODE = False
 
+# Resource types evaluated on a ScheduledNotification when the scope of the rule has none
+DEFAULT_SCHEDULED_RESOURCE_TYPES = ['AWS::EC2::Instance', 'AWS::SSM::ManagedInstanceInventory']
+
 # Other parameters (no change needed)
 CONFIG_ROLE_TIMEOUT_SECONDS = 900
 
+# CloudEndure API. The login session is reused across invocations of the same Lambda container until it
+# expires, and the project and machine lists until they are older than CLOUDENDURE_CACHE_TTL_SECONDS.
+CLOUDENDURE_HOST = os.environ.get('CLOUDENDURE_HOST', 'https://console.cloudendure.com')
+# requests, or asyncio to use the aiohttp client (aiohttp has to be packaged with the function)
+CLOUDENDURE_HTTP_CLIENT = os.environ.get('CLOUDENDURE_HTTP_CLIENT', 'requests')
+# Connections to the API, and machine lists fetched at the same time
+CLOUDENDURE_MAX_CONNECTIONS = 10
+CLOUDENDURE_SESSION_TTL_SECONDS = int(os.environ.get('CLOUDENDURE_SESSION_TTL', '1800'))
+CLOUDENDURE_CACHE_TTL_SECONDS = int(os.environ.get('CLOUDENDURE_CACHE_TTL', '60'))
+CLOUDENDURE_MAX_RETRIES = 10
+CLOUDENDURE_RETRY_BASE_SECONDS = 0.5
+CLOUDENDURE_RETRY_MAX_SECONDS = 20
+
 #############
 # Main Code #
 #############
@@ -32,16 +57,10 @@ def evaluate_compliance(event, configuration_item, valid_rule_parameters):
     print(rule_event)
     print(rule_event['messageType'])
     if rule_event['messageType'] == 'ScheduledNotification':
-        try:
-            configclient = boto3.client('config')
-            triggereval = configclient.start_config_rules_evaluation(ConfigRuleNames=[event['configRuleName']])
-        except Exception as e:
-            print (e)
-    
-        return None
+        return evaluate_scheduled_compliance(event, valid_rule_parameters)
     
     try:
-        CloudEndureStatus = CheckCloudEndureReplication(valid_rule_parameters['apiToken'], valid_rule_parameters['project'], configuration_item)
+        CloudEndureStatus = CheckCloudEndureReplication(valid_rule_parameters['apiToken'], get_project_names(valid_rule_parameters), configuration_item)
         print (CloudEndureStatus)
         if CloudEndureStatus[0] == "PASSED":
             evaluations.append (
@@ -80,136 +99,410 @@ def evaluate_compliance(event, configuration_item, valid_rule_parameters):
     print (CloudEndureStatus)
     return evaluations
 
-def CheckCloudEndureReplication(api_token, projectname, ciData):
-    import requests
-    import json
-    import sys
-    import time
-    import random
-    
-    HOST = 'https://console.cloudendure.com'
-    headers = {'Content-Type': 'application/json'}
-    endpoint = '/api/latest/{}'
-    session = {}
-    
-    should_retry = True 
-    retries = 0
-
-    while should_retry:
-        if retries > 10:
-            return ["FAILED", "Exceeded max retries on login"]
-        retry_sleep = random.randint(1,15)
-        time.sleep (retry_sleep)
-        r = requests.post(HOST + endpoint.format('login'), data = json.dumps({'userApiToken': api_token}), headers = headers)
-    
-        if r.status_code != 200 and r.status_code != 307:
-            print ("Bad API Token or loging issue")
-            retries = retries + 1
-        else:
-            should_retry = False
-
-        
-
-    # check if need to use a different API entry point
-    if r.history:
-        endpoint = '/' + '/'.join(r.url.split('/')[3:-1]) + '/{}'
-        r = requests.post(HOST + endpoint.format('login'), data = json.dumps(login_data), headers = headers)
-
-    session = {'session': r.cookies['session']}
-    headers['X-XSRF-TOKEN'] = r.cookies['XSRF-TOKEN']
-
-    should_retry = True 
-    retries = 0
-
-    while should_retry:
-        if retries > 10:
-            return ["FAILED", "Exceeded max retries on getting project list"]
-        retry_sleep = random.randint(1,5)
-        time.sleep (retry_sleep)
-        r = requests.get(HOST + endpoint.format('projects'), headers = headers, cookies = session)
-        if r.status_code != 200:
-            print ("Failed to fetch the project")
-            retries = retries + 1
+##################
+# CloudEndure API #
+##################
+
+class CloudEndureError(Exception):
+    pass
+
+def is_retryable(status_code):
+    # Throttling and server errors
+    return status_code == 429 or status_code >= 500
+
+def get_retry_delay(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(CLOUDENDURE_RETRY_MAX_SECONDS, CLOUDENDURE_RETRY_BASE_SECONDS * 2 ** attempt))
+
+def get_login_endpoint(login_url):
+    # The login of some accounts is redirected to a different API entry point, used for all the following calls
+    return '/' + '/'.join(str(login_url).split('/')[3:-1]) + '/{}'
+
+class CloudEndureClient(object):
+    """Client of the CloudEndure API on a pooled requests session.
+
+    The client logs in once, following the redirect to the API entry point of the account, and sends the session
+    cookie and the XSRF token with every following request until the session expires or is rejected.
+    """
+
+    def __init__(self, api_token, host=None, max_connections=None):
+        self.api_token = api_token
+        self.host = host or CLOUDENDURE_HOST
+        self.max_connections = max_connections or CLOUDENDURE_MAX_CONNECTIONS
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        self.http.headers['Content-Type'] = 'application/json'
+        self.endpoint = '/api/latest/{}'
+        self.expires = 0
+        self.lock = threading.Lock()
+
+    def request(self, method, path, error_message, **kwargs):
+        """Send a request to the API, retrying throttling, server and connection errors with backoff.
+
+        Return the response, which can be a client error (4xx) for the caller to handle.
+        Raise a CloudEndureError with error_message when the retries are exhausted.
+        """
+        url = self.host + self.endpoint.format(path)
+        for attempt in range(CLOUDENDURE_MAX_RETRIES + 1):
+            try:
+                r = self.http.request(method, url, **kwargs)
+                if not is_retryable(r.status_code):
+                    return r
+                print("CloudEndure API returned {} for {}".format(r.status_code, url))
+            except requests.exceptions.RequestException as e:
+                print("CloudEndure API request failed: {}".format(e))
+            if attempt < CLOUDENDURE_MAX_RETRIES:
+                time.sleep(get_retry_delay(attempt))
+        raise CloudEndureError(error_message)
+
+    def login(self, expired_session=None):
+        with self.lock:
+            # Another thread may already have logged in again
+            if self.expires > time.time() and self.http.cookies.get('session') != expired_session:
+                return
+            self.http.cookies.clear()
+            self.http.headers.pop('X-XSRF-TOKEN', None)
+            self.endpoint = '/api/latest/{}'
+            login_data = json.dumps({'userApiToken': self.api_token})
+            r = self.request('POST', 'login', "Exceeded max retries on login", data=login_data)
+            if r.status_code == 200 and r.history:
+                self.endpoint = get_login_endpoint(r.url)
+                r = self.request('POST', 'login', "Exceeded max retries on login", data=login_data)
+            if r.status_code != 200 or 'XSRF-TOKEN' not in self.http.cookies:
+                raise CloudEndureError("Bad API Token or login issue")
+            self.http.headers['X-XSRF-TOKEN'] = self.http.cookies['XSRF-TOKEN']
+            self.expires = time.time() + CLOUDENDURE_SESSION_TTL_SECONDS
+
+    def get_items(self, path, error_message):
+        """Return the items of an API list, logging in again once if the session is no longer valid."""
+        if self.expires <= time.time():
+            self.login()
+        for attempt in range(2):
+            session = self.http.cookies.get('session')
+            r = self.request('GET', path, error_message)
+            if r.status_code == 200:
+                return json.loads(r.content)['items']
+            if r.status_code in (401, 403, 419) and attempt == 0:
+                print("CloudEndure session expired, logging in again")
+                self.login(expired_session=session)
+                continue
+            raise CloudEndureError(error_message)
+
+    def get_projects(self):
+        """Return the IDs of the projects by name."""
+        return {project['name']: project['id'] for project in self.get_items('projects', "Failed to fetch the project list")}
+
+    def get_machines(self, project_id):
+        return self.get_items('projects/{}/machines'.format(project_id), "Failed to fetch the machines")
+
+    def get_machines_of_projects(self, project_ids):
+        """Return the machines of each project by project ID, fetching the projects concurrently."""
+        if self.expires <= time.time():
+            self.login()
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            return dict(zip(project_ids, executor.map(self.get_machines, project_ids)))
+
+class AsyncCloudEndureClient(object):
+    """asyncio variant of CloudEndureClient, on an aiohttp session.
+
+    aiohttp is not included in the Lambda runtime and has to be packaged with the function. The session and its
+    connections are kept on an event loop owned by the client, so they are reused across invocations like those
+    of CloudEndureClient.
+    """
+
+    def __init__(self, api_token, host=None, max_connections=None):
+        import aiohttp
+        self.aiohttp = aiohttp
+        self.api_token = api_token
+        self.host = host or CLOUDENDURE_HOST
+        self.max_connections = max_connections or CLOUDENDURE_MAX_CONNECTIONS
+        self.loop = asyncio.new_event_loop()
+        self.http = None
+        self.headers = {'Content-Type': 'application/json'}
+        self.endpoint = '/api/latest/{}'
+        self.expires = 0
+        self.login_lock = None
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    async def get_http(self):
+        if self.http is None:
+            self.http = self.aiohttp.ClientSession(
+                connector=self.aiohttp.TCPConnector(limit=self.max_connections),
+                # The stub server of the tests runs on an IP address
+                cookie_jar=self.aiohttp.CookieJar(unsafe=True))
+            self.login_lock = asyncio.Lock()
+        return self.http
+
+    async def request(self, method, path, error_message, **kwargs):
+        """See CloudEndureClient.request(). Return the response and its body."""
+        http = await self.get_http()
+        url = self.host + self.endpoint.format(path)
+        for attempt in range(CLOUDENDURE_MAX_RETRIES + 1):
+            try:
+                async with http.request(method, url, headers=self.headers, **kwargs) as r:
+                    body = await r.read()
+                if not is_retryable(r.status):
+                    return r, body
+                print("CloudEndure API returned {} for {}".format(r.status, url))
+            except (self.aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print("CloudEndure API request failed: {}".format(e))
+            if attempt < CLOUDENDURE_MAX_RETRIES:
+                await asyncio.sleep(get_retry_delay(attempt))
+        raise CloudEndureError(error_message)
+
+    def get_cookie(self, name):
+        for cookie in self.http.cookie_jar:
+            if cookie.key == name:
+                return cookie.value
+        return None
+
+    async def login(self, expired_session=None):
+        await self.get_http()
+        async with self.login_lock:
+            if self.expires > time.time() and self.get_cookie('session') != expired_session:
+                return
+            self.http.cookie_jar.clear()
+            self.headers.pop('X-XSRF-TOKEN', None)
+            self.endpoint = '/api/latest/{}'
+            login_data = json.dumps({'userApiToken': self.api_token})
+            r, _ = await self.request('POST', 'login', "Exceeded max retries on login", data=login_data)
+            if r.status == 200 and r.history:
+                self.endpoint = get_login_endpoint(r.url)
+                r, _ = await self.request('POST', 'login', "Exceeded max retries on login", data=login_data)
+            if r.status != 200 or self.get_cookie('XSRF-TOKEN') is None:
+                raise CloudEndureError("Bad API Token or login issue")
+            self.headers['X-XSRF-TOKEN'] = self.get_cookie('XSRF-TOKEN')
+            self.expires = time.time() + CLOUDENDURE_SESSION_TTL_SECONDS
+
+    async def get_items(self, path, error_message):
+        if self.expires <= time.time():
+            await self.login()
+        for attempt in range(2):
+            session = self.get_cookie('session')
+            r, body = await self.request('GET', path, error_message)
+            if r.status == 200:
+                return json.loads(body)['items']
+            if r.status in (401, 403, 419) and attempt == 0:
+                print("CloudEndure session expired, logging in again")
+                await self.login(expired_session=session)
+                continue
+            raise CloudEndureError(error_message)
+
+    async def fetch_machines_of_projects(self, project_ids):
+        if self.expires <= time.time():
+            await self.login()
+        machines = await asyncio.gather(*[
+            self.get_items('projects/{}/machines'.format(project_id), "Failed to fetch the machines")
+            for project_id in project_ids
+        ])
+        return dict(zip(project_ids, machines))
+
+    def get_projects(self):
+        items = self.run(self.get_items('projects', "Failed to fetch the project list"))
+        return {project['name']: project['id'] for project in items}
+
+    def get_machines_of_projects(self, project_ids):
+        return self.run(self.fetch_machines_of_projects(project_ids))
+
+    def close(self):
+        if self.http is not None:
+            self.run(self.http.close())
+            self.http = None
+
+# Clients and API responses, per API token, kept for the life of the Lambda container
+CLOUDENDURE_CLIENTS = {}
+CLOUDENDURE_CACHE = {}
+
+def get_token_key(api_token):
+    # The API token itself is only kept by its client
+    return hashlib.sha256(api_token.encode('utf-8')).hexdigest()
+
+def get_cloudendure_client(api_token):
+    token_key = get_token_key(api_token)
+    if token_key not in CLOUDENDURE_CLIENTS:
+        if CLOUDENDURE_HTTP_CLIENT == 'asyncio':
+            CLOUDENDURE_CLIENTS[token_key] = AsyncCloudEndureClient(api_token)
         else:
-            should_retry = False
-        
+            CLOUDENDURE_CLIENTS[token_key] = CloudEndureClient(api_token)
+    return CLOUDENDURE_CLIENTS[token_key]
+
+def get_cached(api_token, key):
+    """Return the cached value of key for the API token, or None if there is none or it is older than the TTL."""
+    cached = CLOUDENDURE_CACHE.get((get_token_key(api_token), key))
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+    return None
+
+def set_cached(api_token, key, value):
+    CLOUDENDURE_CACHE[(get_token_key(api_token), key)] = (time.time() + CLOUDENDURE_CACHE_TTL_SECONDS, value)
+    return value
+
+def get_cloudendure_projects(api_token):
+    """Return the IDs of the CloudEndure projects by name."""
+    projects = get_cached(api_token, 'projects')
+    if projects is None:
+        projects = set_cached(api_token, 'projects', get_cloudendure_client(api_token).get_projects())
+    return projects
+
+def index_machines(machines):
+    """Return the machines indexed by the ID of their EC2 instance (machineCloudId) and by their name.
+
+    When several machines have the same ID or name, the first one is used.
+    """
+    machine_index = {'cloudId': {}, 'name': {}}
+    for machine in machines:
+        source_properties = machine.get('sourceProperties', {})
+        if source_properties.get('machineCloudId'):
+            machine_index['cloudId'].setdefault(source_properties['machineCloudId'], machine)
+        if source_properties.get('name'):
+            machine_index['name'].setdefault(source_properties['name'], machine)
+    return machine_index
+
+def get_cloudendure_machines(api_token, projectnames):
+    """Return the machines of the CloudEndure projects, indexed with index_machines().
+
+    The machine lists that are not cached are fetched concurrently. When a machine is in several projects, the
+    first project in projectnames is used.
+
+    Keyword arguments:
+    api_token -- the CloudEndure API token
+    projectnames -- the names of the projects
+    """
+    projects = get_cloudendure_projects(api_token)
+    missing = [projectname for projectname in projectnames if projectname not in projects]
+    if missing:
+        raise CloudEndureError("Project {} not found in CloudEndure".format(', '.join(missing)))
+    project_ids = [projects[projectname] for projectname in projectnames]
+
+    indexes = {project_id: get_cached(api_token, ('machines', project_id)) for project_id in project_ids}
+    stale = [project_id for project_id, machine_index in indexes.items() if machine_index is None]
+    if stale:
+        for project_id, machines in get_cloudendure_client(api_token).get_machines_of_projects(stale).items():
+            indexes[project_id] = set_cached(api_token, ('machines', project_id), index_machines(machines))
+
+    if len(project_ids) == 1:
+        return indexes[project_ids[0]]
+    machine_index = {'cloudId': {}, 'name': {}}
+    for project_id in reversed(project_ids):
+        machine_index['cloudId'].update(indexes[project_id]['cloudId'])
+        machine_index['name'].update(indexes[project_id]['name'])
+    return machine_index
+
+def find_machine(machine_index, ciData):
+    """Return the CloudEndure machine of a configuration item, or None.
+
+    EC2 instances (i-) are matched on machineCloudId, managed instances (mi-) on the ComputerName of their
+    AWS:InstanceInformation inventory.
+    """
+    resource_id = ciData['resourceId']
+    if resource_id.startswith('i-'):
+        return machine_index['cloudId'].get(resource_id)
+    if resource_id.startswith('mi-'):
+        computer_name = ciData['configuration']['AWS:InstanceInformation']['Content'][resource_id]['ComputerName']
+        return machine_index['name'].get(computer_name)
+    return None
 
+def evaluate_machine_replication(machine, now=None):
+    """Return the replication status of a CloudEndure machine, as ['PASSED' or 'FAILED', reason].
+
+    Keyword arguments:
+    machine -- the machine, as returned by the CloudEndure API
+    now -- the current time (default: datetime.datetime.now())
+    """
+    replication_info = machine['replicationInfo']
+    if replication_info.get('backloggedStorageBytes', 0) > 0:
+        return ['FAILED', 'Backlogged bytes is higher than 0']
+    if 'lastConsistencyDateTime' not in replication_info:
+        return ['FAILED', 'Last consistency date does not exist or system still replicating']
+    # Replication has to have been consistent within the last 10 minutes
+    now_minus_10 = (now or datetime.datetime.now()) - datetime.timedelta(minutes = 10)
+    if replication_info['lastConsistencyDateTime'] < now_minus_10.strftime("%Y-%m-%dT%H:%M:%S"):
+        return ['FAILED', 'Communication with Source machine lost']
+    if 'lastTestLaunchDateTime' not in machine['lifeCycle']:
+        return ['FAILED', 'Machine has not been tested']
+    return ['PASSED', 'Replication enabled and consistent ']
+
+def get_project_names(valid_rule_parameters):
+    # The project rule parameter is one project name, or a comma delimited list of them
+    return [projectname.strip() for projectname in valid_rule_parameters['project'].split(',') if projectname.strip()]
+
+def CheckCloudEndureReplication(api_token, projectnames, ciData):
     try:
-        projects = json.loads(r.content)['items']
-        for project in projects:
-            if project['name'] == projectname:
-                machines = False
-                project_id = project['id']
-                should_retry = True 
-                retries = 0
-            
-                while should_retry:
-                    if retries > 10:
-                        return ["FAILED", "Exceeded max retries on login"]
-                    retry_sleep = random.randint(1,5)
-                    time.sleep (retry_sleep)
-                    r = requests.get(HOST + endpoint.format('projects/{}/machines').format(project_id), headers = headers, cookies = session)
-                    if r.status_code != 200:
-                        print ("Failed to fetch the machines")
-                        retries = retries + 1
-                    else:
-                        should_retry = False
-                        
-                for machine in json.loads(r.content)['items']:
-                    if ciData['resourceId'].startswith('mi-'):
-                        if machine['sourceProperties']['name'] == ciData['configuration']['AWS:InstanceInformation']['Content'][ciData['resourceId']]['ComputerName']:
-                            backlog = 0
-
-                            if 'backloggedStorageBytes' in machine['replicationInfo']:		
-                                if machine['replicationInfo']['backloggedStorageBytes'] > 0:
-                                    return ['FAILED', 'Backlogged bytes is higher than 0']
-                
-                            now = datetime.datetime.now()
-                            now_minus_10 = now - datetime.timedelta(minutes = 10)
-                            current = now_minus_10.strftime("%Y-%m-%dT%H:%M:%S")
-                            if 'lastConsistencyDateTime' in machine['replicationInfo']:
-                                if machine['replicationInfo']['lastConsistencyDateTime'] < current:
-                                    return ['FAILED', 'Communication with Source machine lost']
-                            
-
-                            if 'lastConsistencyDateTime' not in machine['replicationInfo']:
-                                return ['FAILED', 'Last consistency date does not exist or system still replicating']
-                            if 'lastTestLaunchDateTime' not in machine['lifeCycle']:
-                                return ['FAILED', 'Machine has not been tested']
-                            return ['PASSED', 'Replication enabled and consistent ']
-                        machines = True
-                    elif ciData['resourceId'].startswith('i-'):
-                        
-                        if machine['sourceProperties']['machineCloudId'] == ciData['resourceId']: 
-                            backlog = 0
-
-                            if 'backloggedStorageBytes' in machine['replicationInfo']:		
-                                if machine['replicationInfo']['backloggedStorageBytes'] > 0:
-                                    return ['FAILED', 'Backlogged bytes is higher than 0']
-                    
-                            now = datetime.datetime.now()
-                            now_minus_10 = now - datetime.timedelta(minutes = 10)
-                            current = now_minus_10.strftime("%Y-%m-%dT%H:%M:%S")
-                            if 'lastConsistencyDateTime' in machine['replicationInfo']:
-                                if machine['replicationInfo']['lastConsistencyDateTime'] < current:
-                                    return ['FAILED', 'Communication with Source machine lost']
-            
-                
-                            if 'lastConsistencyDateTime' not in machine['replicationInfo']:
-                                return ['FAILED', 'Last consistency date does not exist or system still replicating']
-                            if 'lastTestLaunchDateTime' not in machine['lifeCycle']:
-                                return ['FAILED', 'Machine has not been tested']
-                            return ['PASSED', 'Replication enabled and consistent ']
-                        machines = True
-                    
-    
-                print (ciData['resourceId'])
-                return ["NOT_APPLICABLE", "Machine not in CloudEndure"]
+        machine_index = get_cloudendure_machines(api_token, projectnames)
+    except CloudEndureError as e:
+        return ["FAILED", str(e)]
+
+    try:
+        machine = find_machine(machine_index, ciData)
+        if machine is None:
+            print (ciData['resourceId'])
+            return ["NOT_APPLICABLE", "Machine not in CloudEndure"]
+        return evaluate_machine_replication(machine)
     except Exception as e:
         return ['FAILED', e]
 
 
 
+# Evaluates every resource in the scope of the rule in one invocation: the CloudEndure machines are fetched once,
+# and joined with the EC2 instances and managed instances recorded by AWS Config.
+def evaluate_scheduled_compliance(event, valid_rule_parameters):
+    """Return the evaluations of all the resources in the scope of the rule.
+
+    Keyword arguments:
+    event -- the event variable given in the lambda handler
+    valid_rule_parameters -- the output of the evaluate_parameters() representing validated parameters of the Config Rule
+    """
+    projectnames = get_project_names(valid_rule_parameters)
+    machine_index = get_cloudendure_machines(valid_rule_parameters['apiToken'], projectnames)
+
+    now = datetime.datetime.now()
+    evaluations = []
+    for ciData in select_config_items(get_rule_resource_types(event)):
+        try:
+            machine = find_machine(machine_index, ciData)
+        except KeyError:
+            # Managed instance without the AWS:InstanceInformation inventory
+            machine = None
+        if machine is None:
+            status = ["NOT_APPLICABLE", "Machine not in CloudEndure"]
+        else:
+            status = evaluate_machine_replication(machine, now)
+        compliance_type = {'PASSED': 'COMPLIANT', 'FAILED': 'NON_COMPLIANT'}.get(status[0], status[0])
+        evaluations.append(build_evaluation(ciData['resourceId'], compliance_type, event,
+                                            resource_type=ciData['resourceType'],
+                                            annotation=status[1] if compliance_type != 'COMPLIANT' else None))
+    print("Evaluated {} resources against CloudEndure projects {}".format(len(evaluations), ', '.join(projectnames)))
+    return evaluations
+
+def get_rule_resource_types(event):
+    config_rules = AWS_CONFIG_CLIENT.describe_config_rules(ConfigRuleNames=[event['configRuleName']])['ConfigRules']
+    scope = config_rules[0].get('Scope', {}) if config_rules else {}
+    return scope.get('ComplianceResourceTypes') or DEFAULT_SCHEDULED_RESOURCE_TYPES
+
+def select_config_items(resource_types):
+    """Yield the resources of the given types recorded by AWS Config, using advanced queries.
+
+    The configuration is only selected for managed instance inventories, which are matched on their ComputerName.
+    """
+    inventory_type = 'AWS::SSM::ManagedInstanceInventory'
+    queries = []
+    other_types = [resource_type for resource_type in resource_types if resource_type != inventory_type]
+    if other_types:
+        queries.append("SELECT resourceId, resourceType WHERE resourceType IN ({})".format(
+            ', '.join("'{}'".format(resource_type) for resource_type in other_types)))
+    if inventory_type in resource_types:
+        queries.append("SELECT resourceId, resourceType, configuration WHERE resourceType = '{}'".format(inventory_type))
+
+    paginator = AWS_CONFIG_CLIENT.get_paginator('select_resource_config')
+    for expression in queries:
+        for page in paginator.paginate(Expression=expression):
+            for result in page['Results']:
+                yield json.loads(result)
+
 def evaluate_parameters(rule_parameters):
     """Evaluate the rule parameters dictionary validity. Raise a ValueError for invalid parameters.
 
@@ -249,13 +542,9 @@ def get_client(service, event, region=None):
     region -- the region where the client is called (default: None)
     """
     if not ASSUME_ROLE_MODE:
-        return boto3.client(service, region)
+        return aws_clients.client(service, region)
     credentials = get_assume_role_credentials(get_execution_role_arn(event), region)
-    return boto3.client(service, aws_access_key_id=credentials['AccessKeyId'],
-                        aws_secret_access_key=credentials['SecretAccessKey'],
-                        aws_session_token=credentials['SessionToken'],
-                        region_name=region
-                       )
+    return aws_clients.client(service, region, credentials=credentials)
 
 # This generate an evaluation for config
 def build_evaluation(resource_id, compliance_type, event, resource_type=DEFAULT_RESOURCE_TYPE, annotation=None):
@@ -389,11 +678,10 @@ def is_applicable(configuration_item, event):
 
 
 def get_assume_role_credentials(role_arn, region=None):
-    sts_client = boto3.client('sts', region)
     try:
-        assume_role_response = sts_client.assume_role(RoleArn=role_arn,
-                                                      RoleSessionName="configLambdaExecution",
-                                                      DurationSeconds=CONFIG_ROLE_TIMEOUT_SECONDS)
+        # Cached across invocations until shortly before the credentials expire
+        assume_role_response = aws_clients.assume_role(role_arn, "configLambdaExecution",
+                                                       CONFIG_ROLE_TIMEOUT_SECONDS, region)
         if 'liblogging' in sys.modules:
             liblogging.logSession(role_arn, assume_role_response)
         return assume_role_response['Credentials']
@@ -409,40 +697,31 @@ def get_assume_role_credentials(role_arn, region=None):
 
 # This removes older evaluation (usually useful for periodic rule not reporting on AWS::::Account).
 def clean_up_old_evaluations(latest_evaluations, event):
+    """Yield NOT_APPLICABLE evaluations for the resources previously evaluated that are not in latest_evaluations.
 
-    cleaned_evaluations = []
-
-    old_eval = AWS_CONFIG_CLIENT.get_compliance_details_by_config_rule(
-        ConfigRuleName=event['configRuleName'],
-        ComplianceTypes=['COMPLIANT', 'NON_COMPLIANT'],
-        Limit=100)
-
-    old_eval_list = []
-
-    while True:
-        for old_result in old_eval['EvaluationResults']:
-            old_eval_list.append(old_result)
-        if 'NextToken' in old_eval:
-            next_token = old_eval['NextToken']
-            old_eval = AWS_CONFIG_CLIENT.get_compliance_details_by_config_rule(
-                ConfigRuleName=event['configRuleName'],
-                ComplianceTypes=['COMPLIANT', 'NON_COMPLIANT'],
-                Limit=100,
-                NextToken=next_token)
-        else:
-            break
-
-    for old_eval in old_eval_list:
-        old_resource_id = old_eval['EvaluationResultIdentifier']['EvaluationResultQualifier']['ResourceId']
-        newer_founded = False
-        for latest_eval in latest_evaluations:
-            if old_resource_id == latest_eval['ComplianceResourceId']:
-                newer_founded = True
-        if not newer_founded:
-            cleaned_evaluations.append(build_evaluation(old_resource_id, "NOT_APPLICABLE", event))
-
-    return cleaned_evaluations + latest_evaluations
+    The previous evaluations are read page by page, so the evaluations can be reported while the next pages are read.
 
+    Keyword arguments:
+    latest_evaluations -- the evaluations of this invocation
+    event -- the event variable given in the lambda handler
+    """
+    latest_resources = {(evaluation['ComplianceResourceType'], evaluation['ComplianceResourceId'])
+                        for evaluation in latest_evaluations}
+
+    paginator = AWS_CONFIG_CLIENT.get_paginator('get_compliance_details_by_config_rule')
+    pages = paginator.paginate(ConfigRuleName=event['configRuleName'],
+                               ComplianceTypes=['COMPLIANT', 'NON_COMPLIANT'],
+                               PaginationConfig={'PageSize': 100})
+    for page in pages:
+        for old_eval in page['EvaluationResults']:
+            qualifier = old_eval['EvaluationResultIdentifier']['EvaluationResultQualifier']
+            old_resource = (qualifier['ResourceType'], qualifier['ResourceId'])
+            if old_resource not in latest_resources:
+                # Reported once, even if the resource has several previous evaluations
+                latest_resources.add(old_resource)
+                yield build_evaluation(qualifier['ResourceId'], "NOT_APPLICABLE", event, resource_type=qualifier['ResourceType'])
+
+@aws_clients.timed_handler()
 def lambda_handler(event, context):
     if 'liblogging' in sys.modules:
         liblogging.logEvent(event)
@@ -477,13 +756,18 @@ def lambda_handler(event, context):
         return build_error_response("Customer error while making API request", str(ex), ex.response['Error']['Code'], ex.response['Error']['Message'])
     except ValueError as ex:
         return build_internal_error_response(str(ex), str(ex))
+    except CloudEndureError as ex:
+        # Keep the previous evaluations rather than reporting every resource when CloudEndure cannot be reached
+        return build_internal_error_response("Error while calling the CloudEndure API", str(ex))
 
     evaluations = []
     latest_evaluations = []
+    # Only a periodic evaluation covers every resource, so that the resources it did not evaluate can be cleaned up
+    clean_up = is_scheduled_notification(invoking_event['messageType'])
 
     if not compliance_result:
         latest_evaluations.append(build_evaluation(event['accountId'], "NOT_APPLICABLE", event, resource_type='AWS::::Account'))
-        evaluations = clean_up_old_evaluations(latest_evaluations, event)
+        evaluations = latest_evaluations
     elif isinstance(compliance_result, str):
         if configuration_item:
             evaluations.append(build_evaluation_from_config_item(configuration_item, compliance_result))
@@ -499,7 +783,7 @@ def lambda_handler(event, context):
 
             if not missing_fields:
                 latest_evaluations.append(evaluation)
-        evaluations = clean_up_old_evaluations(latest_evaluations, event)
+        evaluations = latest_evaluations
     elif isinstance(compliance_result, dict):
         missing_fields = False
         for field in ('ComplianceResourceType', 'ComplianceResourceId', 'ComplianceType', 'OrderingTimestamp'):
@@ -518,12 +802,21 @@ def lambda_handler(event, context):
         # Used solely for RDK test to skip actual put_evaluation API call
         test_mode = True
 
-    # Invoke the Config API to report the result of the evaluation
-    evaluation_copy = []
-    evaluation_copy = evaluations[:]
-    while evaluation_copy:
-        AWS_CONFIG_CLIENT.put_evaluations(Evaluations=evaluation_copy[:100], ResultToken=result_token, TestMode=test_mode)
-        del evaluation_copy[:100]
+    # Invoke the Config API to report the result of the evaluation, in chunks of 100 sent in parallel
+    with evaluation_submitter.EvaluationSubmitter(AWS_CONFIG_CLIENT, result_token, test_mode) as submitter:
+        submitter.add_all(evaluations)
+
+        if clean_up:
+            # Reported while the previous evaluations are read
+            stale_evaluations = []
+            for evaluation in clean_up_old_evaluations(latest_evaluations, event):
+                submitter.add(evaluation)
+                stale_evaluations.append(evaluation)
+            print("{} previous evaluations set to NOT_APPLICABLE".format(len(stale_evaluations)))
+            evaluations = evaluations + stale_evaluations
+    for failed in submitter.failed_evaluations:
+        print("Config service rejected evaluation of " + failed['ComplianceResourceId'])
+    print("PutEvaluations: {}".format(submitter.get_metrics()))
 
     # Used solely for RDK test to be able to test Lambda function
     return evaluations
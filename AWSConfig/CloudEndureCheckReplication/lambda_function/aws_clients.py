@@ -0,0 +1,185 @@
+import functools
+import os
+import threading
+import time
+
+# Shared by the Lambda functions of the AWS Config OPA, CloudEndure replication
+# check and configuration management samples. Each sample ships its own copy
+# next to its handler, keep them identical.
+#
+# boto3 clients are cached for the life of the Lambda container, per service,
+# region and credentials, so only the first invocation pays for loading the
+# service model and opening connections. Credentials of assumed roles are
+# cached until shortly before they expire, and the clients and resources
+# created with them are dropped once they have expired.
+
+import_started = time.perf_counter()
+
+# Tuned for Lambda: keep connections alive between invocations, allow enough
+# connections for the thread pools of the handlers, and let botocore adapt
+# its retry rate to throttling.
+max_pool_connections = int(os.environ.get('AWS_CLIENT_MAX_POOL_CONNECTIONS',
+                                          '20'))
+max_attempts = int(os.environ.get('AWS_CLIENT_MAX_ATTEMPTS', '10'))
+# Assumed role credentials are refreshed this many seconds before they expire
+credentials_refresh_margin = int(
+    os.environ.get('AWS_CREDENTIALS_REFRESH_MARGIN', '60'))
+
+clients = {}
+resources = {}
+assumed_roles = {}
+# Expiration timestamps of the credentials of the cached clients and resources
+expirations = {}
+lock = threading.Lock()
+timings = {
+    'BotoImportSeconds': None,
+    'ClientInitSeconds': {},
+    'Invocations': 0,
+}
+invocation_started = None
+boto3 = None
+client_config = None
+
+
+def load_boto3():
+    # boto3 is only imported when the first client is created, and the time
+    # it takes is reported by get_timings
+    global boto3, client_config
+    if boto3 is None:
+        started = time.perf_counter()
+        import boto3 as boto3_module
+        from botocore.config import Config
+        client_config = Config(
+            tcp_keepalive=True,
+            max_pool_connections=max_pool_connections,
+            retries={'mode': 'adaptive', 'max_attempts': max_attempts}
+        )
+        boto3 = boto3_module
+        timings['BotoImportSeconds'] = round(time.perf_counter() - started, 3)
+    return boto3
+
+
+def get_cache_key(service, region, credentials):
+    if credentials is None:
+        return service, region, None
+    return (service, region, credentials['AccessKeyId'],
+            credentials.get('SessionToken'))
+
+
+def get_credentials_kwargs(credentials):
+    if credentials is None:
+        return {}
+    return {
+        'aws_access_key_id': credentials['AccessKeyId'],
+        'aws_secret_access_key': credentials['SecretAccessKey'],
+        'aws_session_token': credentials.get('SessionToken'),
+    }
+
+
+def get_expiration(credentials):
+    # Credentials passed without an Expiration are assumed not to expire
+    if credentials is None or credentials.get('Expiration') is None:
+        return None
+    return credentials['Expiration'].timestamp()
+
+
+def evict_expired():
+    # Clients and resources of expired credentials are not used anymore. Called
+    # with the lock held, whenever a new client or resource is created.
+    now = time.time()
+    for key in [k for k, expiration in expirations.items() if expiration <= now]:
+        clients.pop(key, None)
+        resources.pop(key, None)
+        del expirations[key]
+
+
+def get_cached(cache, kind, service, region, credentials):
+    key = get_cache_key(service, region, credentials)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    with lock:
+        if key not in cache:
+            evict_expired()
+            started = time.perf_counter()
+            cache[key] = getattr(load_boto3(), kind)(
+                service, region_name=region, config=client_config,
+                **get_credentials_kwargs(credentials))
+            timings['ClientInitSeconds'].setdefault(
+                service, round(time.perf_counter() - started, 3))
+            expiration = get_expiration(credentials)
+            if expiration is not None:
+                expirations[key] = expiration
+        return cache[key]
+
+
+def client(service, region=None, credentials=None):
+    """Return a cached boto3 client.
+
+    Keyword arguments:
+    service -- the service name, as for boto3.client()
+    region -- the region of the client (default: the region of the Lambda function)
+    credentials -- the Credentials of an assumed role (default: the Lambda execution role)
+    """
+    return get_cached(clients, 'client', service, region, credentials)
+
+
+def resource(service, region=None, credentials=None):
+    """Return a cached boto3 resource, see client()."""
+    return get_cached(resources, 'resource', service, region, credentials)
+
+
+def assume_role(role_arn, session_name, duration_seconds=900, region=None):
+    """Return the AssumeRole response of role_arn, cached until shortly before its credentials expire.
+
+    Errors of sts:AssumeRole are raised as botocore ClientError.
+    """
+    key = (role_arn, session_name, region)
+    cached = assumed_roles.get(key)
+    if cached is not None:
+        remaining = cached['Credentials']['Expiration'].timestamp() - time.time()
+        if remaining > credentials_refresh_margin:
+            return cached
+    response = client('sts', region).assume_role(
+        RoleArn=role_arn, RoleSessionName=session_name,
+        DurationSeconds=duration_seconds)
+    assumed_roles[key] = response
+    return response
+
+
+def record_invocation():
+    """Count an invocation and start timing it. Call it first thing in the handler."""
+    global invocation_started
+    invocation_started = time.perf_counter()
+    timings['Invocations'] += 1
+    if timings['Invocations'] == 1:
+        # from the import of this module to the first invocation
+        timings['InitSeconds'] = round(invocation_started - import_started, 3)
+
+
+def get_timings():
+    """Return the startup timings of the container and the duration of the current invocation.
+
+    ColdStart is True during the first invocation of the container.
+    ClientInitSeconds is the time it took to create the first client of each service.
+    """
+    report = dict(timings, ColdStart=timings['Invocations'] == 1)
+    report['ClientInitSeconds'] = dict(timings['ClientInitSeconds'])
+    if invocation_started is not None:
+        report['InvocationSeconds'] = round(
+            time.perf_counter() - invocation_started, 3)
+    return report
+
+
+def timed_handler(log=print):
+    """Decorate a Lambda handler to log get_timings() at the end of every invocation."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            record_invocation()
+            try:
+                return handler(event, context)
+            finally:
+                log('Startup timings: {}'.format(get_timings()))
+        return wrapper
+    return decorator
@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared by the Lambda functions of the AWS Config OPA and CloudEndure
+# replication check samples. Each sample ships its own copy next to its
+# handler, keep them identical.
+#
+# Evaluations are buffered and sent to AWS Config with PutEvaluations, in
+# chunks of 100, on a small thread pool. Throttled calls are only retried by
+# the client, with the adaptive retries of aws_clients.client(), so that a
+# throttled chunk is not retried by two layers. The retries of the client are
+# counted.
+
+# PutEvaluations accepts at most 100 evaluations per call
+chunk_size = 100
+max_workers = int(os.environ.get('EVALUATION_SUBMITTER_THREADS', '4'))
+
+
+def get_retry_attempts(response):
+    # The retries of botocore, from a response or a ClientError
+    return response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+
+
+class EvaluationSubmitter(object):
+    """Send evaluations to AWS Config in chunks of 100, several chunks at a time.
+
+    Full chunks are sent in the background as evaluations are added, the
+    rest by flush(), which waits for every chunk and raises the first error.
+    Throttled calls are retried by config_client. When everything fits in one chunk, it
+    is sent by flush() on the calling thread. Used as a context manager,
+    flush() is called on exit.
+
+    Keyword arguments:
+    config_client -- the boto3 AWS Config client, with retries (aws_clients.client('config'))
+    result_token -- the resultToken of the Lambda event
+    test_mode -- the TestMode of PutEvaluations (default False)
+    workers -- the number of chunks sent at a time (default EVALUATION_SUBMITTER_THREADS, 4)
+    """
+
+    def __init__(self, config_client, result_token, test_mode=False,
+                 workers=None):
+        self.config_client = config_client
+        self.result_token = result_token
+        self.test_mode = test_mode
+        self.workers = workers or max_workers
+        self.buffer = []
+        self.executor = None
+        self.futures = []
+        self.lock = threading.Lock()
+        self.failed_evaluations = []
+        self.metrics = {'Evaluations': 0, 'Chunks': 0, 'Retries': 0,
+                        'FailedEvaluations': 0, 'WallSeconds': 0.0}
+        self.started = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            # Do not hide the error of the caller
+            self.wait()
+            self.close()
+
+    def add(self, evaluation):
+        if self.started is None:
+            self.started = time.perf_counter()
+        self.buffer.append(evaluation)
+        if len(self.buffer) == chunk_size:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            self.futures.append(self.executor.submit(self.send, self.buffer))
+            self.buffer = []
+
+    def add_all(self, evaluations):
+        for evaluation in evaluations:
+            self.add(evaluation)
+
+    def flush(self):
+        """Send the buffered evaluations, wait for every chunk, and return get_metrics()."""
+        if self.buffer:
+            chunk, self.buffer = self.buffer, []
+            if self.executor is None:
+                self.send(chunk)
+            else:
+                self.futures.append(self.executor.submit(self.send, chunk))
+        errors = self.wait()
+        self.close()
+        if errors:
+            raise errors[0]
+        return self.get_metrics()
+
+    def wait(self):
+        # Return the errors of the chunks sent since the last call
+        futures, self.futures = self.futures, []
+        errors = [future.exception() for future in futures
+                  if future.exception() is not None]
+        if self.started is not None:
+            self.metrics['WallSeconds'] = round(
+                time.perf_counter() - self.started, 3)
+        return errors
+
+    def send(self, chunk):
+        try:
+            response = self.config_client.put_evaluations(
+                Evaluations=chunk, ResultToken=self.result_token,
+                TestMode=self.test_mode)
+        except Exception as e:
+            with self.lock:
+                self.metrics['Retries'] += get_retry_attempts(
+                    getattr(e, 'response', {}))
+            raise
+        failed = response.get('FailedEvaluations', [])
+        with self.lock:
+            self.metrics['Retries'] += get_retry_attempts(response)
+            self.metrics['Evaluations'] += len(chunk)
+            self.metrics['Chunks'] += 1
+            self.metrics['FailedEvaluations'] += len(failed)
+            self.failed_evaluations += failed
+
+    def get_metrics(self):
+        """Return the evaluations and chunks sent, the retries of the client, the evaluations rejected by AWS Config and the time since the first evaluation was added."""
+        with self.lock:
+            return dict(self.metrics)
+
+    def close(self):
+        # Stops the thread pool, a new one is started by the next full chunk
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
@@ -0,0 +1,150 @@
+import datetime
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+
+# A local stand-in for the CloudEndure API that replays the responses of
+# cloudendure_responses.json, so the API client of the rule can be exercised
+# without a CloudEndure account. It is not deployed with the Lambda function.
+#
+# Each response is keyed by "METHOD path". "{now}" in a response body is
+# replaced by the current time, so the recorded machines stay consistent.
+# Like the API, every call but the login needs the session cookie and the
+# X-XSRF-TOKEN header, and gets a 401 otherwise.
+#
+# Usage:
+#   python3 local/stub_cloudendure_server.py [port]
+# serves the responses until interrupted.
+#   python3 local/stub_cloudendure_server.py --check
+# runs the rule against the stub with the requests client, and the asyncio
+# client if aiohttp is installed, and prints the results, the number of
+# requests and the number of connections the stub received.
+
+here = os.path.dirname(os.path.abspath(__file__))
+responses_path = os.path.join(here, 'cloudendure_responses.json')
+
+
+class StubCloudEndureHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1, so that the clients can keep their connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.stats['connections'] += 1
+
+    def do_GET(self):
+        self.replay()
+
+    def do_POST(self):
+        self.replay()
+
+    def replay(self):
+        self.server.stats['requests'] += 1
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        response = self.server.responses.get(
+            '{} {}'.format(self.command, self.path))
+        if response is None:
+            return self.send(404, {'message': 'Not recorded'})
+        if not self.path.endswith('/login') and not self.is_logged_in():
+            return self.send(401, {'message': 'Unauthorized'})
+        # Latency of the real API, to compare sequential and concurrent calls
+        time.sleep(self.server.latency)
+        body = json.dumps(response.get('body', {})).replace(
+            '{now}', datetime.datetime.now().isoformat())
+        self.send(response['status'], body, response.get('headers', {}),
+                  response.get('cookies', {}))
+
+    def is_logged_in(self):
+        cookies = self.headers.get('Cookie') or ''
+        session = self.server.responses['POST /api/v5/login']['cookies']
+        return ('session={}'.format(session['session']) in cookies and
+                self.headers.get('X-XSRF-TOKEN') == session['XSRF-TOKEN'])
+
+    def send(self, status, body, headers=None, cookies=None):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        for name, value in (cookies or {}).items():
+            self.send_header('Set-Cookie', '{}={}; Path=/'.format(name, value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port=0, latency=0.0):
+    """Start the stub on a background thread and return the server."""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port),
+                                             StubCloudEndureHandler)
+    with open(responses_path) as f:
+        server.responses = json.load(f)
+    server.latency = latency
+    server.stats = {'requests': 0, 'connections': 0}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check():
+    sys.path.insert(0, os.path.join(here, '..', 'lambda_function'))
+    import CloudEndureReplicationCheck as rule
+
+    server = start_server(latency=0.05)
+    rule.CLOUDENDURE_HOST = 'http://127.0.0.1:{}'.format(server.server_port)
+    projectnames = ['my-project', 'my-dr-project']
+    config_items = [
+        {'resourceId': 'i-0123456789abcdef0'},
+        {'resourceId': 'i-0123456789abcdef1'},
+        {'resourceId': 'i-0fffffffffffffff0'},
+    ] + [{
+        'resourceId': resource_id,
+        'configuration': {'AWS:InstanceInformation': {'Content': {
+            resource_id: {'ComputerName': computer_name}}}}
+    } for resource_id, computer_name in [('mi-00000000000000001', 'onprem-db-1'),
+                                         ('mi-00000000000000002', 'onprem-db-2')]]
+
+    http_clients = ['requests']
+    try:
+        import aiohttp  # noqa: F401
+        http_clients.append('asyncio')
+    except ImportError:
+        print('aiohttp is not installed, skipping the asyncio client')
+
+    for http_client in http_clients:
+        rule.CLOUDENDURE_HTTP_CLIENT = http_client
+        rule.CLOUDENDURE_CLIENTS.clear()
+        rule.CLOUDENDURE_CACHE.clear()
+        server.stats.update(requests=0, connections=0)
+        start = time.perf_counter()
+        results = [rule.CheckCloudEndureReplication('stub-token', projectnames, ciData)
+                   for ciData in config_items]
+        elapsed = time.perf_counter() - start
+        print('{} client: {} requests on {} connections in {:.3f} s'.format(
+            http_client, server.stats['requests'],
+            server.stats['connections'], elapsed))
+        for ciData, result in zip(config_items, results):
+            print('  {:<22} {}'.format(ciData['resourceId'], result))
+        for client in rule.CLOUDENDURE_CLIENTS.values():
+            if hasattr(client, 'close'):
+                client.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--check']:
+        check()
+    else:
+        port = int(sys.argv[1]) if len(sys.argv) > 1 else 8443
+        start_server(port)
+        print('Serving the CloudEndure API stub on http://127.0.0.1:{}'.format(port))
+        threading.Event().wait()
@@ -0,0 +1,109 @@
+import os
+import random
+import sys
+import threading
+import time
+
+# Compares the wall time of the Athena queries of a drift check run one
+# after another, as get_keyvalue_misconfigurations() used to, with
+# run_Athena_queries(), which runs them at the same time.
+#
+# Runs against a local stand-in for the Athena API: every query takes a
+# random time between 1 and 4 seconds (scaled by --scale) and returns
+# 2,500 rows, in pages of 1,000 rows like GetQueryResults.
+#
+# Usage:
+#   python3 benchmark/benchmark_athena_queries.py [queries] [scale]
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+import configurationManagementExampleLambda as lambda_function  # noqa: E402
+
+rows_per_query = 2500
+
+
+class LocalAthena(object):
+    # The calls of the Athena API used by run_Athena_queries()
+
+    def __init__(self, latencies):
+        self.latencies = latencies
+        self.executions = {}
+        self.lock = threading.Lock()
+        self.max_running = 0
+
+    def start_query_execution(self, QueryString, WorkGroup,
+                              ResultConfiguration=None):
+        with self.lock:
+            query_id = 'q{}'.format(len(self.executions))
+            self.executions[query_id] = (
+                QueryString, time.perf_counter() + self.latencies[QueryString])
+            self.max_running = max(self.max_running, len(
+                [1 for _, done in self.executions.values()
+                 if done > time.perf_counter()]))
+        return {'QueryExecutionId': query_id}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        now = time.perf_counter()
+        return {'QueryExecutions': [{
+            'QueryExecutionId': query_id,
+            'Status': {'State': 'SUCCEEDED'
+                       if self.executions[query_id][1] <= now else 'RUNNING'},
+        } for query_id in QueryExecutionIds]}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, QueryExecutionId, PaginationConfig):
+        query = self.executions[QueryExecutionId][0]
+        columns = ['resourceid', 'key', 'value']
+        rows = [{'Data': [{'VarCharValue': name} for name in columns]}]
+        rows += [{'Data': [{'VarCharValue': 'i-{}'.format(i)},
+                           {'VarCharValue': query}, {}]}
+                 for i in range(rows_per_query)]
+        size = PaginationConfig['PageSize']
+        for i in range(0, len(rows), size):
+            yield {'ResultSet': {
+                'Rows': rows[i:i + size],
+                'ResultSetMetadata': {
+                    'ColumnInfo': [{'Name': name} for name in columns]}}}
+
+    def stop_query_execution(self, QueryExecutionId):
+        pass
+
+
+def main(query_count, scale):
+    random.seed(1)
+    latencies = {'SELECT {}'.format(i): random.uniform(1, 4) * scale
+                 for i in range(query_count)}
+    queries = list(latencies)
+    print('{} queries, {:.2f} s for the slowest, {:.2f} s in total'.format(
+        query_count, max(latencies.values()), sum(latencies.values())))
+
+    athena = LocalAthena(latencies)
+    start = time.perf_counter()
+    sequential = []
+    for query in queries:
+        sequential += lambda_function.query_Athena_and_parse_response(
+            query, athena)
+    sequential_elapsed = time.perf_counter() - start
+
+    athena = LocalAthena(latencies)
+    start = time.perf_counter()
+    concurrent = list(lambda_function.run_Athena_queries(
+        queries, athena, max_concurrent=query_count))
+    concurrent_elapsed = time.perf_counter() - start
+
+    key = lambda row: (row['key'], row['resourceid'])  # noqa: E731
+    if sorted(sequential, key=key) != sorted(concurrent, key=key) or \
+            len(concurrent) != query_count * rows_per_query:
+        print('The queries returned different rows')
+        sys.exit(1)
+    print('  {:<12} {:>7.2f} s'.format('sequential', sequential_elapsed))
+    print('  {:<12} {:>7.2f} s  ({} queries at the same time)'.format(
+        'concurrent', concurrent_elapsed, athena.max_running))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 1)
@@ -0,0 +1,171 @@
+import os
+import sys
+import tempfile
+import time
+
+import duckdb
+
+# Compares the drift query built by compare_with_ideal_config() with the
+# query it used to build, one SELECT * per rule of the ideal config file
+# joined with UNION, on a synthetic inventory table queried with DuckDB as
+# a local stand-in for Athena.
+#
+# DuckDB reads the table once for the whole query, while Athena reads it
+# once per reference of the table. The scanned bytes are estimated the way
+# Athena bills them: every reference of the table reads the columns it
+# selects, measured from the Parquet file. The runtime is the one of DuckDB.
+#
+# Usage:
+#   python3 benchmark/benchmark_drift_query.py [instances] [keys]
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+import configurationManagementExampleLambda as lambda_function  # noqa: E402
+
+table = 'inventory'
+settings_group = 'webservers'
+
+
+def make_ideal_config(key_count):
+    # A mix of the rules of the ideal config file: plain values, wildcards,
+    # lists of accepted values and subkeys
+    common = {}
+    for k in range(key_count):
+        key = 'setting{}'.format(k)
+        kind = k % 5
+        if kind == 0:
+            common[key] = 'value{}'.format(k)
+        elif kind == 1:
+            common[key] = 'value{}{{*}}'.format(k)
+        elif kind == 2:
+            common[key] = ['value{}'.format(k), 'alternative{}'.format(k)]
+        elif kind == 3:
+            common[key] = {'sub0': 'value{}'.format(k),
+                           'sub1': 'value{}'.format(k)}
+        else:
+            common[key] = {'{*}': 'value{}'.format(k)}
+    return {'common': common}
+
+
+def write_inventory(path, instance_count, key_count):
+    # The columns of an SSM resource data sync of the custom inventory, with
+    # one row per instance and setting. 1 in 20 values drifted.
+    duckdb.sql("""
+        COPY (
+            SELECT
+                'i-' || lpad(printf('%x', i), 17, '0') AS resourceid,
+                '2023-06-01T00:00:00Z' AS capturetime,
+                '1.0' AS schemaversion,
+                'Custom:ConfigSettings' AS resourcetype,
+                '123456789012' AS accountid,
+                'us-east-1' AS region,
+                CASE WHEN k % 7 = 0 THEN '{group}-other' ELSE '{group}' END
+                    AS settingsgroup,
+                'setting' || k AS key,
+                CASE WHEN k % 5 IN (3, 4) THEN 'sub' || (i % 2) END AS subkey,
+                CASE WHEN (i + k) % 20 = 0 THEN 'drifted' || k
+                     ELSE 'value' || k END AS value
+            FROM range({instances}) AS instances (i),
+                 range({keys}) AS settings (k)
+        ) TO '{path}' (FORMAT parquet)
+    """.format(group=settings_group, instances=instance_count,
+               keys=key_count, path=path))
+
+
+def get_column_bytes(path):
+    return dict(duckdb.sql(
+        "SELECT path_in_schema, sum(total_compressed_size) "
+        "FROM parquet_metadata('{}') GROUP BY 1".format(path)).fetchall())
+
+
+def build_query(key, subkey, value):
+    # The query of a single rule, as the drift query was built before
+    # plan_drift_query()
+    rule = lambda_function.build_rule(key, subkey, value)
+    query = "SELECT * FROM \"paas-config-mgmt\".\"{}\" WHERE settingsgroup='{}' AND key='{}'".format(
+        table, lambda_function.sql_escape(settings_group),
+        lambda_function.sql_escape(rule['key']))
+    if rule['subkeyCondition']:
+        query += " AND subkey{}'{}'".format(
+            rule['subkeyCondition'], lambda_function.sql_escape(rule['subkey']))
+    if isinstance(rule['value'], list):
+        query += " AND value{}(".format(rule['condition']) + ', '.join(
+            map(lambda_function.sql_string, rule['value'])) + ")"
+    else:
+        query += " AND value{}'{}'".format(
+            rule['condition'], lambda_function.sql_escape(rule['value']))
+    return query
+
+
+def legacy_query(ideal_config):
+    # compare_with_ideal_config() before the planner
+    queries = []
+    for category in ideal_config:
+        for key, subkey_or_value in ideal_config[category].items():
+            if isinstance(subkey_or_value, dict):
+                for subkey, value in subkey_or_value.items():
+                    queries.append(build_query(key, subkey, value))
+            else:
+                queries.append(build_query(key, None, subkey_or_value))
+    return queries
+
+
+def run(connection, query):
+    start = time.perf_counter()
+    rows = connection.sql(query).fetchall()
+    return rows, time.perf_counter() - start
+
+
+def main(instance_count, key_count):
+    ideal_config = make_ideal_config(key_count)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'inventory.parquet')
+        write_inventory(path, instance_count, key_count)
+        column_bytes = get_column_bytes(path)
+
+        connection = duckdb.connect()
+        connection.sql('CREATE SCHEMA "paas-config-mgmt"')
+        connection.sql(
+            'CREATE VIEW "paas-config-mgmt"."{}" AS '
+            "SELECT * FROM read_parquet('{}')".format(table, path))
+
+        queries = legacy_query(ideal_config)
+        legacy_rows, legacy_elapsed = run(connection, ' UNION '.join(queries))
+        planned = lambda_function.compare_with_ideal_config(
+            ideal_config, table, settings_group)
+        planned_rows, planned_elapsed = run(connection, planned)
+
+    # The planner returns the projected columns and the expected value, the
+    # legacy query every column without duplicates
+    legacy_columns = ['resourceid', 'capturetime', 'schemaversion',
+                      'resourcetype', 'accountid', 'region', 'settingsgroup',
+                      'key', 'subkey', 'value']
+    legacy_set = {tuple(row[legacy_columns.index(column)]
+                        for column in lambda_function.DRIFT_QUERY_COLUMNS)
+                  for row in legacy_rows}
+    planned_set = {row[:len(lambda_function.DRIFT_QUERY_COLUMNS)]
+                   for row in planned_rows}
+    if legacy_set != planned_set:
+        print('The planned query returned different rows')
+        sys.exit(1)
+
+    all_bytes = sum(column_bytes.values())
+    projected_bytes = sum(column_bytes[column]
+                          for column in lambda_function.DRIFT_QUERY_COLUMNS)
+    branches = planned.count(' FROM inventory i ')
+    print('{:,} instances, {:,} settings, {:,} rules, {:,} misconfigured rows'
+          .format(instance_count, key_count, len(queries), len(planned_set)))
+    for name, elapsed, scans, scan_bytes, length in [
+            ('UNION of SELECT *', legacy_elapsed, len(queries), all_bytes,
+             len(' UNION '.join(queries))),
+            ('planned', planned_elapsed, branches, projected_bytes,
+             len(planned))]:
+        print('  {:<18} {:>8.3f} s  {:>4} table reads  {:>10,.1f} MB '
+              'scanned (estimated)  {:>9,} characters of SQL'.format(
+                  name, elapsed, scans, scans * scan_bytes / 2 ** 20, length))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 300)
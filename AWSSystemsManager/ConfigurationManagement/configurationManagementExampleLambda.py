@@ -16,43 +16,295 @@
 #* SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #*
 
+import os
+import re
+import csv
+import json
+import time
+import codecs
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import aws_clients
+
+# "athena" checks the inventory with an Athena query, "memory" reads the inventory files of the SSM resource data
+# sync from INVENTORY_S3_BUCKET/INVENTORY_S3_PREFIX and checks them in the Lambda function
+DRIFT_ENGINE = os.environ.get("DRIFT_ENGINE", "athena")
+
+# Misconfigurations sent to the reporting Lambda function per invocation
+REPORTING_BATCH_SIZE = int(os.environ.get("REPORTING_BATCH_SIZE", "500"))
+
+# "true" does not invoke the reporting Lambda function when the misconfigurations are the same as the ones it was
+# sent last time by this container
+SKIP_UNCHANGED_REPORTS = os.environ.get("SKIP_UNCHANGED_REPORTS", "false").lower() == "true"
+
+# "true" only reports the changes since the last run: the misconfigurations that appeared, with "drift": "drifted",
+# and the ones that were fixed, with "drift": "remediated". The open misconfigurations and the high-water mark of
+# INCREMENTAL_COLUMN are kept in DRIFT_STATE_FILE, and the drift query only reads the inventory rows at or after the
+# mark. Use a partition column for INCREMENTAL_COLUMN so that Athena skips the older partitions.
+INCREMENTAL_DRIFT = os.environ.get("INCREMENTAL_DRIFT", "false").lower() == "true"
+INCREMENTAL_COLUMN = os.environ.get("INCREMENTAL_COLUMN", "capturetime")
+DRIFT_STATE_FILE = os.environ.get("DRIFT_STATE_FILE", "/tmp/configuration-drift-state.json")
+
+# Kept for the life of the Lambda container:
+# the ideal config files, by bucket and key: (ETag, ideal config)
+IDEAL_CONFIG_CACHE = {}
+# the drift queries, by table and settings group, and the compiled rules: (ETag of the ideal config file, query or rules)
+DRIFT_QUERY_CACHE = {}
+COMPILED_RULES_CACHE = {}
+# the digest of the misconfigurations last reported, by table and settings group
+REPORTED_MISCONFIGURATIONS = {}
+
+@aws_clients.timed_handler()
 def lambda_handler(event, context):
-    misconfigurations = get_keyvalue_misconfigurations(IDEAL_FILE_S3_KEY, CONFIG_SETTINGS_GROUP, CONFIG_MGMT_ATHENA_TABLE, CUSTOM_QUERIES)
+    if INCREMENTAL_DRIFT:
+        stateStore = LocalFileStateStore(DRIFT_STATE_FILE)
+        misconfigurations, state = get_drift_deltas(stateStore.load(), IDEAL_FILE_S3_KEY, CONFIG_SETTINGS_GROUP, CONFIG_MGMT_ATHENA_TABLE, CUSTOM_QUERIES)
+    else:
+        # The misconfigurations are reported in batches as the queries return them, they are not all kept in memory
+        misconfigurations = iter_keyvalue_misconfigurations(IDEAL_FILE_S3_KEY, CONFIG_SETTINGS_GROUP, CONFIG_MGMT_ATHENA_TABLE, CUSTOM_QUERIES)
+
+    if SKIP_UNCHANGED_REPORTS and not INCREMENTAL_DRIFT:
+        memo_key = (CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP)
+        spool, count, digest = spool_misconfigurations(misconfigurations)
+        if REPORTED_MISCONFIGURATIONS.get(memo_key) == digest:
+            spool.close()
+            print("The {} misconfigurations are unchanged since the last report, not reported".format(count))
+            return 0
+        misconfigurations = read_spooled_misconfigurations(spool)
 
-    if misconfigurations:
-        response = invoke_reporting_lambda(misconfigurations, context)
+    reported = 0
+    for batch in get_batches(misconfigurations, REPORTING_BATCH_SIZE):
+        response = invoke_reporting_lambda(batch, context)
 
         print(response)
-        return misconfigurations
+        reported += len(batch)
+
+    # Only once they were all reported
+    if INCREMENTAL_DRIFT:
+        stateStore.save(state)
+    elif SKIP_UNCHANGED_REPORTS:
+        REPORTED_MISCONFIGURATIONS[memo_key] = digest
+
+    print("Reported {} misconfigurations".format(reported))
+    return reported
+
+def spool_misconfigurations(misconfigurations):
+    # Writes the misconfigurations to a temporary file, in memory up to 10 MB and on disk after that, and returns
+    # the file, their number and a digest of them that does not depend on their order
+    spool = tempfile.SpooledTemporaryFile(max_size=10 * 2 ** 20, mode='w+')
+    count = 0
+    total = 0
+    for misconfiguration in misconfigurations:
+        line = json.dumps(misconfiguration, sort_keys=True)
+        spool.write(line + "\n")
+        count += 1
+        total += int(hashlib.sha256(line.encode()).hexdigest(), 16)
+    spool.seek(0)
+    return spool, count, (count, total % 2 ** 256)
+
+def read_spooled_misconfigurations(spool):
+    with spool:
+        for line in spool:
+            yield json.loads(line)
+
+def get_batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def iter_keyvalue_misconfigurations(IDEAL_FILE_S3_KEY, CONFIG_SETTINGS_GROUP, CONFIG_MGMT_ATHENA_TABLE, CUSTOM_QUERIES):
+
+    s3Client = aws_clients.resource('s3')
+    athenaClient = aws_clients.client('athena')
+
+    # Load ideal JSON from S3, only downloaded again when it changed
+    etag, idealConfig = get_ideal_config(os.environ["IDEAL_FILE_S3_BUCKET"], IDEAL_FILE_S3_KEY, s3Client)
+
+    # Manually written queries, if any
+    queries = list(CUSTOM_QUERIES)
+
+    if DRIFT_ENGINE == "memory":
+        # Check inventory against ideal in memory, with the same rules as the query builder
+        compiled = get_cached(COMPILED_RULES_CACHE, etag, (CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP),
+                              lambda: compile_ideal_config(idealConfig))
+        yield from find_misconfigurations_in_memory(
+            compiled, CONFIG_SETTINGS_GROUP, os.environ["INVENTORY_S3_BUCKET"], os.environ["INVENTORY_S3_PREFIX"])
     else:
-        return []
+        # Check inventory against ideal using query builder
+        queries.insert(0, get_cached(DRIFT_QUERY_CACHE, etag, (CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP),
+                                     lambda: compare_with_ideal_config(idealConfig, CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP)))
 
-def get_keyvalue_misconfigurations(IDEAL_FILE_S3_KEY, CONFIG_SETTINGS_GROUP, CONFIG_MGMT_ATHENA_TABLE, CUSTOM_QUERIES):
+    # All the queries run at the same time, the rows of each are returned as soon as it succeeds
+    yield from run_Athena_queries(queries, athenaClient)
 
-    aggregatedResults = []
-    s3Client = boto3.resource('s3')
-    athenaClient = boto3.client('athena')
+def get_ideal_config(bucket, key, s3Client):
+    # Returns the ETag and content of the ideal config file. When it is cached, it is only downloaded if its ETag
+    # changed, S3 answers 304 Not Modified otherwise.
+    cached = IDEAL_CONFIG_CACHE.get((bucket, key))
+    idealObject = s3Client.Object(bucket, key)
+    try:
+        if cached:
+            response = idealObject.get(IfNoneMatch=cached[0])
+        else:
+            response = idealObject.get()
+    except s3Client.meta.client.exceptions.ClientError as e:
+        if cached and e.response['Error']['Code'] in ('304', 'NotModified'):
+            return cached
+        raise
+    IDEAL_CONFIG_CACHE[(bucket, key)] = (response['ETag'], json.loads(response['Body'].read()))
+    return IDEAL_CONFIG_CACHE[(bucket, key)]
+
+def get_cached(cache, etag, key, build):
+    # The value of key built from the ideal config file with this ETag, built again when the file changed
+    cached = cache.get(key)
+    if cached is None or cached[0] != etag:
+        cached = cache[key] = (etag, build())
+    return cached[1]
+
+# Incremental drift detection
 
-    # Load ideal JSON from S3
-    idealConfig = get_ideal_config_file_from_s3(os.environ["IDEAL_FILE_S3_BUCKET"], IDEAL_FILE_S3_KEY, s3Client)
+class LocalFileStateStore(object):
+    # The state of the incremental drift detection, as a JSON file. /tmp is kept for the life of the Lambda
+    # container only, a state store that outlives it needs the same load() and save() on S3 or DynamoDB.
 
-    # Check inventory against ideal using query builder
-    query = compare_with_ideal_config(idealConfig, CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP)
-    aggregatedResults += query_Athena_and_parse_response(query, athenaClient)
+    def __init__(self, path):
+        self.path = path
 
-    # Check manually written queries, if any
-    for query in CUSTOM_QUERIES:
-        aggregatedResults += query_Athena_and_parse_response(query, athenaClient)
+    def load(self):
+        # None when there is no state yet, or it cannot be read, so that the next run checks the whole inventory
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
 
-    print(aggregatedResults)
+    def save(self, state):
+        # Written to a temporary file first, so that an interrupted run leaves the previous state
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.path + ".tmp", self.path)
 
-    return aggregatedResults
+def get_drift_deltas(previousState, IDEAL_FILE_S3_KEY, CONFIG_SETTINGS_GROUP, CONFIG_MGMT_ATHENA_TABLE, CUSTOM_QUERIES):
+    # Returns the misconfigurations that appeared or were fixed since previousState, and the new state. Only the
+    # inventory rows at or after the high-water mark of previousState are checked, unless there is no state yet,
+    # it is for another ideal config file, table or settings group, or DRIFT_ENGINE is memory.
+    s3Client = aws_clients.resource('s3')
+    athenaClient = aws_clients.client('athena')
 
+    etag, idealConfig = get_ideal_config(os.environ["IDEAL_FILE_S3_BUCKET"], IDEAL_FILE_S3_KEY, s3Client)
 
-def compare_with_ideal_config(idealConfig, CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP):
+    state = {'etag': etag, 'table': CONFIG_MGMT_ATHENA_TABLE, 'settingsGroup': CONFIG_SETTINGS_GROUP,
+             'highWaterMark': None, 'open': [], 'customOpen': []}
+    incremental = (DRIFT_ENGINE != "memory" and previousState is not None and previousState.get('highWaterMark') is not None
+                   and all(previousState.get(name) == state[name] for name in ('etag', 'table', 'settingsGroup')))
+    markFilter = None
+    if incremental:
+        # Rows captured at the mark are checked again, so that none captured in the same second as it are missed
+        markFilter = "{} >= '{}'".format(INCREMENTAL_COLUMN, sql_escape(previousState['highWaterMark']))
 
-    query_list = []
-    aggregated_query = ""
+    findings = []
+    customFindings = []
+    # The resources in the inventory, and the latest INCREMENTAL_COLUMN of each
+    resources = {}
+
+    queries = list(CUSTOM_QUERIES)
+    if DRIFT_ENGINE == "memory":
+        compiled = get_cached(COMPILED_RULES_CACHE, etag, (CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP),
+                              lambda: compile_ideal_config(idealConfig))
+        findings += find_misconfigurations_in_memory(
+            compiled, CONFIG_SETTINGS_GROUP, os.environ["INVENTORY_S3_BUCKET"], os.environ["INVENTORY_S3_PREFIX"])
+        customIndex = 0
+    else:
+        if markFilter:
+            driftQuery = compare_with_ideal_config(idealConfig, CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP, markFilter)
+        else:
+            driftQuery = get_cached(DRIFT_QUERY_CACHE, etag, (CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP),
+                                    lambda: compare_with_ideal_config(idealConfig, CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP))
+        queries = [driftQuery, plan_resources_query(CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP)] + queries
+        customIndex = 2
+
+    for index, row in iter_Athena_query_results(queries, athenaClient):
+        if index >= customIndex:
+            customFindings.append(row)
+        elif index == 0:
+            findings.append(row)
+        else:
+            resources[row['resourceid']] = row['highwatermark']
+
+    # The resources with rows at or after the mark
+    if incremental:
+        recaptured = {resource for resource, mark in resources.items() if mark is not None and mark >= previousState['highWaterMark']}
+    else:
+        recaptured = set(resources)
+
+    previousOpen = {}
+    previousCustomOpen = {}
+    if previousState is not None:
+        previousOpen = {get_finding_key(finding): finding for finding in previousState.get('open', [])}
+        previousCustomOpen = {get_finding_key(finding): finding for finding in previousState.get('customOpen', [])}
+
+    # The open misconfigurations of the resources that were not captured again are still open, unless the resource
+    # left the inventory, for example a terminated instance. The manually written queries read the whole inventory,
+    # their results replace the previous ones.
+    currentOpen = {}
+    marks = [mark for mark in resources.values() if mark is not None]
+    if incremental:
+        currentOpen = {key: finding for key, finding in previousOpen.items()
+                       if finding['resourceid'] in resources and finding['resourceid'] not in recaptured}
+        state['highWaterMark'] = max(marks + [previousState['highWaterMark']])
+    elif marks:
+        state['highWaterMark'] = max(marks)
+    currentOpen.update((get_finding_key(finding), finding) for finding in findings)
+    currentCustomOpen = {get_finding_key(finding): finding for finding in customFindings}
+
+    state['open'] = list(currentOpen.values())
+    state['customOpen'] = list(currentCustomOpen.values())
+
+    deltas = []
+    for previous, current in ((previousOpen, currentOpen), (previousCustomOpen, currentCustomOpen)):
+        deltas += [dict(finding, drift="drifted") for key, finding in current.items() if key not in previous]
+        deltas += [dict(finding, drift="remediated") for key, finding in previous.items() if key not in current]
+
+    print("{} drift check: {} misconfigurations open, {} drifted and {} remediated since the last run, {} resources captured since {}".format(
+        "Incremental" if incremental else "Full", len(currentOpen) + len(currentCustomOpen),
+        sum(1 for delta in deltas if delta['drift'] == "drifted"), sum(1 for delta in deltas if delta['drift'] == "remediated"),
+        len(recaptured), previousState['highWaterMark'] if incremental else "the start"))
+
+    return deltas, state
+
+def get_finding_key(finding):
+    # A misconfiguration is the same one as long as the value stays the same, whenever it was captured
+    return json.dumps({column: value for column, value in finding.items() if column != 'capturetime'}, sort_keys=True)
+
+def plan_resources_query(CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP):
+    # The resources of the settings group and their latest INCREMENTAL_COLUMN. It reads the whole table, but only
+    # these two columns, to find the resources that were captured again and the ones that left the inventory.
+    where = "settingsgroup = '{}'".format(sql_escape(CONFIG_SETTINGS_GROUP))
+    return "SELECT resourceid, max({}) AS highwatermark FROM \"paas-config-mgmt\".\"{}\" WHERE {} GROUP BY resourceid".format(
+        INCREMENTAL_COLUMN, CONFIG_MGMT_ATHENA_TABLE, where)
+
+# Columns of the inventory table read by the drift query. Only these are scanned, instead of every column with SELECT *.
+DRIFT_QUERY_COLUMNS = ['resourceid', 'capturetime', 'settingsgroup', 'key', 'subkey', 'value']
+
+# Operators that can be set with {condition:<operator>} in the ideal config file
+CUSTOM_CONDITIONS = ['=', '!=', '<>', '<', '<=', '>', '>=', 'LIKE', 'NOT LIKE']
+
+def compare_with_ideal_config(idealConfig, CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP, partition_filter=None):
+
+    # One rule per key, or per key and subkey, of the ideal config file
+    rules = get_ideal_config_rules(idealConfig)
+
+    return plan_drift_query(rules, CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP, partition_filter)
+
+def get_ideal_config_rules(idealConfig):
+
+    rules = []
 
     # Gets top level key, usually "common" for our use case. Use different top-level keys to
     # auto-build queries using a different builder function.
@@ -61,78 +313,314 @@ def compare_with_ideal_config(idealConfig, CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETT
         # just a string : value
         for key, subkey_or_value in idealConfig[category].items():
             #subkey_or_value is either the subkey or value, depending on the case below
-            if isinstance(subkey_or_value, str):
+            if isinstance(subkey_or_value, (str, list)):
                 #subkey_or_value is the value in this block
-                # builds the query using the keys and values found when parsing
-                # adds query to a list to be concatenated later
-                query = build_query(key, None, subkey_or_value, CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP)
-                query_list.append(query)
+                rules.append(build_rule(key, None, subkey_or_value))
 
             elif isinstance(subkey_or_value, dict):
                 #subkey_or_value is subkey in this block
                 # json looks like string : {string, value} so this for loop parses that
                 for subkey, value in idealConfig[category][key].items():
-                    # same as above loop
-                    query = build_query(key, subkey, value, CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP)
-                    query_list.append(query)
-
-    # need the length of the list because we can't loop through and add UNION to every query_list
-    # because the last query in the list will not need UNION at the end
-    list_length = len(query_list)
-    counter = 0
-    # concatenates queries and adds UNION in between
-    while counter < list_length:
-        aggregated_query += query_list[counter]
-        if counter != list_length - 1:
-            aggregated_query+= " UNION "
-        counter += 1
-
-    return aggregated_query
-
-def build_query(key, subkey, value, CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP):
-    if "{condition:" in value:
-        #<set condition to specified value in ideal config file>
-    elif isinstance(value, list):
-        condition = " NOT IN "
-    else:
-        condition = "!=" #default conditional
+                    rules.append(build_rule(key, subkey, value))
+
+    return rules
+
+def build_rule(key, subkey, value):
+    # A rule matches the inventory rows of key (and subkey) whose value is misconfigured, that is
+    # rows where "value <condition> <value of the rule>" is true
+    expected = ', '.join(value) if isinstance(value, list) else value
+    subkeyCondition = None
 
-    if "{*}" in value: #used as wildcard in ideal config file
+    if isinstance(value, list):
+        condition = " NOT IN "
+    elif value.startswith("{condition:"):
+        # {condition:<operator>}<value>, for example {condition:<}10 for values lower than 10
+        operator, _, value = value[len("{condition:"):].partition("}")
+        if operator.strip().upper() not in CUSTOM_CONDITIONS:
+            raise ValueError("Unsupported condition {} for key {}".format(operator, key))
+        condition = " {} ".format(operator.strip().upper())
+    elif "{*}" in value: #used as wildcard in ideal config file
         value = value.replace("{*}", "%")
         condition = " NOT LIKE "
+    else:
+        condition = "!=" #default conditional
 
     if subkey:
-        if "{*}" in value:
-            value = value.replace("{*}", "%")
-            condition = " NOT LIKE "
-
-        if "{*}" in subkey:
+        if "{*}" in subkey: #"{*}" alone indicates "for any subkey, value should be..."
             subkey = subkey.replace("{*}", "%")
             subkeyCondition = " LIKE "
         else:
             subkeyCondition = "="
-        if subkey == '{*}': #use indicates "for any subkey, value should be..."
-            subkey = None
-
-    #append the correct query statement based on values provided
-    if subkey is None and not isinstance(value, list):
-        # print("entered")
-        query = "SELECT * FROM \"paas-config-mgmt\".\"{}\" WHERE settingsgroup='{}' AND key='{}' AND value{}'{}'".format(
-         CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP, key, condition, value
-         )
-    elif subkey is None and isinstance(value, list):
-        query = "SELECT * FROM \"paas-config-mgmt\".\"{}\" WHERE settingsgroup='{}' AND key='{}' AND value {} (".format(
-         CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP, key, condition
-         )
-        query += ', '.join(map(lambda x: "'" + x + "'", value)) + ")"
-    elif subkey is not None and isinstance(value, list):
-        query = "SELECT * FROM \"paas-config-mgmt\".\"{}\" WHERE settingsgroup='{}' AND key='{}' AND subkey{}'{}' AND value{} (".format(
-             CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP, key, subkeyCondition, subkey, condition
-             )
-        query += ', '.join(map(lambda x: "'" + x + "'", value)) + ")"
+
+    return {'key': key, 'subkey': subkey, 'subkeyCondition': subkeyCondition, 'condition': condition,
+            'value': value, 'expected': expected}
+
+def sql_escape(value):
+    return value.replace("'", "''")
+
+def sql_string(value):
+    return "'{}'".format(sql_escape(value)) if value is not None else "CAST(NULL AS varchar)"
+
+def plan_drift_query(rules, CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP, partition_filter=None):
+    # Builds a single query for all the rules, instead of one SELECT * per rule joined with UNION:
+    # * the inventory table is read once per kind of condition (!=, NOT LIKE, NOT IN, custom operators) instead
+    #   of once per rule, by joining it with the rules of that condition as an inline VALUES table
+    # * only DRIFT_QUERY_COLUMNS are read
+    # * the settingsgroup filter is a literal on the table, so that Athena prunes the other partitions if the
+    #   table is partitioned by settingsgroup. partition_filter adds a predicate on other partition columns,
+    #   for example "dt = '2023-06-01'"
+    # * the branches are joined with UNION ALL, there are no duplicates to remove. Each row of the result is an
+    #   inventory row and the expected value of the rule it does not satisfy
+    if not rules:
+        return ""
+
+    groups = {}
+    for rule in rules:
+        groups.setdefault(rule['condition'], []).append(rule)
+
+    where = "settingsgroup = '{}'".format(sql_escape(CONFIG_SETTINGS_GROUP))
+    if partition_filter:
+        where += " AND ({})".format(partition_filter)
+    query = "WITH inventory AS (SELECT {} FROM \"paas-config-mgmt\".\"{}\" WHERE {})".format(
+        ', '.join(DRIFT_QUERY_COLUMNS), CONFIG_MGMT_ATHENA_TABLE, where)
+
+    branches = []
+    for condition, group in groups.items():
+        rows = []
+        for rule in group:
+            if isinstance(rule['value'], list):
+                value = "ARRAY[{}]".format(', '.join(map(sql_string, rule['value'])))
+            else:
+                value = sql_string(rule['value'])
+            rows.append("({}, {}, {}, {}, {})".format(
+                sql_string(rule['key']), sql_string((rule['subkeyCondition'] or 'any').strip()),
+                sql_string(rule['subkey']), value, sql_string(rule['expected'])))
+
+        # Only the subkey conditions used by the rules of the group
+        subkey_conditions = []
+        for subkeyCondition, predicate in [(None, "e.subkeycondition = 'any'"),
+                                           ("=", "(e.subkeycondition = '=' AND i.subkey = e.subkey)"),
+                                           (" LIKE ", "(e.subkeycondition = 'LIKE' AND i.subkey LIKE e.subkey)")]:
+            if any(rule['subkeyCondition'] == subkeyCondition for rule in group):
+                subkey_conditions.append(predicate)
+
+        if condition == " NOT IN ":
+            value_condition = "NOT contains(e.value, i.value)"
+        else:
+            value_condition = "i.value{}e.value".format(condition)
+
+        branches.append(
+            "SELECT {}, e.expected FROM inventory i JOIN (VALUES {}) AS e (key, subkeycondition, subkey, value, expected) "
+            "ON i.key = e.key AND ({}) WHERE {}".format(
+                ', '.join('i.' + column for column in DRIFT_QUERY_COLUMNS), ', '.join(rows),
+                ' OR '.join(subkey_conditions), value_condition))
+
+    return query + " " + " UNION ALL ".join(branches)
+
+# In-memory drift engine. It finds the same misconfigurations as the query of plan_drift_query(), as dictionaries
+# of DRIFT_QUERY_COLUMNS and expected, without the latency and minimum scanned bytes of an Athena query.
+
+# Inventory files read at the same time
+INVENTORY_READ_THREADS = int(os.environ.get("INVENTORY_READ_THREADS", "16"))
+
+def like_to_regex(pattern):
+    # LIKE pattern: % matches any sequence of characters, _ any single character, everything else itself
+    return re.compile(''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern), re.DOTALL)
+
+def compile_rule(rule):
+    # Returns (subkey matcher, value matcher) functions of the rule, which are true when the subkey matches the
+    # rule and the value is misconfigured. As in SQL, a missing (NULL) subkey or value never matches a condition.
+    if rule['subkeyCondition'] is None:
+        subkey_matches = lambda subkey: True
+    elif rule['subkeyCondition'] == "=":
+        subkey_matches = lambda subkey, expected=rule['subkey']: subkey == expected
     else:
-        query = "SELECT * FROM \"paas-config-mgmt\".\"{}\" WHERE settingsgroup='{}' AND key='{}' AND subkey{}'{}' AND value{}'{}'".format(
-             CONFIG_MGMT_ATHENA_TABLE, CONFIG_SETTINGS_GROUP, key, subkeyCondition, subkey, condition, value
-             )
+        subkey_matches = lambda subkey, regex=like_to_regex(rule['subkey']): subkey is not None and regex.fullmatch(subkey) is not None
+
+    condition = rule['condition'].strip()
+    value = rule['value']
+    if condition == "NOT IN":
+        accepted = frozenset(value)
+        value_matches = lambda v: v is not None and v not in accepted
+    elif condition in ("LIKE", "NOT LIKE"):
+        regex = like_to_regex(value)
+        negate = condition == "NOT LIKE"
+        value_matches = lambda v: v is not None and (regex.fullmatch(v) is None) == negate
+    else:
+        compare = {
+            "=": lambda v: v == value,
+            "!=": lambda v: v != value,
+            "<>": lambda v: v != value,
+            "<": lambda v: v < value,
+            "<=": lambda v: v <= value,
+            ">": lambda v: v > value,
+            ">=": lambda v: v >= value,
+        }[condition]
+        value_matches = lambda v: v is not None and compare(v)
+
+    return subkey_matches, value_matches
+
+def compile_ideal_config(idealConfig):
+    # The compiled rules by key, built once per ideal file. The regular expressions of the LIKE patterns are
+    # compiled here, not for every inventory row.
+    compiled = {}
+    for rule in get_ideal_config_rules(idealConfig):
+        subkey_matches, value_matches = compile_rule(rule)
+        compiled.setdefault(rule['key'], []).append((subkey_matches, value_matches, rule['expected']))
+    return compiled
+
+def find_misconfigured_rows(compiled, rows, CONFIG_SETTINGS_GROUP):
+    # rows are inventory rows, with their attribute names in any case as in the files of the resource data sync
+    for row in rows:
+        row = {name.lower(): value for name, value in row.items()}
+        if row.get('settingsgroup') != CONFIG_SETTINGS_GROUP:
+            continue
+        for subkey_matches, value_matches, expected in compiled.get(row.get('key'), ()):
+            if subkey_matches(row.get('subkey')) and value_matches(row.get('value')):
+                misconfiguration = {column: row.get(column) for column in DRIFT_QUERY_COLUMNS}
+                misconfiguration['expected'] = expected
+                yield misconfiguration
+
+def read_inventory_rows(lines):
+    # The files of the resource data sync have one JSON document per line
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+def find_misconfigurations_in_memory(compiled, CONFIG_SETTINGS_GROUP, inventory_bucket, inventory_prefix):
+    # compiled are the rules of compile_ideal_config()
+    s3Client = aws_clients.client('s3')
+
+    def check_inventory_file(key):
+        # Streamed line by line, only the misconfigured rows are kept
+        body = s3Client.get_object(Bucket=inventory_bucket, Key=key)['Body']
+        return list(find_misconfigured_rows(compiled, read_inventory_rows(body.iter_lines()), CONFIG_SETTINGS_GROUP))
+
+    keys = (
+        content['Key']
+        for page in s3Client.get_paginator('list_objects_v2').paginate(Bucket=inventory_bucket, Prefix=inventory_prefix)
+        for content in page.get('Contents', [])
+        if content['Key'].endswith('.json')
+    )
+    with ThreadPoolExecutor(max_workers=INVENTORY_READ_THREADS) as executor:
+        for file_misconfigurations in executor.map(check_inventory_file, keys):
+            yield from file_misconfigurations
+
+# Athena query executor. The queries of a drift check run at the same time, so that it takes about as long as its
+# slowest query instead of the sum of all of them.
+
+# Queries running at the same time, keep it below the active DML queries quota of the account
+ATHENA_MAX_CONCURRENT_QUERIES = int(os.environ.get("ATHENA_MAX_CONCURRENT_QUERIES", "5"))
+ATHENA_WORKGROUP = os.environ.get("ATHENA_WORKGROUP", "primary")
+# Required if the workgroup has no query result location
+ATHENA_OUTPUT_LOCATION = os.environ.get("ATHENA_OUTPUT_LOCATION")
+# "true" reads the CSV result files from S3 instead of paging through GetQueryResults, which is faster for large
+# results. The CSV files do not tell empty values from NULL, both are read as None.
+ATHENA_RESULTS_FROM_S3 = os.environ.get("ATHENA_RESULTS_FROM_S3", "false").lower() == "true"
+# Minutes during which Athena returns the results of an earlier run of the same query instead of running it again,
+# 0 to always run it. The results are reused even if the inventory changed since, keep it below the interval of
+# the inventory collection. Needs Athena engine version 3.
+ATHENA_RESULT_REUSE_MINUTES = int(os.environ.get("ATHENA_RESULT_REUSE_MINUTES", "0"))
+# Polling interval of the running queries, increased by half up to the maximum while none of them finishes
+ATHENA_POLL_SECONDS = 0.2
+ATHENA_MAX_POLL_SECONDS = 2
+
+def query_Athena_and_parse_response(query, athenaClient):
+    # The rows of the result of a single query, as dictionaries of column name and value
+    return list(run_Athena_queries([query], athenaClient))
+
+def run_Athena_queries(queries, athenaClient, max_concurrent=None):
+    # Starts the queries, at most max_concurrent (default ATHENA_MAX_CONCURRENT_QUERIES) at a time, polls them
+    # together and yields the rows of each query, as dictionaries of column name and value, as soon as it
+    # succeeds. Raises RuntimeError if a query fails, the queries still running are then stopped.
+    for _, row in iter_Athena_query_results(queries, athenaClient, max_concurrent):
+        yield row
+
+def iter_Athena_query_results(queries, athenaClient, max_concurrent=None):
+    # run_Athena_queries(), yielding the index of the query in queries with each row
+    max_concurrent = max_concurrent or ATHENA_MAX_CONCURRENT_QUERIES
+    pending = [(index, query) for index, query in enumerate(queries) if query]
+    running = []
+    indexes = {}
+    delay = ATHENA_POLL_SECONDS
+
+    def start_next_queries():
+        while pending and len(running) < max_concurrent:
+            index, query = pending.pop(0)
+            queryExecutionId = start_Athena_query(query, athenaClient)
+            indexes[queryExecutionId] = index
+            running.append(queryExecutionId)
+
+    try:
+        while pending or running:
+            start_next_queries()
+
+            # BatchGetQueryExecution accepts up to 50 query execution IDs
+            executions = []
+            for i in range(0, len(running), 50):
+                executions += athenaClient.batch_get_query_execution(QueryExecutionIds=running[i:i + 50])['QueryExecutions']
+
+            succeeded = []
+            for execution in executions:
+                state = execution['Status']['State']
+                if state == 'SUCCEEDED':
+                    succeeded.append(execution)
+                elif state in ('FAILED', 'CANCELLED'):
+                    running.remove(execution['QueryExecutionId'])
+                    raise RuntimeError("Athena query {} {}: {}".format(
+                        execution['QueryExecutionId'], state, execution['Status'].get('StateChangeReason', '')))
+
+            if not succeeded:
+                time.sleep(delay)
+                delay = min(delay * 1.5, ATHENA_MAX_POLL_SECONDS)
+                continue
+
+            delay = ATHENA_POLL_SECONDS
+            for execution in succeeded:
+                running.remove(execution['QueryExecutionId'])
+                if execution.get('Statistics', {}).get('ResultReuseInformation', {}).get('ReusedPreviousResult'):
+                    print("Athena query {} reused the results of an earlier run".format(execution['QueryExecutionId']))
+            # Start the next queries before reading the results, so that they run meanwhile
+            start_next_queries()
+            for execution in succeeded:
+                index = indexes.pop(execution['QueryExecutionId'])
+                if ATHENA_RESULTS_FROM_S3:
+                    rows = read_Athena_results_from_s3(execution['ResultConfiguration']['OutputLocation'])
+                else:
+                    rows = read_Athena_results(execution['QueryExecutionId'], athenaClient)
+                for row in rows:
+                    yield index, row
+    finally:
+        # Only left running if a query failed or the caller stopped reading the rows
+        for queryExecutionId in running:
+            athenaClient.stop_query_execution(QueryExecutionId=queryExecutionId)
+
+def start_Athena_query(query, athenaClient):
+    kwargs = {'QueryString': query, 'WorkGroup': ATHENA_WORKGROUP}
+    if ATHENA_OUTPUT_LOCATION:
+        kwargs['ResultConfiguration'] = {'OutputLocation': ATHENA_OUTPUT_LOCATION}
+    if ATHENA_RESULT_REUSE_MINUTES > 0:
+        kwargs['ResultReuseConfiguration'] = {
+            'ResultReuseByAgeConfiguration': {'Enabled': True, 'MaxAgeInMinutes': ATHENA_RESULT_REUSE_MINUTES}}
+    return athenaClient.start_query_execution(**kwargs)['QueryExecutionId']
+
+def read_Athena_results(queryExecutionId, athenaClient):
+    # Pages of up to 1000 rows, the first row of the first page has the column names. A NULL has no VarCharValue.
+    columns = None
+    for page in athenaClient.get_paginator('get_query_results').paginate(
+            QueryExecutionId=queryExecutionId, PaginationConfig={'PageSize': 1000}):
+        rows = page['ResultSet']['Rows']
+        if columns is None:
+            columns = [column['Name'] for column in page['ResultSet']['ResultSetMetadata']['ColumnInfo']]
+            rows = rows[1:]
+        for row in rows:
+            yield {column: data.get('VarCharValue') for column, data in zip(columns, row['Data'])}
 
-    return query
+def read_Athena_results_from_s3(outputLocation):
+    # s3://<bucket>/<key>.csv, streamed line by line
+    bucket, _, key = outputLocation[len("s3://"):].partition("/")
+    body = aws_clients.client('s3').get_object(Bucket=bucket, Key=key)['Body']
+    reader = csv.reader(codecs.getreader('utf-8')(body))
+    columns = next(reader, None)
+    for row in reader:
+        yield {column: value if value != '' else None for column, value in zip(columns, row)}
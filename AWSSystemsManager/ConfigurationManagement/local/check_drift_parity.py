@@ -0,0 +1,101 @@
+import glob
+import json
+import os
+import sys
+
+# Checks that the in-memory drift engine finds the same misconfigurations as
+# the Athena drift query, on the ideal config file and inventory files in
+# local/fixtures. The inventory files have the format of the SSM resource
+# data sync, one JSON document per line. The query runs on DuckDB, as a
+# local stand-in for Athena, when duckdb is installed.
+#
+# Usage:
+#   python3 local/check_drift_parity.py
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+import configurationManagementExampleLambda as lambda_function  # noqa: E402
+
+fixtures_dir = os.path.join(here, 'fixtures')
+table = 'inventory'
+settings_group = 'webservers'
+
+# The misconfigurations of the fixtures, as (resourceid, key, subkey, value)
+expected_misconfigurations = {
+    ('i-0aaaaaaaaaaaaaaa1', 'sshd', 'PermitRootLogin', 'yes'),
+    ('i-0aaaaaaaaaaaaaaa1', 'limits', 'nofile', '1024'),
+    ('i-0aaaaaaaaaaaaaaa1', 'mounts', '/data/logs', 'xfs'),
+    ('i-0bbbbbbbbbbbbbbb2', 'ntpServer', None, 'pool.ntp.org'),
+    ('i-0bbbbbbbbbbbbbbb2', 'logLevel', None, 'error'),
+    ('i-0bbbbbbbbbbbbbbb2', 'tlsVersion', None, 'TLSv1.0'),
+    # {condition:<}100 flags the values that compare lower, as strings
+    ('i-0bbbbbbbbbbbbbbb2', 'maxConnections', None, '050'),
+    ('i-0bbbbbbbbbbbbbbb2', 'banner', None, 'Its 100 managed'),
+}
+
+
+def as_set(misconfigurations):
+    return {tuple(misconfiguration[column] for column in
+                  lambda_function.DRIFT_QUERY_COLUMNS + ['expected'])
+            for misconfiguration in misconfigurations}
+
+
+def run_memory_engine(ideal_config, paths):
+    compiled = lambda_function.compile_ideal_config(ideal_config)
+    misconfigurations = []
+    for path in paths:
+        with open(path) as f:
+            misconfigurations += lambda_function.find_misconfigured_rows(
+                compiled, lambda_function.read_inventory_rows(f),
+                settings_group)
+    return misconfigurations
+
+
+def run_drift_query(ideal_config, paths):
+    import duckdb
+    connection = duckdb.connect()
+    connection.sql('CREATE SCHEMA "paas-config-mgmt"')
+    # Athena column names are lower case
+    connection.sql(
+        'CREATE VIEW "paas-config-mgmt"."{}" AS SELECT resourceId AS '
+        'resourceid, captureTime AS capturetime, settingsgroup, key, subkey, '
+        'value FROM read_json([{}], format = \'newline_delimited\', columns = '
+        "{{resourceId: 'VARCHAR', captureTime: 'VARCHAR', settingsgroup: "
+        "'VARCHAR', key: 'VARCHAR', subkey: 'VARCHAR', value: 'VARCHAR'}})"
+        .format(table, ', '.join("'{}'".format(path) for path in paths)))
+    query = lambda_function.compare_with_ideal_config(
+        ideal_config, table, settings_group)
+    result = connection.sql(query)
+    return [dict(zip(result.columns, row)) for row in result.fetchall()]
+
+
+def main():
+    with open(os.path.join(fixtures_dir, 'idealConfig.json')) as f:
+        ideal_config = json.load(f)
+    paths = sorted(glob.glob(os.path.join(fixtures_dir, 'inventory', '*.json')))
+
+    memory = run_memory_engine(ideal_config, paths)
+    found = {(m['resourceid'], m['key'], m['subkey'], m['value'])
+             for m in memory}
+    if found != expected_misconfigurations or len(memory) != len(found):
+        print('The in-memory engine found {}, expected {}'.format(
+            sorted(found, key=str), sorted(expected_misconfigurations, key=str)))
+        sys.exit(1)
+    print('in-memory engine: {} misconfigurations'.format(len(memory)))
+
+    try:
+        query = run_drift_query(ideal_config, paths)
+    except ImportError:
+        print('duckdb is not installed, skipping the drift query')
+        return
+    if as_set(query) != as_set(memory) or len(query) != len(memory):
+        print('The drift query returned different rows:')
+        for row in sorted(as_set(query) ^ as_set(memory), key=str):
+            print('  {}'.format(row))
+        sys.exit(1)
+    print('drift query: same {} misconfigurations'.format(len(query)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import glob
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import duckdb
+
+# Runs the incremental drift detection three times on the inventory files in
+# local/fixtures, with DuckDB as a local stand-in for Athena, and checks the
+# changes it reports:
+# 1. without state, every misconfiguration is reported as drifted
+# 2. after one instance is captured again with one setting fixed and one
+#    changed, only its changes are reported
+# 3. without new captures, nothing is reported
+# 4. after the other instance left the inventory, its misconfigurations are
+#    reported as remediated
+#
+# Usage:
+#   python3 local/check_incremental_drift.py
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+os.environ['IDEAL_FILE_S3_BUCKET'] = 'ideal-config'
+
+import aws_clients  # noqa: E402
+import configurationManagementExampleLambda as lambda_function  # noqa: E402
+
+fixtures_dir = os.path.join(here, 'fixtures')
+table = 'inventory'
+settings_group = 'webservers'
+
+
+class LocalAthena(object):
+    # The calls of the Athena API used by run_Athena_queries(), the queries
+    # run on DuckDB when they are started
+
+    def __init__(self, inventory_dir):
+        self.connection = duckdb.connect()
+        self.connection.sql('CREATE SCHEMA "paas-config-mgmt"')
+        self.connection.sql(
+            'CREATE VIEW "paas-config-mgmt"."{}" AS SELECT resourceId AS '
+            'resourceid, captureTime AS capturetime, settingsgroup, key, '
+            'subkey, value FROM read_json(\'{}/*.json\', format = '
+            "'newline_delimited', columns = {{resourceId: 'VARCHAR', "
+            "captureTime: 'VARCHAR', settingsgroup: 'VARCHAR', key: "
+            "'VARCHAR', subkey: 'VARCHAR', value: 'VARCHAR'}})".format(
+                table, inventory_dir))
+        self.results = {}
+
+    def start_query_execution(self, QueryString, WorkGroup, **kwargs):
+        result = self.connection.sql(QueryString)
+        query_id = 'q{}'.format(len(self.results))
+        self.results[query_id] = (result.columns, result.fetchall())
+        return {'QueryExecutionId': query_id}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        return {'QueryExecutions': [
+            {'QueryExecutionId': query_id, 'Status': {'State': 'SUCCEEDED'}}
+            for query_id in QueryExecutionIds]}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, QueryExecutionId, PaginationConfig):
+        columns, rows = self.results[QueryExecutionId]
+        yield {'ResultSet': {
+            'ResultSetMetadata': {'ColumnInfo': [{'Name': name}
+                                                 for name in columns]},
+            'Rows': [{'Data': [{'VarCharValue': name} for name in columns]}] +
+                    [{'Data': [{} if value is None else
+                               {'VarCharValue': str(value)}
+                               for value in row]} for row in rows]}}
+
+    def stop_query_execution(self, QueryExecutionId):
+        pass
+
+
+class LocalIdealConfigFile(object):
+    # The S3 object of the ideal config file, see get_ideal_config()
+
+    def get(self, **kwargs):
+        with open(os.path.join(fixtures_dir, 'idealConfig.json'), 'rb') as f:
+            return {'ETag': '"fixture"', 'Body': io.BytesIO(f.read())}
+
+
+class LocalS3(object):
+
+    class meta(object):
+        class client(object):
+            class exceptions(object):
+                class ClientError(Exception):
+                    pass
+
+    def Object(self, bucket, key):
+        return LocalIdealConfigFile()
+
+
+def run(state_store):
+    deltas, state = lambda_function.get_drift_deltas(
+        state_store.load(), 'idealConfig.json', settings_group, table, [])
+    state_store.save(state)
+    return {(delta['drift'], delta['resourceid'], delta['key'], delta['value'])
+            for delta in deltas}
+
+
+def check(name, found, expected):
+    if found != expected:
+        print('{}: reported {}, expected {}'.format(
+            name, sorted(found, key=str), sorted(expected, key=str)))
+        sys.exit(1)
+    print('{}: {} changes reported'.format(name, len(found)))
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        inventory_dir = os.path.join(directory, 'inventory')
+        shutil.copytree(os.path.join(fixtures_dir, 'inventory'), inventory_dir)
+        aws_clients.clients[('athena', None, None)] = LocalAthena(inventory_dir)
+        aws_clients.resources[('s3', None, None)] = LocalS3()
+        state_store = lambda_function.LocalFileStateStore(
+            os.path.join(directory, 'state.json'))
+
+        found = run(state_store)
+        if {delta[0] for delta in found} != {'drifted'} or len(found) != 8:
+            print('full run: reported {}, expected 8 drifted'.format(
+                sorted(found, key=str)))
+            sys.exit(1)
+        print('full run: {} changes reported'.format(len(found)))
+
+        # The second instance is captured again, with ntpServer fixed and
+        # another wrong logLevel
+        path = glob.glob(os.path.join(inventory_dir, 'i-0bbb*.json'))[0]
+        with open(path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        with open(path, 'w') as f:
+            for row in rows:
+                row['captureTime'] = '2023-06-01T01:00:00Z'
+                if row['key'] == 'ntpServer' and row['value']:
+                    row['value'] = 'time.example.com'
+                if row['key'] == 'logLevel':
+                    row['value'] = 'debug'
+                f.write(json.dumps(row) + '\n')
+
+        check('incremental run', run(state_store), {
+            ('remediated', 'i-0bbbbbbbbbbbbbbb2', 'ntpServer', 'pool.ntp.org'),
+            ('remediated', 'i-0bbbbbbbbbbbbbbb2', 'logLevel', 'error'),
+            ('drifted', 'i-0bbbbbbbbbbbbbbb2', 'logLevel', 'debug'),
+        })
+        check('unchanged run', run(state_store), set())
+        state = state_store.load()
+        if state['highWaterMark'] != '2023-06-01T01:00:00Z' or \
+                len(state['open']) != 7:
+            print('unexpected state: {}'.format(state))
+            sys.exit(1)
+
+        # The first instance is terminated
+        os.remove(glob.glob(os.path.join(inventory_dir, 'i-0aaa*.json'))[0])
+        check('run after an instance left', run(state_store), {
+            ('remediated', 'i-0aaaaaaaaaaaaaaa1', 'sshd', 'yes'),
+            ('remediated', 'i-0aaaaaaaaaaaaaaa1', 'limits', '1024'),
+            ('remediated', 'i-0aaaaaaaaaaaaaaa1', 'mounts', 'xfs'),
+        })
+
+
+if __name__ == '__main__':
+    main()
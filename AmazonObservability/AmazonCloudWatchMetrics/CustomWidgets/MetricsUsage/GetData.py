@@ -1,31 +1,448 @@
+import argparse
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
 import boto3
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
-def get_total_metrics_count():
+# Namespaces counted at the same time. ListMetrics is limited to 25 requests
+# per second per account and region, keep it well below that.
+MAX_WORKERS = 8
+
+# CloudWatch has no API to list namespaces. They are found by one walk of all
+# the metrics of a region, which also counts them, and kept for
+# NAMESPACE_CACHE_TTL seconds. Until then, the known namespaces are counted in
+# parallel, and new namespaces are discovered from the metrics with data points
+# in the last 3 hours.
+NAMESPACE_CACHE_TTL = int(os.environ.get('NAMESPACE_CACHE_TTL', '86400'))
+DISCOVERY_RECENTLY_ACTIVE = 'PT3H'
+
+# The namespaces found by the last walk of each region, by region name: (time
+# of the walk, namespaces)
+namespace_cache = {}
+
+def get_cached_namespaces(region_name):
+    cached = namespace_cache.get(region_name)
+    if cached and time.time() - cached[0] < NAMESPACE_CACHE_TTL:
+        return cached[1]
+    return None
+
+def get_client(region=None, max_workers=MAX_WORKERS):
+    # Adaptive retries slow the threads down when ListMetrics is throttled
+    config = Config(
+        max_pool_connections=max_workers,
+        retries={'mode': 'adaptive', 'max_attempts': 10}
+    )
+    return boto3.client('cloudwatch', region_name=region, config=config)
+
+class MetricsCounter:
+    # Counts the metrics of every namespace and region, keeping only the counts,
+    # never the Metrics of the pages
+    def __init__(self, clients, max_workers=MAX_WORKERS):
+        self.clients = clients
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.api_calls = 0
+
+    def paginate(self, region, **kwargs):
+        for page in self.clients[region].get_paginator('list_metrics').paginate(**kwargs):
+            with self.lock:
+                self.api_calls += 1
+            yield page
+
+    def discover_namespaces(self, region, executor, futures, task):
+        # Each namespace is counted as soon as it is discovered, while the
+        # discovery goes on
+        for page in self.paginate(region, RecentlyActive=DISCOVERY_RECENTLY_ACTIVE):
+            for namespace in {metric['Namespace'] for metric in page['Metrics']}:
+                self.submit(region, namespace, executor, futures, task)
+
+    def submit(self, region, namespace, executor, futures, task):
+        with self.lock:
+            if (region, namespace) not in futures:
+                futures[(region, namespace)] = executor.submit(task, region, namespace)
+
+    def count_namespace(self, region, namespace):
+        count = 0
+        for page in self.paginate(region, Namespace=namespace):
+            count += len(page['Metrics'])
+        return count
+
+    def walk_region(self, region):
+        # Counts the metrics of every namespace of a region in one walk of all
+        # its metrics, and caches the namespaces found
+        counts = {}
+        for page in self.paginate(region):
+            for metric in page['Metrics']:
+                counts[metric['Namespace']] = counts.get(metric['Namespace'], 0) + 1
+        namespace_cache[self.clients[region].meta.region_name] = (time.time(), set(counts))
+        return counts
+
+    def run(self, task, namespaces, discover=()):
+        # Runs task(region, namespace) for each of namespaces, by region, and
+        # each namespace discovered from the recently active metrics of the
+        # regions in discover, and returns its results by (region, namespace)
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for region, region_namespaces in namespaces.items():
+                for namespace in region_namespaces:
+                    self.submit(region, namespace, executor, futures, task)
+            discoveries = [executor.submit(self.discover_namespaces, region, executor, futures, task) for region in discover]
+            for discovery in discoveries:
+                discovery.result()
+            return {key: future.result() for key, future in list(futures.items())}
+
+    def count(self, namespaces=None, recently_active=False):
+        # namespaces: the namespaces to count in every region. Otherwise the
+        # cached namespaces are counted in parallel, or all the metrics of the
+        # region are walked once when there are none. With recently_active,
+        # only the namespaces with recently active metrics are counted when
+        # there are no cached namespaces, which misses the idle namespaces.
+        started = time.perf_counter()
+        known = {}
+        walked = []
+        for region, client in self.clients.items():
+            cached = get_cached_namespaces(client.meta.region_name)
+            if namespaces:
+                known[region] = namespaces
+            elif cached is not None or recently_active:
+                known[region] = cached or set()
+            else:
+                walked.append(region)
+
+        with ThreadPoolExecutor(max_workers=max(len(walked), 1)) as executor:
+            walks = {region: executor.submit(self.walk_region, region) for region in walked}
+            counts = self.run(self.count_namespace, known, discover=[] if namespaces else list(known))
+            for region, walk in walks.items():
+                counts.update(((region, namespace), count) for namespace, count in walk.result().items())
+
+        # The namespaces discovered since the walk
+        for region in known:
+            cached = namespace_cache.get(self.clients[region].meta.region_name)
+            if cached and not namespaces:
+                cached[1].update(namespace for key_region, namespace in counts if key_region == region)
+
+        by_region = {}
+        by_namespace = {}
+        by_region_namespace = {}
+        for (region, namespace), count in counts.items():
+            name = self.clients[region].meta.region_name
+            by_region[name] = by_region.get(name, 0) + count
+            by_namespace[namespace] = by_namespace.get(namespace, 0) + count
+            by_region_namespace.setdefault(name, {})[namespace] = count
+
+        return {
+            'total': sum(counts.values()),
+            'by_region': by_region,
+            'by_namespace': by_namespace,
+            'by_region_namespace': by_region_namespace,
+            'api_calls': self.api_calls,
+            'seconds': round(time.perf_counter() - started, 3)
+        }
+
+def count_metrics(regions=None, namespaces=None, max_workers=MAX_WORKERS, client_factory=get_client, recently_active=False):
+    # regions defaults to the region of the session. namespaces defaults to all
+    # the namespaces of each region, see MetricsCounter.count().
+    # client_factory(region, max_workers) returns the CloudWatch client of a
+    # region, for example a local stub.
+    clients = {region: client_factory(region, max_workers) for region in regions or [None]}
+    return MetricsCounter(clients, max_workers).count(namespaces, recently_active)
+
+# Metrics inventory snapshot
+#
+# The counts of metrics per region, namespace and dimension key are kept in a
+# snapshot, a JSON file or S3 object, so that the widget renders from it
+# without listing the metrics. The widget never refreshes it: run
+# refresh_snapshot_if_due() on a schedule, or GetData.py --snapshot <location>
+# --refresh, separately from the widget. It is refreshed with the metrics that
+# had data points in the last 3 hours, which adds the new ones, and rescanned
+# in full less often, with a walk of all the metrics of each region, which
+# also finds the idle namespaces and drops the metrics that CloudWatch does not
+# list anymore. Each metric is kept as an 8 byte digest of its namespace, name and
+# dimensions, in a second file or object next to the counts, to tell the new
+# metrics from the known ones.
+
+# Seconds the snapshot is used from memory before it is read again
+SNAPSHOT_CACHE_TTL = int(os.environ.get('SNAPSHOT_CACHE_TTL', '300'))
+# Seconds between refreshes with the recently active metrics. Keep it below
+# the 3 hours of RecentlyActive, or new metrics may be missed until the next
+# full rescan.
+SNAPSHOT_REFRESH_INTERVAL = int(os.environ.get('SNAPSHOT_REFRESH_INTERVAL', '3600'))
+# Seconds between full rescans
+SNAPSHOT_FULL_RESCAN_INTERVAL = int(os.environ.get('SNAPSHOT_FULL_RESCAN_INTERVAL', '86400'))
+REFRESH_RECENTLY_ACTIVE = 'PT3H'
+
+# Snapshots read from their location, by location: (time read, snapshot)
+snapshot_cache = {}
+
+def get_metric_digest(metric):
+    dimensions = sorted((d['Name'], d['Value']) for d in metric.get('Dimensions', []))
+    key = json.dumps([metric['Namespace'], metric['MetricName'], dimensions])
+    return hashlib.blake2b(key.encode(), digest_size=8).digest()
+
+def read_location(location):
+    # location is a local path or s3://bucket/key. Returns None if it does not exist.
+    if location.startswith('s3://'):
+        bucket, _, key = location[len('s3://'):].partition('/')
+        s3 = boto3.client('s3')
+        try:
+            return s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+        except s3.exceptions.NoSuchKey:
+            return None
     try:
-        # Create CloudWatch client
-        cloudwatch = boto3.client('cloudwatch')
-        
-        # List all metrics with pagination
-        paginator = cloudwatch.get_paginator('list_metrics')
-        
-        total_metrics = 0
-        
-        # Iterate through all pages
-        for page in paginator.paginate():
-            metrics = page['Metrics']
-            total_metrics += len(metrics)
-            
-        return total_metrics
-        
+        with open(location, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def write_location(location, data):
+    if location.startswith('s3://'):
+        bucket, _, key = location[len('s3://'):].partition('/')
+        boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=data)
+        return
+    # Written to a temporary file first, so that readers never see half of it
+    with open(location + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(location + '.tmp', location)
+
+class MetricsInventory:
+    # The metrics of each region and namespace: their count, the count per
+    # dimension key, and their digests
+    def __init__(self, regions=None):
+        self.regions = regions or {}
+        self.lock = threading.Lock()
+
+    def get_namespace(self, region, namespace):
+        with self.lock:
+            return self.regions.setdefault(region, {}).setdefault(
+                namespace, {'metrics': 0, 'dimension_keys': {}, 'digests': set()})
+
+    def add(self, region, metric):
+        # Returns True if the metric is new
+        stats = self.get_namespace(region, metric['Namespace'])
+        digest = get_metric_digest(metric)
+        if digest in stats['digests']:
+            return False
+        stats['digests'].add(digest)
+        stats['metrics'] += 1
+        for dimension in metric.get('Dimensions', []):
+            stats['dimension_keys'][dimension['Name']] = stats['dimension_keys'].get(dimension['Name'], 0) + 1
+        return True
+
+    def get_counts(self):
+        return {
+            region: {
+                namespace: {'metrics': stats['metrics'], 'dimension_keys': stats['dimension_keys']}
+                for namespace, stats in namespaces.items()
+            }
+            for region, namespaces in self.regions.items()
+        }
+
+    def dump_digests(self):
+        return json.dumps({
+            region: {
+                namespace: base64.b64encode(b''.join(sorted(stats['digests']))).decode()
+                for namespace, stats in namespaces.items()
+            }
+            for region, namespaces in self.regions.items()
+        }).encode()
+
+    @classmethod
+    def load(cls, counts, digests):
+        digests = json.loads(digests) if digests else {}
+        regions = {}
+        for region, namespaces in counts.items():
+            for namespace, stats in namespaces.items():
+                packed = base64.b64decode(digests.get(region, {}).get(namespace, ''))
+                regions.setdefault(region, {})[namespace] = {
+                    'metrics': stats['metrics'],
+                    'dimension_keys': dict(stats['dimension_keys']),
+                    'digests': {packed[i:i + 8] for i in range(0, len(packed), 8)}
+                }
+        return cls(regions)
+
+def scan_metrics(counter, inventory, region, **kwargs):
+    # Adds the metrics listed with kwargs to inventory and returns the number of new ones
+    name = counter.clients[region].meta.region_name
+    new_metrics = 0
+    for page in counter.paginate(region, **kwargs):
+        for metric in page['Metrics']:
+            new_metrics += inventory.add(name, metric)
+    return new_metrics
+
+def refresh_snapshot(location, snapshot, regions=None, max_workers=MAX_WORKERS, client_factory=get_client, full=False):
+    # Rescans every namespace when full or there is no snapshot yet, otherwise
+    # only adds the metrics with data points in the last 3 hours. Writes the
+    # snapshot and returns it.
+    started = time.perf_counter()
+    clients = {region: client_factory(region, max_workers) for region in regions or [None]}
+    counter = MetricsCounter(clients, max_workers)
+    digests = None if full or snapshot is None else read_location(location + '.digests')
+    # Without the digests, the known metrics would be counted again
+    full = digests is None
+
+    if full:
+        inventory = MetricsInventory()
+        # One walk of all the metrics per region, the regions in parallel
+        kwargs = {}
+    else:
+        inventory = MetricsInventory.load(snapshot['regions'], digests)
+        # One walk of the recently active metrics per region, also finds the
+        # new namespaces
+        kwargs = {'RecentlyActive': REFRESH_RECENTLY_ACTIVE}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = dict(zip(clients, executor.map(
+            lambda region: scan_metrics(counter, inventory, region, **kwargs), clients)))
+
+    now = time.time()
+    snapshot = {
+        'regions': inventory.get_counts(),
+        'refreshed_at': now,
+        'full_scan_at': now if full else snapshot['full_scan_at'],
+        'last_refresh': {
+            'mode': 'full' if full else 'incremental',
+            'api_calls': counter.api_calls,
+            'new_metrics': sum(results.values()),
+            'seconds': round(time.perf_counter() - started, 3)
+        }
+    }
+    write_location(location + '.digests', inventory.dump_digests())
+    write_location(location, json.dumps(snapshot).encode())
+    snapshot_cache[location] = (time.time(), snapshot)
+    return snapshot
+
+def read_snapshot(location):
+    data = read_location(location)
+    return json.loads(data) if data else None
+
+def get_snapshot(location):
+    # The snapshot at location, from memory for SNAPSHOT_CACHE_TTL seconds.
+    # None if there is no snapshot yet. Never lists the metrics.
+    cached = snapshot_cache.get(location)
+    if cached and time.time() - cached[0] < SNAPSHOT_CACHE_TTL:
+        return cached[1]
+
+    snapshot = read_snapshot(location)
+    if snapshot is not None:
+        snapshot_cache[location] = (time.time(), snapshot)
+    return snapshot
+
+def get_due_refresh(snapshot):
+    # 'full', 'incremental' or None
+    if snapshot is None or time.time() - snapshot['full_scan_at'] >= SNAPSHOT_FULL_RESCAN_INTERVAL:
+        return 'full'
+    if time.time() - snapshot['refreshed_at'] >= SNAPSHOT_REFRESH_INTERVAL:
+        return 'incremental'
+    return None
+
+def refresh_snapshot_if_due(location, regions=None, max_workers=MAX_WORKERS, client_factory=get_client, full=False):
+    # Refreshes the snapshot at location if it is older than
+    # SNAPSHOT_REFRESH_INTERVAL, or rescans it in full if its last full scan is
+    # older than SNAPSHOT_FULL_RESCAN_INTERVAL. Run it on a schedule, outside
+    # of the widget. Returns the snapshot.
+    snapshot = read_snapshot(location)
+    due = 'full' if full else get_due_refresh(snapshot)
+    if due is None:
+        return snapshot
+    return refresh_snapshot(location, snapshot, regions, max_workers, client_factory, due == 'full')
+
+def get_metrics_usage(location):
+    # The counts of the snapshot, with its age and the cost of its last
+    # refresh, without listing the metrics. The total is None if there is no
+    # snapshot yet.
+    started = time.perf_counter()
+    snapshot = get_snapshot(location)
+    if snapshot is None:
+        return {
+            'total': None,
+            'refresh_due': 'full',
+            'seconds': round(time.perf_counter() - started, 3)
+        }
+
+    by_region = {}
+    by_namespace = {}
+    by_dimension_key = {}
+    for region, namespaces in snapshot['regions'].items():
+        by_region[region] = sum(stats['metrics'] for stats in namespaces.values())
+        for namespace, stats in namespaces.items():
+            by_namespace[namespace] = by_namespace.get(namespace, 0) + stats['metrics']
+            for key, count in stats['dimension_keys'].items():
+                by_dimension_key[key] = by_dimension_key.get(key, 0) + count
+
+    return {
+        'total': sum(by_region.values()),
+        'by_region': by_region,
+        'by_namespace': by_namespace,
+        'by_dimension_key': by_dimension_key,
+        'snapshot_age_seconds': round(time.time() - snapshot['refreshed_at']),
+        'full_scan_age_seconds': round(time.time() - snapshot['full_scan_at']),
+        'last_refresh': snapshot['last_refresh'],
+        'refresh_due': get_due_refresh(snapshot),
+        'seconds': round(time.perf_counter() - started, 3)
+    }
+
+def get_total_metrics_count(regions=None, namespaces=None, max_workers=MAX_WORKERS):
+    try:
+        return count_metrics(regions, namespaces, max_workers)['total']
+
     except Exception as e:
         print(f"Error occurred: {str(e)}")
         return None
 
 def main():
-    count = get_total_metrics_count()
-    if count is not None:
-        print(f"Total number of metrics: {count}")
+    parser = argparse.ArgumentParser(description='Count the CloudWatch metrics per namespace and region')
+    parser.add_argument('--regions', help='comma separated regions, default the region of the session')
+    parser.add_argument('--namespaces', help='comma separated namespaces, default all the namespaces')
+    parser.add_argument('--recently-active', action='store_true', help='only count the namespaces with metrics active in the last 3 hours, instead of walking all the metrics once to find the namespaces')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help=f'namespaces counted at the same time, default {MAX_WORKERS}')
+    parser.add_argument('--snapshot', help='read the counts from the snapshot at this path or s3://bucket/key')
+    parser.add_argument('--refresh', action='store_true', help='refresh the snapshot first, if it is older than SNAPSHOT_REFRESH_INTERVAL')
+    parser.add_argument('--full', action='store_true', help='with --refresh, rescan all the metrics')
+    args = parser.parse_args()
+    regions = args.regions.split(',') if args.regions else None
+
+    try:
+        if args.snapshot:
+            if args.refresh:
+                refresh_snapshot_if_due(args.snapshot, regions, args.workers, full=args.full)
+            result = get_metrics_usage(args.snapshot)
+        else:
+            result = count_metrics(
+                regions,
+                args.namespaces.split(',') if args.namespaces else None,
+                args.workers,
+                recently_active=args.recently_active
+            )
+    except Exception as e:
+        print(f"Error occurred: {str(e)}")
+        return
+
+    if args.snapshot and result['total'] is None:
+        print(f"No snapshot at {args.snapshot} yet, create it with --refresh")
+        return
+    if args.snapshot:
+        print(f"Total number of metrics: {result['total']}")
+        for namespace, count in sorted(result['by_namespace'].items(), key=lambda item: -item[1]):
+            print(f"  {namespace}: {count}")
+        refresh = result['last_refresh']
+        print(f"Snapshot refreshed {result['snapshot_age_seconds']} s ago, fully scanned {result['full_scan_age_seconds']} s ago")
+        print(f"Last refresh: {refresh['mode']}, {refresh['api_calls']} ListMetrics calls in {refresh['seconds']} s, {refresh['new_metrics']} new metrics")
+        if result['refresh_due']:
+            print(f"A {result['refresh_due']} refresh is due")
+        print(f"Read in {result['seconds']} s")
+        return
+
+    print(f"Total number of metrics: {result['total']}")
+    for region, namespaces in sorted(result['by_region_namespace'].items()):
+        print(f"{region}: {result['by_region'][region]}")
+        for namespace, count in sorted(namespaces.items(), key=lambda item: -item[1]):
+            print(f"  {namespace}: {count}")
+    print(f"{result['api_calls']} ListMetrics calls in {result['seconds']} s")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+
+# Compares the serial ListMetrics walk GetData.py used to do with the count
+# per region and namespace, on local stubbed CloudWatch clients where each
+# page of 500 metrics takes 50 ms (scaled by scale):
+# * the first count walks all the metrics of each region once, the regions
+#   in parallel, and caches the namespaces
+# * the next counts count the cached namespaces in parallel
+# One namespace has no metric with data points in the last 3 hours, it must
+# be counted all the same.
+#
+# Usage:
+#   python3 benchmark/benchmark_metrics_count.py [regions] [namespaces] [metrics per namespace] [scale]
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'local'))
+
+import GetData  # noqa: E402
+from stub_cloudwatch import StubCloudWatch, get_stub_client_factory  # noqa: E402
+
+idle = ['Custom/Idle']
+
+def serial_count(clients):
+    # get_total_metrics_count before the namespaces were counted in parallel
+    total = 0
+    for client in clients:
+        for page in client.get_paginator('list_metrics').paginate():
+            total += len(page['Metrics'])
+    return total
+
+def main(region_count, namespace_count, metric_count, scale):
+    regions = ['us-east-1', 'us-west-2', 'eu-west-1', 'ap-southeast-2'][:region_count]
+    # One namespace has most of the metrics, as is common with custom metrics
+    namespaces = {f'Custom/App{n}': metric_count for n in range(namespace_count)}
+    namespaces['Custom/App0'] = metric_count * 4
+    namespaces['Custom/Idle'] = metric_count // 10
+    namespaces_by_region = {region: namespaces for region in regions}
+    latency = 0.05 * scale
+    factory = get_stub_client_factory(namespaces_by_region, latency, idle)
+
+    start = time.perf_counter()
+    expected = serial_count([StubCloudWatch(region, namespaces, latency, idle=idle) for region in regions])
+    serial_seconds = time.perf_counter() - start
+
+    print(f'{len(regions)} regions, {len(namespaces)} namespaces, {expected:,} metrics')
+    print(f'  {"serial":<36} {serial_seconds:>8.2f} s')
+    for workers in (4, 8, 16):
+        GetData.namespace_cache.clear()
+        for name in ('walk, namespaces found', 'cached namespaces'):
+            result = GetData.count_metrics(regions, None, workers, factory)
+            if result['total'] != expected or result['by_region'] != {region: expected // len(regions) for region in regions}:
+                print(f'{name}, {workers} workers: counted {result["total"]}, expected {expected}')
+                sys.exit(1)
+            print(f'  {f"{name}, {workers} workers":<36} {result["seconds"]:>8.2f} s  {result["api_calls"]} ListMetrics calls')
+
+    GetData.namespace_cache.clear()
+    result = GetData.count_metrics(regions, None, 8, factory, recently_active=True)
+    if 'Custom/Idle' in result['by_namespace']:
+        print('The recently active namespaces include the idle namespace')
+        sys.exit(1)
+    print(f'  {"recently active namespaces only":<36} {result["seconds"]:>8.2f} s  {result["total"]:,} metrics, the idle namespace is missed')
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 5000,
+         float(sys.argv[4]) if len(sys.argv) > 4 else 1)
@@ -0,0 +1,83 @@
+import os
+import sys
+import tempfile
+import time
+
+# Measures the metrics inventory snapshot of GetData.py on local stubbed
+# CloudWatch clients, where each page of 500 metrics takes 50 ms (scaled by
+# scale): the reads of the widget, from memory and from the snapshot file,
+# and the refreshes that run separately, the first full scan, an incremental
+# refresh after metrics were added, and a full rescan. One namespace has no
+# metric with data points in the last 3 hours. Checks the counts against a
+# count of all the metrics.
+#
+# Usage:
+#   python3 benchmark/benchmark_snapshot.py [regions] [namespaces] [metrics per namespace] [scale]
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'local'))
+
+import GetData  # noqa: E402
+from stub_cloudwatch import StubCloudWatch, get_stub_client_factory  # noqa: E402
+
+def check(name, result, clients):
+    GetData.namespace_cache.clear()
+    expected = GetData.count_metrics(list(clients), None, 8, get_stub_client_factory(clients))
+    if result['total'] != expected['total'] or result['by_namespace'] != expected['by_namespace']:
+        print(f'{name}: {result["total"]} metrics in the snapshot, expected {expected["total"]}')
+        sys.exit(1)
+    refresh = result['last_refresh']
+    print(f'  {name:<28} {result["seconds"]:>8.3f} s  {result["total"]:>9,} metrics  '
+          f'age {result["snapshot_age_seconds"]:>3} s  last refresh: {refresh["mode"]}, '
+          f'{refresh["api_calls"]} ListMetrics calls, {refresh["seconds"]} s, {refresh["new_metrics"]:,} new metrics')
+
+def refresh(name, location, regions, factory, full=False):
+    snapshot = GetData.refresh_snapshot_if_due(location, regions, 8, factory, full)
+    refresh = snapshot['last_refresh']
+    print(f'  {name:<28} {refresh["seconds"]:>8.3f} s  {refresh["mode"]}, {refresh["api_calls"]} ListMetrics calls, '
+          f'{refresh["new_metrics"]:,} new metrics')
+
+def main(region_count, namespace_count, metric_count, scale):
+    regions = ['us-east-1', 'us-west-2', 'eu-west-1', 'ap-southeast-2'][:region_count]
+    namespaces = {f'Custom/App{n}': metric_count for n in range(namespace_count)}
+    namespaces['Custom/Idle'] = metric_count // 10
+    clients = {
+        region: StubCloudWatch(region, dict(namespaces), 0.05 * scale, idle=['Custom/Idle'])
+        for region in regions
+    }
+    factory = get_stub_client_factory(clients)
+    print(f'{len(regions)} regions, {len(namespaces)} namespaces, {len(regions) * sum(namespaces.values()):,} metrics')
+
+    with tempfile.TemporaryDirectory() as directory:
+        location = os.path.join(directory, 'snapshot.json')
+        usage = lambda: GetData.get_metrics_usage(location)  # noqa: E731
+
+        result = usage()
+        if result['total'] is not None or result['refresh_due'] != 'full':
+            print(f'read without a snapshot: {result}')
+            sys.exit(1)
+        print(f'  {"read without a snapshot":<28} {result["seconds"]:>8.3f} s  full refresh due')
+
+        refresh('first refresh', location, regions, factory)
+        check('read from the file', usage(), clients)
+        check('read from memory', usage(), clients)
+
+        for client in clients.values():
+            client.add_metrics('Custom/App0', 1000)
+            client.add_metrics('Custom/New', 250)
+        GetData.SNAPSHOT_REFRESH_INTERVAL = 0
+        refresh('incremental refresh', location, regions, factory)
+        GetData.SNAPSHOT_CACHE_TTL = 0
+        check('read after the refresh', usage(), clients)
+
+        refresh('full rescan', location, regions, factory, full=True)
+        check('read after the rescan', usage(), clients)
+        size = os.path.getsize(location) + os.path.getsize(location + '.digests')
+        print(f'snapshot: {os.path.getsize(location):,} bytes of counts, {size:,} bytes with the digests')
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 5000,
+         float(sys.argv[4]) if len(sys.argv) > 4 else 1)
@@ -0,0 +1,64 @@
+import time
+from types import SimpleNamespace
+
+# A local stand-in for the ListMetrics paginator of a CloudWatch client, for
+# benchmarking GetData.py without an AWS account. Each page takes
+# page_latency seconds, like a ListMetrics call, and has up to 500 metrics.
+
+PAGE_SIZE = 500
+
+class StubCloudWatch:
+    def __init__(self, region, namespaces, page_latency=0.05, recently_active_every=3, idle=()):
+        # namespaces: metric count by namespace. Every recently_active_every-th
+        # metric of a namespace had data points in the last 3 hours, except in
+        # the idle namespaces.
+        self.meta = SimpleNamespace(region_name=region)
+        self.namespaces = namespaces
+        self.page_latency = page_latency
+        self.recently_active_every = recently_active_every
+        self.idle = set(idle)
+        # The first metric added by add_metrics, by namespace
+        self.added_from = {}
+
+    def add_metrics(self, namespace, count):
+        # New metrics, all of them recently active
+        self.added_from.setdefault(namespace, self.namespaces.get(namespace, 0))
+        self.namespaces[namespace] = self.namespaces.get(namespace, 0) + count
+
+    def is_recently_active(self, namespace, i):
+        if i >= self.added_from.get(namespace, self.namespaces[namespace]):
+            return True
+        return namespace not in self.idle and i % self.recently_active_every == 0
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'list_metrics'
+        return self
+
+    def paginate(self, Namespace=None, RecentlyActive=None, **kwargs):
+        # The metrics of every namespace in turn, as the API returns them
+        namespaces = [Namespace] if Namespace else sorted(self.namespaces)
+        metrics = (
+            {'Namespace': namespace, 'MetricName': f'Metric{i}', 'Dimensions': [{'Name': 'Id', 'Value': str(i)}]}
+            for namespace in namespaces
+            for i in range(self.namespaces.get(namespace, 0))
+            if RecentlyActive is None or self.is_recently_active(namespace, i)
+        )
+        page = []
+        for metric in metrics:
+            page.append(metric)
+            if len(page) == PAGE_SIZE:
+                time.sleep(self.page_latency)
+                yield {'Metrics': page}
+                page = []
+        time.sleep(self.page_latency)
+        yield {'Metrics': page}
+
+def get_stub_client_factory(namespaces_by_region, page_latency=0.05, idle=()):
+    # A client_factory of GetData.count_metrics, with the metric counts of each region
+    # namespaces_by_region: metric count by namespace, or a StubCloudWatch, by region
+    def client_factory(region, max_workers):
+        namespaces = namespaces_by_region[region or 'us-east-1']
+        if isinstance(namespaces, StubCloudWatch):
+            return namespaces
+        return StubCloudWatch(region or 'us-east-1', namespaces, page_latency, idle=idle)
+    return client_factory